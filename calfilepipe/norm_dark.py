@@ -30,6 +30,11 @@ import sqlite3
 import glob, os, sys
 import cal_tools
 
+# has_column() is with the ingest code in ../db
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "db"))
+import query_frames
+
 # Usage: average_darks.py date
 """ Find all the darks in the database from the supplied date.
     If a date isn't supplied, find the most recent dark in the
@@ -65,6 +70,12 @@ def get_dark_list(date):
 
   cur = conn.cursor()
 
+  # Leave out copies of earlier frames, if the ingest has marked them
+  # (databases from before the duplicate_of column have none).
+  unique = ""
+  if (query_frames.has_column(conn, "duplicate_of")):
+    unique = " AND duplicate_of IS NULL"
+
   if (date == None):
     # They didn't supply an argument to get most recent data.
     cur.execute(
@@ -78,7 +89,7 @@ def get_dark_list(date):
     cur.execute("select dateobs,path,exptime FROM images \
     WHERE imagetyp='Dark Frame' \
       AND dateobs >= date(?) \
-      AND dateobs <  date(?, '+1 day')",(date, date,))
+      AND dateobs <  date(?, '+1 day')" + unique, (date, date,))
     rows = cur.fetchall()
 
   else:
@@ -87,7 +98,7 @@ def get_dark_list(date):
     cur.execute("select dateobs,path,exptime FROM images \
     WHERE imagetyp='Dark Frame' \
       AND dateobs >= date(?) \
-      AND dateobs <  date(?, '+1 day')",(date, date,))
+      AND dateobs <  date(?, '+1 day')" + unique, (date, date,))
     rows = cur.fetchall()
 
   # Return a list of tuples, each containing the path and the exptime.
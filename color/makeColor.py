@@ -1,4 +1,6 @@
 import argparse
+import os, sys
+import sqlite3
 from PIL import Image
 import numpy as np
 import astropy.io.fits as pyfits
@@ -28,6 +30,10 @@ if __name__ == "__main__":
     help="min percentile when taking log")
   parser.add_argument("-prcntmaxlog", default=99.9, type=float,
     help="max percentile when taking log")
+  parser.add_argument("-db", default=None,
+    help="database file (default ../../db/PW17QSI.db from this script)")
+  parser.add_argument("--nodb", default=False, action="store_true",
+    help="don't record the composite for the web color gallery")
   
   args = parser.parse_args()
 
@@ -95,3 +101,23 @@ if __name__ == "__main__":
   # Write the array out as a JPEG file.
   img = Image.fromarray(rgbArray)
   img.save(outputfilename)
+
+  # Record it (with a small preview) for the astrobrowse color gallery.
+  if (not args.nodb):
+    this_path, this_file = os.path.split(os.path.abspath(__file__))
+    sys.path.append(this_path + "/../db")
+    import color_products
+    db_path = args.db
+    if (db_path == None):
+      db_path = this_path + "/../../db/PW17QSI.db"
+    conn = sqlite3.connect(db_path)
+    color_products.create_color_table(conn)
+    if (takelog):
+      pmin, pmax = percentileminlog, percentilemaxlog
+    else:
+      pmin, pmax = percentilemin, percentilemax
+    if (not color_products.record_color(conn, outputfilename, img,
+        this_path + "/../../data", redfile, greenfile, bluefile,
+        takelog, pmin, pmax)):
+      print("not under the data directory; not added to the color gallery")
+    conn.close()
@@ -0,0 +1,159 @@
+
+import sqlite3
+import argparse
+import datetime
+import os, sys
+from PIL import Image
+
+# Usage: color_products.py --rebuild     (record every JPEG in data/color)
+#        color_products.py               (list the recorded products)
+#
+# The color_products table backs the /astrobrowse/color gallery.
+# makeColor.py records each composite it writes, so the web page never
+# lists the directory or opens the full size images.
+
+# Width of the gallery previews in pixels.
+PREVIEW_WIDTH = 400
+
+# Previews live in this subdirectory next to the composite.
+PREVIEW_DIR = "previews"
+
+def create_color_table(conn):
+  """ One row per color composite.  Paths are relative to the data
+      root, as in the images table."""
+
+  conn.execute(
+      '''create table if not exists color_products
+           ( path           text   primary key,
+             red            text,
+             green          text,
+             blue           text,
+             takelog        int,
+             prcntmin       real,
+             prcntmax       real,
+             width          int,
+             height         int,
+             previewpath    text,
+             previewwidth   int,
+             previewheight  int,
+             created        text);''')
+
+
+def data_relative(path, data_root):
+  """ path relative to data_root, or None if it is outside it."""
+
+  rel = os.path.relpath(os.path.abspath(path), os.path.abspath(data_root))
+  if (rel.startswith("..")):
+    return None
+  return rel
+
+
+def write_preview(img, outfile, width=PREVIEW_WIDTH):
+  """ Save a small JPEG of a PIL image in PREVIEW_DIR next to outfile.
+
+      Return: (preview file name, width, height)"""
+
+  out_dir, out_name = os.path.split(os.path.abspath(outfile))
+  prev_dir = os.path.join(out_dir, PREVIEW_DIR)
+  os.makedirs(prev_dir, exist_ok=True)
+  prev_file = os.path.join(prev_dir, os.path.splitext(out_name)[0] + ".jpg")
+
+  small = img.convert("RGB")
+  small.thumbnail((width, width * 4), Image.LANCZOS)
+  tmp = prev_file + ".tmp"
+  small.save(tmp, format="JPEG", quality=85)
+  os.replace(tmp, prev_file)
+
+  return prev_file, small.width, small.height
+
+
+def record_color(conn, outfile, img, data_root, red=None, green=None,
+                 blue=None, takelog=False, prcntmin=None, prcntmax=None):
+  """ Write the preview of a composite and insert or update its row.
+      img is the PIL image just saved to outfile, so nothing is re-read.
+
+      Return: True if recorded, False if outfile is outside data_root"""
+
+  path = data_relative(outfile, data_root)
+  if (path == None):
+    return False
+
+  prev_file, pwidth, pheight = write_preview(img, outfile)
+
+  def source(name):
+    if (name == None):
+      return None
+    rel = data_relative(name, data_root)
+    return rel if (rel != None) else name
+
+  conn.execute("insert or replace into color_products values \
+    (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+    (path, source(red), source(green), source(blue), int(bool(takelog)),
+     prcntmin, prcntmax, img.width, img.height,
+     data_relative(prev_file, data_root), pwidth, pheight,
+     datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")))
+  conn.commit()
+  return True
+
+
+def rebuild(conn, data_root, color_dir="color", echo=True):
+  """ Record the JPEG composites already in data/color that have no
+      row yet (their sources and stretch are not known).
+
+      Return: number of composites recorded"""
+
+  known = set(row[0] for row in conn.execute("select path from color_products"))
+  count = 0
+  top = os.path.join(data_root, color_dir)
+  for name in sorted(os.listdir(top)):
+    full = os.path.join(top, name)
+    if ((not os.path.isfile(full)) or
+        (not name.lower().endswith((".jpg", ".jpeg", ".png")))):
+      continue
+    if (data_relative(full, data_root) in known):
+      continue
+    with Image.open(full) as img:
+      img.load()
+      record_color(conn, full, img, data_root)
+    count = count + 1
+    if (echo):
+      print(full)
+  return count
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="""
+  Maintain the color_products table used by the astrobrowse color
+  gallery.  With --rebuild, record the composites found in data/color.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--rebuild", default=False, action="store_true",
+    help="record (with previews) composites not in the table yet")
+  parser.add_argument("-data", default=None,
+    help="data root (default ../../data from this script)")
+  parser.add_argument("-db", default=None,
+    help="database file (default ../../db/PW17QSI.db from this script)")
+
+  args = parser.parse_args()
+
+  # Get the path to the database.
+  this_path, this_file = os.path.split(os.path.abspath(__file__))
+  db_path = args.db
+  if (db_path == None):
+    db_path = this_path + "/../../db/PW17QSI.db"
+  data_root = args.data
+  if (data_root == None):
+    data_root = this_path + "/../../data"
+
+  conn = sqlite3.connect(db_path)
+  create_color_table(conn)
+
+  if (args.rebuild):
+    count = rebuild(conn, data_root)
+    print("recorded {} composites".format(count))
+  else:
+    for row in conn.execute("select path, width, height, red, green, blue \
+                             from color_products order by path"):
+      print("{}  {}x{}  {} {} {}".format(*row))
+
+  conn.close()
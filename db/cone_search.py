@@ -0,0 +1,345 @@
+
+import sqlite3
+import argparse
+import math
+import os, sys
+
+# Usage: cone_search.py ra dec [radius]
+#        cone_search.py --box ramin ramax decmin decmax
+#        cone_search.py --rebuild
+
+# Nominal plate scale (arcsec per unbinned pixel) used when a header
+# has no XPIXSZ/FOCALLEN to compute it from.  Override with --platescale.
+DEFAULT_PLATE_SCALE = 0.38
+
+def create_pointing_tables(conn):
+  """ Pointing in degrees plus an R-tree over each frame's footprint.
+      pointing.id is the R-tree id, so the two stay in step even if
+      the images rowids change (e.g. after a VACUUM).
+
+      The footprint RA range is left unwrapped (it may run below 0
+      or above 360) and the queries below search the shifted copies."""
+
+  conn.execute(
+      '''create table if not exists pointing
+           ( id             integer primary key,
+             path           text   unique not null,
+             ra             real,
+             dec            real,
+             halfwidth      real,
+             halfheight     real);''')
+
+  conn.execute(
+      '''create virtual table if not exists footprints
+           using rtree(id, ramin, ramax, decmin, decmax);''')
+
+
+def parse_sexagesimal(value, hours=False):
+  """ Convert '05 34 31.94', '05:34:31.94', '+22 00 52.2' or a plain
+      number to degrees.  The value is in hours when hours=True
+      (sexagesimal or plain, e.g. RA 5.5 = 82.5 deg); a plain number
+      ending in 'h' or 'd' ('5.5h', '82.5d') is in hours or degrees
+      whatever hours says.
+
+      Argument: string or number
+      Return: degrees, or None if the value can't be parsed."""
+
+  if (value == None):
+    return None
+  if (isinstance(value, (int, float))):
+    return float(value) * (15.0 if hours else 1.0)
+
+  text = str(value).strip()
+  if ((text == "") or (text == "NONE")):
+    return None
+  if (text[-1:].lower() in ("h", "d")):
+    hours = (text[-1:].lower() == "h")
+    text = text[:-1].strip()
+
+  parts = text.replace(":", " ").split()
+  if (len(parts) == 0):
+    return None
+  try:
+    sign = -1.0 if parts[0].startswith("-") else 1.0
+    deg = abs(float(parts[0]))
+    for i, p in enumerate(parts[1:3]):
+      deg = deg + float(p) / 60.0**(i+1)
+  except ValueError:
+    return None
+
+  deg = sign * deg
+  if (hours):
+    deg = deg * 15.0
+  return deg
+
+
+def plate_scale(xpixsz=None, focallen=None, binning=1,
+                default=DEFAULT_PLATE_SCALE):
+  """ Arcsec per (binned) pixel.  MaxIm's XPIXSZ is the binned pixel
+      size in microns, so no binning factor is applied to it.
+
+      Argument: XPIXSZ, FOCALLEN (mm), binning, default unbinned scale
+      Return: arcsec per binned pixel"""
+
+  try:
+    if ((xpixsz != None) and (focallen != None) and (float(focallen) > 0)):
+      return 206.265 * float(xpixsz) / float(focallen)
+  except (TypeError, ValueError):
+    pass
+
+  try:
+    binning = int(binning)
+  except (TypeError, ValueError):
+    binning = 1
+  return default * max(binning, 1)
+
+
+def footprint(objctra, objctdec, naxis1, naxis2, scale):
+  """ Frame center and half sizes in degrees.
+
+      Argument: OBJCTRA, OBJCTDEC, NAXIS1, NAXIS2, arcsec per pixel
+      Return: (ra, dec, halfwidth, halfheight) or None"""
+
+  ra = parse_sexagesimal(objctra, hours=True)
+  dec = parse_sexagesimal(objctdec)
+  if ((ra == None) or (dec == None)):
+    return None
+
+  try:
+    halfwidth = 0.5 * int(naxis1) * scale / 3600.0
+    halfheight = 0.5 * int(naxis2) * scale / 3600.0
+  except (TypeError, ValueError):
+    halfwidth = 0.0
+    halfheight = 0.0
+
+  return (ra % 360.0, dec, halfwidth, halfheight)
+
+
+def ra_halfrange(dec, half):
+  """ Half range in RA that covers +/- half degrees about dec.
+      Returns 180 once the region touches a pole."""
+
+  if (abs(dec) + half >= 90.0):
+    return 180.0
+  return math.degrees(math.asin(min(1.0,
+    math.sin(math.radians(half)) / math.cos(math.radians(dec)))))
+
+
+def _dra_box(ra, dec, dra, half_dec):
+  """ Box of +/- dra (RA) and half_dec (Dec) about ra, dec."""
+
+  if (dra >= 180.0):
+    return (0.0, 360.0, max(-90.0, dec - half_dec), min(90.0, dec + half_dec))
+  return (ra - dra, ra + dra, dec - half_dec, dec + half_dec)
+
+
+def ra_box(ra, dec, half_ra, half_dec):
+  """ RA/Dec bounding box (unwrapped RA) of a frame footprint centred
+      on ra, dec: half_ra is a tangent-plane half width, so the RA
+      range is set at the footprint edge nearest the pole."""
+
+  edge = min(89.999, abs(dec) + half_dec)
+  dra = min(180.0, half_ra / math.cos(math.radians(edge)))
+  return _dra_box(ra, dec, dra, half_dec)
+
+
+def circle_box(ra, dec, radius):
+  """ RA/Dec bounding box (unwrapped RA) of a circle of radius degrees."""
+
+  return _dra_box(ra, dec, ra_halfrange(dec, radius), radius)
+
+
+def insert_pointing(cursor, path, fp):
+  """ Add or replace the pointing row and R-tree entry for one frame.
+
+      Argument: cursor, images.path, footprint() result"""
+
+  cursor.execute("select id from pointing where path=?", (path,))
+  row = cursor.fetchone()
+  if (row != None):
+    cursor.execute("delete from footprints where id=?", (row[0],))
+    cursor.execute("delete from pointing where id=?", (row[0],))
+
+  if (fp == None):
+    return
+
+  ra, dec, halfwidth, halfheight = fp
+  cursor.execute("insert into pointing (path, ra, dec, halfwidth, halfheight) \
+    values (?, ?, ?, ?, ?)", (path, ra, dec, halfwidth, halfheight))
+  ramin, ramax, decmin, decmax = ra_box(ra, dec, halfwidth, halfheight)
+  cursor.execute("insert into footprints (id, ramin, ramax, decmin, decmax) \
+    values (?, ?, ?, ?, ?)", (cursor.lastrowid, ramin, ramax, decmin, decmax))
+
+
+def separation(ra1, dec1, ra2, dec2):
+  """ Angular separation in degrees (haversine)."""
+
+  ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+  h = math.sin((dec2 - dec1) / 2.0)**2 + \
+      math.cos(dec1) * math.cos(dec2) * math.sin((ra2 - ra1) / 2.0)**2
+  return math.degrees(2.0 * math.asin(min(1.0, math.sqrt(h))))
+
+
+def _rtree_candidates(conn, ramin, ramax, decmin, decmax):
+  """ Yield pointing rows whose footprint box overlaps the query box,
+      searching the RA-shifted copies so boxes across 0/360 are found."""
+
+  seen = set()
+  for shift in (0.0, -360.0, 360.0):
+    cur = conn.execute("select p.id, p.path, p.ra, p.dec, \
+      p.halfwidth, p.halfheight from footprints f \
+      join pointing p on p.id = f.id \
+      where f.ramax >= ? and f.ramin <= ? \
+      and f.decmax >= ? and f.decmin <= ?",
+      (ramin + shift, ramax + shift, decmin, decmax))
+    for row in cur:
+      if (row[0] not in seen):
+        seen.add(row[0])
+        yield row
+
+
+def tangent_offsets(ra, dec, ra0, dec0):
+  """ Gnomonic (tangent plane) offsets of ra, dec from ra0, dec0.
+
+      Return: (xi, eta) in degrees, or None if the point is 90 degrees
+              or more away"""
+
+  ra, dec, ra0, dec0 = map(math.radians, (ra, dec, ra0, dec0))
+  cosc = math.sin(dec0) * math.sin(dec) + \
+         math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0)
+  if (cosc <= 0.0):
+    return None
+  xi = math.cos(dec) * math.sin(ra - ra0) / cosc
+  eta = (math.cos(dec0) * math.sin(dec) -
+         math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0)) / cosc
+  return (math.degrees(xi), math.degrees(eta))
+
+
+def cone_search(conn, ra, dec, radius=0.0):
+  """ Frames whose footprint comes within radius (deg) of ra, dec.
+      radius=0 finds the frames covering that position.
+      The footprint is treated as aligned with RA/Dec, since the
+      headers carry no position angle, and the distance to it is
+      measured in the frame's tangent plane (so it is approximate for
+      fields and radii of many degrees).
+
+      Argument: connection, ra, dec, radius in degrees
+      Return: list of (path, ra, dec, separation) sorted by separation"""
+
+  ramin, ramax, decmin, decmax = circle_box(ra, dec, radius)
+  matches = []
+  for pid, path, fra, fdec, hw, hh in \
+      _rtree_candidates(conn, ramin, ramax, decmin, decmax):
+    # Distance from the position to the footprint rectangle, in the
+    # tangent plane of the frame center.
+    offsets = tangent_offsets(ra, dec, fra, fdec)
+    if (offsets == None):
+      continue
+    dx = max(0.0, abs(offsets[0]) - hw)
+    dy = max(0.0, abs(offsets[1]) - hh)
+    if (math.hypot(dx, dy) <= radius):
+      matches.append((path, fra, fdec, separation(ra, dec, fra, fdec)))
+
+  matches.sort(key=lambda m: m[3])
+  return matches
+
+
+def box_search(conn, ramin, ramax, decmin, decmax):
+  """ Frames whose footprint overlaps an RA/Dec box (degrees).
+      ramin > ramax means the box wraps through RA=0.
+
+      Return: list of (path, ra, dec) sorted by path"""
+
+  if (ramin > ramax):
+    ramax = ramax + 360.0
+  matches = [(row[1], row[2], row[3]) for row in
+             _rtree_candidates(conn, ramin, ramax, decmin, decmax)]
+  matches.sort()
+  return matches
+
+
+def rebuild(conn, default_scale=DEFAULT_PLATE_SCALE):
+  """ (Re)compute the pointing of every images row from the stored
+      keywords, using XPIXSZ/FOCALLEN from the headers table if present.
+      For frames ingested before the pointing tables existed.
+
+      Return: number of frames with a usable pointing"""
+
+  create_pointing_tables(conn)
+  cursor = conn.cursor()
+  rows = conn.execute("select i.path, i.objctra, i.objctdec, \
+    i.naxis1, i.naxis2, i.xbinning, \
+    (select value from headers h where h.path = i.path \
+       and h.keyword = 'XPIXSZ'), \
+    (select value from headers h where h.path = i.path \
+       and h.keyword = 'FOCALLEN') \
+    from images i").fetchall()
+
+  count = 0
+  for path, objctra, objctdec, naxis1, naxis2, xbin, xpixsz, focallen in rows:
+    scale = plate_scale(xpixsz, focallen, xbin, default=default_scale)
+    fp = footprint(objctra, objctdec, naxis1, naxis2, scale)
+    insert_pointing(cursor, path, fp)
+    if (fp != None):
+      count = count + 1
+  conn.commit()
+
+  return count
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="""
+  Find the frames covering a position (cone search) or overlapping
+  an RA/Dec box, using the R-tree built at ingest.  RA may be given
+  in degrees ('83.6' or '83.6d') or in hours ('5.57h', '05:34:31.9'),
+  Dec in degrees or sexagesimal degrees.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("ra", nargs="?",
+    help="RA of the cone center: degrees, or hours as 5.57h or 05:34:31.9")
+  parser.add_argument("dec", nargs="?", help="Dec of the cone center")
+  parser.add_argument("radius", nargs="?", default=0.0, type=float,
+    help="cone radius in degrees; 0 = frames covering the position")
+  parser.add_argument("--box", nargs=4, type=float, default=None,
+    metavar=("RAMIN", "RAMAX", "DECMIN", "DECMAX"),
+    help="search a box (degrees) instead of a cone")
+  parser.add_argument("--rebuild", default=False, action="store_true",
+    help="recompute the pointing index for every ingested frame")
+  parser.add_argument("--platescale", default=DEFAULT_PLATE_SCALE,
+    type=float, help="arcsec per unbinned pixel when the header has none")
+  parser.add_argument("-db", default=None,
+    help="database file (default ../../db/PW17QSI.db from this script)")
+
+  args = parser.parse_args()
+
+  # Get the path to the database.
+  this_path, this_file = os.path.split(os.path.abspath(__file__))
+  db_path = args.db
+  if (db_path == None):
+    db_path = this_path + "/../../db/PW17QSI.db"
+
+  conn = sqlite3.connect(db_path)
+  create_pointing_tables(conn)
+
+  if (args.rebuild):
+    count = rebuild(conn, default_scale=args.platescale)
+    print("indexed {} frames".format(count))
+
+  if (args.box != None):
+    for path, ra, dec in box_search(conn, *args.box):
+      print("{}  {:10.5f} {:+10.5f}".format(path, ra, dec))
+
+  elif (args.ra != None):
+    ra = parse_sexagesimal(args.ra, hours=(":" in args.ra or " " in args.ra))
+    dec = parse_sexagesimal(args.dec)
+    if ((ra == None) or (dec == None)):
+      print("usage: cone_search.py ra dec [radius]")
+      sys.exit(2)
+    for path, fra, fdec, sep in cone_search(conn, ra, dec, args.radius):
+      print("{}  {:10.5f} {:+10.5f}  {:8.4f}".format(path, fra, fdec, sep))
+
+  elif (not args.rebuild):
+    parser.print_usage()
+    sys.exit(2)
+
+  conn.close()
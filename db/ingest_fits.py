@@ -1,8 +1,12 @@
 
 import sqlite3
+import argparse
 import numpy as np
 from astropy.io import fits
 import glob, os, sys
+import hashlib
+import io
+import cone_search
 
 def create_images_table(conn):
 
@@ -35,15 +39,468 @@ def create_images_table(conn):
              jd             real,
              jdhelio       real);''')
 
+  # The (name, path) lookup is done for every ingested file.
+  conn.execute('''create index if not exists images_path
+                    on images (path)''')
+  # Night (date range) selections and ordering by observation time.
+  conn.execute('''create index if not exists images_dateobs
+                    on images (dateobs)''')
+
+  # Filters and sort columns of the astrobrowse JSON API; each filter
+  # is followed by the observation time, its /api/frames sort tiebreak.
+  for col in ("imagetyp", "filter", "object"):
+    conn.execute("create index if not exists images_" + col +
+                 " on images (" + col + ", dateobs)")
+  conn.execute('''create index if not exists images_exptime
+                    on images (exptime)''')
+  conn.execute('''create index if not exists images_name
+                    on images (name)''')
+
+  migrate_images_table(conn)
+
+
+def migrate_images_table(conn):
+  """ Bring an existing images table up to the current schema: the
+      columns added after it was first deployed.  Every writer calls
+      it (through create_images_table()); readers that open the
+      database read-only check for the columns instead (see
+      query_frames.has_column())."""
+
+  add_column(conn, "images", "datasum", "text")
+  add_column(conn, "images", "duplicate_of", "text")
+  conn.execute('''create index if not exists images_datasum
+                    on images (datasum)''')
+
+
+def add_column(conn, table, column, decl):
+  """ Add a column to an existing table if it isn't there yet."""
+
+  columns = [row[1] for row in conn.execute("pragma table_info(" + table + ")")]
+  if (column not in columns):
+    conn.execute("alter table " + table + " add column " + column + " " + decl)
+
+
+def create_frame_stats_table(conn):
+  """ Per-frame image statistics, one row per images.path.
+      The calibration and stacking selectors can join on path
+      and filter or weight frames without reading pixel data."""
+
+  conn.execute(
+      '''create table if not exists frame_stats
+           ( path           text   primary key not null,
+             median         real,
+             mad            real,
+             clipmean       real,
+             clipstd        real,
+             nsat           int,
+             satlevel       real,
+             nstars         int,
+             fwhm           real);''')
+
+
+def create_headers_table(conn):
+  """ The complete primary header of every ingested frame, one row
+      per card, keyed on images.path and card order.  Values keep
+      their FITS type (int, real or text)."""
+
+  conn.execute(
+      '''create table if not exists headers
+           ( path           text   not null,
+             seq            int    not null,
+             keyword        text   not null,
+             value,
+             primary key (path, seq));''')
+
+  # Keyword queries, e.g. keyword='SET-TEMP' and value < -15
+  conn.execute('''create index if not exists headers_kv
+                    on headers (keyword, value)''')
+
+
+def header_rows(path, header):
+  """ Convert a FITS header into rows for the headers table.
+
+      Argument: images.path, astropy header
+      Return: a list of (path, seq, keyword, value) tuples."""
+
+  rows = []
+  for seq, card in enumerate(header.cards):
+    value = card.value
+    if (isinstance(value, bool)):
+      value = int(value)
+    elif (not isinstance(value, (int, float, str))):
+      # Undefined values and anything else astropy hands back
+      value = None if (value is None) else str(value)
+      if (value == ""):
+        value = None
+    rows.append((path, seq, card.keyword, value))
+
+  return rows
+
+
+def find_stars(sub, background, sigma, nsigma=5.0, satlevel=65535,
+               halfbox=4, maxstars=50):
+  """ Find local maxima above background + nsigma * sigma in a 2-D
+      (sub)image and estimate the FWHM from the second moments of
+      the brightest unsaturated ones.
+
+      Single hot pixels and cosmic rays are rejected by requiring
+      the 8 neighbours to carry some of the peak flux.
+
+      Argument: 2-D image array, background level and sigma
+      Return: (number of stars, median FWHM in pixels or None)"""
+
+  ny, nx = sub.shape
+  if ((ny < 3) or (nx < 3) or (sigma <= 0)):
+    return (0, None)
+
+  sub = sub.astype(np.float32)
+  c = sub[1:-1, 1:-1]
+  peak = c > (background + nsigma * sigma)
+  neighbours = np.zeros(c.shape, dtype=np.float32)
+  for dy in (-1, 0, 1):
+    for dx in (-1, 0, 1):
+      if ((dy == 0) and (dx == 0)):
+        continue
+      n = sub[1+dy:ny-1+dy, 1+dx:nx-1+dx]
+      neighbours += n
+      # Break ties on flat (e.g. saturated) tops so that each
+      # plateau is only counted once.
+      if ((dy, dx) < (0, 0)):
+        peak &= (c > n)
+      else:
+        peak &= (c >= n)
+  neighbours = neighbours / 8.0 - background
+  peak &= neighbours > 0.2 * (c - background)
+
+  ys, xs = np.nonzero(peak)
+  nstars = len(ys)
+  if (nstars == 0):
+    return (0, None)
+  ys = ys + 1
+  xs = xs + 1
+
+  # Brightest unsaturated stars away from the edges.
+  peaks = sub[ys, xs]
+  order = np.argsort(peaks)[::-1]
+  yy, xx = np.mgrid[-halfbox:halfbox+1, -halfbox:halfbox+1]
+  fwhms = []
+  for i in order:
+    if (len(fwhms) >= maxstars):
+      break
+    y = ys[i]
+    x = xs[i]
+    if (peaks[i] >= satlevel):
+      continue
+    if ((y < halfbox) or (x < halfbox) or
+        (y >= ny - halfbox) or (x >= nx - halfbox)):
+      continue
+    box = sub[y-halfbox:y+halfbox+1, x-halfbox:x+halfbox+1] - background
+    box = np.clip(box, 0, None)
+    total = box.sum()
+    if (total <= 0):
+      continue
+    my = (box * yy).sum() / total
+    mx = (box * xx).sum() / total
+    var = (box * ((yy - my)**2 + (xx - mx)**2)).sum() / total / 2.0
+    if (var > 0):
+      fwhms.append(2.3548 * np.sqrt(var))
+
+  if (len(fwhms) == 0):
+    return (nstars, None)
+
+  return (nstars, float(np.median(fwhms)))
+
+
+def compute_frame_stats(image_data, satlevel=65535, nsigma=3.0, niter=5,
+                        star_box=1024):
+  """ Compute a compact set of statistics for one frame.
+      The median, MAD, sigma-clipped mean/std and saturated pixel count
+      are computed over the whole frame.  The star count and FWHM
+      are estimated from a central box of at most star_box pixels
+      on a side.
+
+      Argument: 2-D image array
+      Return: a dictionary of statistics."""
+
+  data = np.asarray(image_data)
+  if (data.ndim > 2):
+    data = data[0]
+
+  nsat = int(np.count_nonzero(data >= satlevel))
+
+  flat = data.ravel().astype(np.float32)
+  median = float(np.median(flat))
+  mad = float(np.median(np.abs(flat - median)))
+
+  # Iterative sigma clip about the median.
+  clipped = flat
+  center = median
+  for i in range(niter):
+    std = clipped.std()
+    if (std == 0):
+      break
+    keep = np.abs(clipped - center) < nsigma * std
+    if (keep.all()):
+      break
+    clipped = clipped[keep]
+    if (clipped.size == 0):
+      clipped = flat
+      break
+    center = np.median(clipped)
+  clipmean = float(clipped.mean())
+  clipstd = float(clipped.std())
+
+  ny, nx = data.shape
+  y0 = max(0, (ny - star_box) // 2)
+  x0 = max(0, (nx - star_box) // 2)
+  sub = data[y0:y0+star_box, x0:x0+star_box]
+  nstars, fwhm = find_stars(sub, median, 1.4826 * mad, satlevel=satlevel)
+
+  return {"median": median, "mad": mad,
+          "clipmean": clipmean, "clipstd": clipstd,
+          "nsat": nsat, "satlevel": float(satlevel),
+          "nstars": nstars, "fwhm": fwhm}
+
+
+def buffer_checksum(buf):
+  """ Checksum (BLAKE2b, 128 bit) of the data unit only, so copies with
+      edited headers still match.
+
+      Argument: the data unit bytes (e.g. a memoryview of the file)
+      Return: hex digest"""
+
+  return hashlib.blake2b(buf, digest_size=16).hexdigest()
+
+
+def frame_paths(infile, this_dir):
+  """ images table path and thumbpath of a frame: NIGHT/<base>.fit and
+      NIGHT/<base>.png, whatever the FITS file's own suffix.
+
+      Argument: FITS file, night directory
+      Return: (path, thumbpath)"""
+
+  file_base_no_ext = os.path.splitext(os.path.basename(infile))[0]
+  dir_base_name = os.path.basename(this_dir)
+  return (dir_base_name + "/" + file_base_no_ext + ".fit",
+          dir_base_name + "/" + file_base_no_ext + ".png")
+
+
+def frame_record(infile, this_dir, header,
+                 platescale=cone_search.DEFAULT_PLATE_SCALE):
+  """ Everything the images, headers and pointing tables need from
+      one frame's primary header.
+
+      Argument: FITS file, night directory, its header,
+                default arcsec per unbinned pixel for the footprint
+      Return: dict with name, path, thumbpath, values (images row in
+              insert order), hrows (headers rows), fp (footprint)"""
+
+  file_base_name=os.path.basename(infile)
+  path, thumbpath = frame_paths(infile, this_dir)
+
+  naxis = header["NAXIS"]
+  naxis1 = header["NAXIS1"]
+  naxis2 = header["NAXIS2"]
+  dateobs = header["DATE-OBS"]
+  exptime = header["EXPTIME"]
+  try:
+    ccdtemp = header["CCD-TEMP"]
+  except KeyError:
+    ccdtemp = "NONE"
+  xbinning = header["XBINNING"]
+  ybinning = header["YBINNING"]
+  xorgsubf = header["XORGSUBF"]
+  yorgsubf = header["YORGSUBF"]
+  readoutm = header["READOUTM"]
+  isospeed = header["ISOSPEED"]
+  try:
+    filt = header["FILTER"]
+  except KeyError:
+    filt = "NONE"
+  imtype = header["IMAGETYP"]
+  try:
+    traktime = header["TRAKTIME"]
+  except KeyError:
+    traktime = "NONE"
+  egain = header["EGAIN"]
+  try:
+    focuspos = header["FOCUSPOS"]
+  except KeyError:
+    focuspos = "NONE"
+  try:
+    objectX = header["OBJECT"]
+  except KeyError:
+    objectX = "NONE"
+  try:
+    objctra = header["OBJCTRA"]
+  except KeyError:
+    objctra = "NONE"
+  try:
+    objctdec = header["OBJCTDEC"]
+  except KeyError:
+    objctdec = "NONE"
+  try:
+    objctha = header["OBJCTHA"]
+  except KeyError:
+    objctha = "NONE"
+  jd = header["JD"]
+  jdhelio = header["JD-HELIO"]
+
+  # Pointing in degrees and field footprint for the R-tree.
+  scale = cone_search.plate_scale(header.get("XPIXSZ"),
+    header.get("FOCALLEN"), xbinning, default=platescale)
+  fp = cone_search.footprint(objctra, objctdec, naxis1, naxis2, scale)
+
+  values = (file_base_name, path, thumbpath, naxis, naxis1, naxis2, \
+    dateobs, exptime, ccdtemp, xbinning, ybinning, \
+    xorgsubf, yorgsubf, readoutm, isospeed, filt, \
+    imtype, traktime, egain, focuspos, objectX, \
+    objctra, objctdec, objctha, jd, jdhelio)
+
+  return {"name": file_base_name, "path": path, "thumbpath": thumbpath,
+          "dateobs": dateobs, "values": values,
+          "hrows": header_rows(path, header), "fp": fp}
+
+
+def find_duplicate(cursor, datasum, path):
+  """ An earlier ingested frame with the same data checksum.
+
+      Return: (path, thumbpath) of the original, or None"""
+
+  cursor.execute("select path, thumbpath from images where datasum=? \
+    and path!=? and duplicate_of is null limit 1", (datasum, path))
+  return cursor.fetchone()
+
+
+def store_frame(conn, cursor, rec, datasum, original=None, stats=None):
+  """ Write one frame to the images, headers, pointing (and, given
+      stats, frame_stats) tables and commit.  A copy of an earlier
+      frame (original from find_duplicate()) is linked to it and
+      shares its thumbnail.
+
+      Return: True if a new images row was added."""
+
+  duplicate_of = None
+  thumbpath = rec["thumbpath"]
+  if (original != None):
+    # Point at the original's thumbnail rather than making another.
+    duplicate_of = original[0]
+    thumbpath = original[1]
+
+  sqcommand = "insert into images ( \
+    name, path, thumbpath,  \
+    naxis, naxis1, naxis2, \
+    dateobs, exptime, ccdtemp, \
+    xbinning, ybinning, \
+    xorgsubf, yorgsubf, \
+    readoutm, isospeed, \
+    filter, imagetyp, traktime, \
+    egain, focuspos, object, \
+    objctra, objctdec, objctha, \
+    jd, jdhelio) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, \
+    ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? );"
+
+  file_base_name = rec["name"]
+  path = rec["path"]
+
+  # Check to see if this file is already in the database.
+  cursor.execute("select * from images where name=? and path=?", (file_base_name,path,))
+  rows = cursor.fetchall()
+  added = False
+  if (len(rows) == 0):
+    cursor.execute(sqcommand, rec["values"])
+    added = True
+  cursor.execute("update images set datasum=?, duplicate_of=?, thumbpath=? \
+    where name=? and path=?",
+    (datasum, duplicate_of, thumbpath, file_base_name, path))
+
+  # Keep the stored header in step with the file on re-ingest.
+  cursor.execute("delete from headers where path=?", (path,))
+  cursor.executemany("insert into headers (path, seq, keyword, value) \
+    values (?, ?, ?, ?);", rec["hrows"])
+
+  cone_search.insert_pointing(cursor, path, rec["fp"])
+
+  if ((stats != None) and (duplicate_of == None)):
+    # Upsert only the ingest columns: a replace would drop the stat_
+    # columns that img_stats.py -d adds to the same row.
+    cursor.execute("insert into frame_stats ( \
+      path, median, mad, clipmean, clipstd, \
+      nsat, satlevel, nstars, fwhm) values (?, ?, ?, ?, ?, ?, ?, ?, ?) \
+      on conflict(path) do update set \
+      median=excluded.median, mad=excluded.mad, \
+      clipmean=excluded.clipmean, clipstd=excluded.clipstd, \
+      nsat=excluded.nsat, satlevel=excluded.satlevel, \
+      nstars=excluded.nstars, fwhm=excluded.fwhm;",
+      (path, stats["median"], stats["mad"], stats["clipmean"],
+       stats["clipstd"], stats["nsat"], stats["satlevel"],
+       stats["nstars"], stats["fwhm"]))
+
+  conn.commit()
+
+  return added
+
+
+def ingest_file(conn, cursor, infile, this_dir, do_stats=False,
+                platescale=cone_search.DEFAULT_PLATE_SCALE):
+  """ Read the header (and, if requested, the data) of one FITS
+      file and add it to the database.
+
+      Argument: connection, cursor, FITS file, night directory,
+                whether to compute frame statistics,
+                default arcsec per unbinned pixel for the footprint
+      Return: True if a new images row was added."""
+
+  print(infile)
+  file_base_name=os.path.basename(infile)
+  print (file_base_name)
+  file_base_no_ext, ext = os.path.splitext(file_base_name)
+  print (file_base_no_ext)
+
+  # The file is read once: the header, the checksum and the
+  # statistics all come from this buffer.
+  with open(infile, "rb") as fp:
+    raw = fp.read()
+  hdul = fits.open(io.BytesIO(raw))
+  rec = frame_record(infile, this_dir, hdul[0].header, platescale)
+  print("do = " + rec["dateobs"])
+
+  # Checksum of the data unit, and any earlier copy of the same frame.
+  info = hdul.fileinfo(0)
+  datasum = buffer_checksum(
+    memoryview(raw)[info["datLoc"]:info["datLoc"] + info["datSpan"]])
+  original = find_duplicate(cursor, datasum, rec["path"])
+  if (original != None):
+    print("duplicate of " + original[0])
+
+  # Frame statistics come from the same open file.
+  # Copies are linked to the original instead of being re-measured.
+  stats = None
+  if (do_stats and (original == None)):
+    satlevel = hdul[0].header.get("SATURATE", 65535)
+    stats = compute_frame_stats(hdul[0].data, satlevel=satlevel)
+
+  hdul.close()
+
+  return store_frame(conn, cursor, rec, datasum, original, stats)
+
 
 if __name__ == "__main__":
 
-  n = len(sys.argv)
-  if (n != 2):
-    print("usage: ingest_fits directory")
-    sys.exit(2)
+  parser = argparse.ArgumentParser(description="""
+  Ingest the headers of the FITS files in a night directory into the
+  images and headers tables, optionally computing per-frame statistics.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("directory",
+    help="night directory under ../../data, e.g. UT20210227")
+  parser.add_argument("--stats", default=False, action="store_true",
+    help="also compute per-frame statistics into the frame_stats table")
+  parser.add_argument("--platescale", default=cone_search.DEFAULT_PLATE_SCALE,
+    type=float, help="arcsec per unbinned pixel when the header has none")
+
+  args = parser.parse_args()
 
-  this_dir = "../../data/" + sys.argv[1]
+  this_dir = "../../data/" + args.directory
 
   # Get the path to the database.
   this_path, this_file = os.path.split(os.path.abspath(__file__))
@@ -53,108 +510,22 @@ if __name__ == "__main__":
   conn = sqlite3.connect(db_path)
   cursor = conn.cursor()
 
-  # Create table if it does not exist.
+  # Create tables if they do not exist.
   create_images_table(conn)
+  create_headers_table(conn)
+  cone_search.create_pointing_tables(conn)
+  if (args.stats):
+    create_frame_stats_table(conn)
 
   # For each FITS file (extension = .fit) in the specified directory.
   # Read the header and extract some keywords, read the thumbnail file.
   # Add the file to the database.
   count = 0
   for infile in glob.glob(this_dir + "/*.fit"):
-    print(infile)
-    file_base_name=os.path.basename(infile)
-    print (file_base_name)
-    file_base_no_ext, ext = os.path.splitext(file_base_name)
-    print (file_base_no_ext)
-    dir_base_name=os.path.basename(this_dir)
-    myfile, ext = os.path.splitext(infile)
-    thumbfile = myfile + ".png"
-    #path = os.path.abspath(infile)
-    #thumbpath = os.path.abspath(thumbfile)
-    path = dir_base_name + "/" + file_base_no_ext + ".fit"
-    thumbpath = dir_base_name + "/" + file_base_no_ext + ".png"
-
-    hdul = fits.open(infile)
-    naxis = hdul[0].header["NAXIS"]
-    naxis1 = hdul[0].header["NAXIS1"]
-    naxis2 = hdul[0].header["NAXIS2"]
-    dateobs = hdul[0].header["DATE-OBS"]
-    print("do = " + dateobs)
-    exptime = hdul[0].header["EXPTIME"]
-    try:
-      ccdtemp = hdul[0].header["CCD-TEMP"]
-    except KeyError:
-      ccdtemp = "NONE"
-    xbinning = hdul[0].header["XBINNING"]
-    ybinning = hdul[0].header["YBINNING"]
-    xorgsubf = hdul[0].header["XORGSUBF"]
-    yorgsubf = hdul[0].header["YORGSUBF"]
-    readoutm = hdul[0].header["READOUTM"]
-    isospeed = hdul[0].header["ISOSPEED"]
-    try:
-      filt = hdul[0].header["FILTER"]
-    except KeyError:
-      filt = "NONE"
-    imtype = hdul[0].header["IMAGETYP"]
-    try:
-      traktime = hdul[0].header["TRAKTIME"]
-    except KeyError:
-      traktime = "NONE"
-    egain = hdul[0].header["EGAIN"]
-    try:
-      focuspos = hdul[0].header["FOCUSPOS"]
-    except KeyError:
-      focuspos = "NONE"
-    try:
-      objectX = hdul[0].header["OBJECT"]
-    except KeyError:
-      objectX = "NONE"
-    try:
-      objctra = hdul[0].header["OBJCTRA"]
-    except KeyError:
-      objctra = "NONE"
-    try:
-      objctdec = hdul[0].header["OBJCTDEC"]
-    except KeyError:
-      objctdec = "NONE"
-    try:
-      objctha = hdul[0].header["OBJCTHA"]
-    except KeyError:
-      objctha = "NONE"
-    jd = hdul[0].header["JD"]
-    jdhelio = hdul[0].header["JD-HELIO"]
-
-    hdul.close()
-
-    sqcommand = "insert into images ( \
-      name, path, thumbpath,  \
-      naxis, naxis1, naxis2, \
-      dateobs, exptime, ccdtemp, \
-      xbinning, ybinning, \
-      xorgsubf, yorgsubf, \
-      readoutm, isospeed, \
-      filter, imagetyp, traktime, \
-      egain, focuspos, object, \
-      objctra, objctdec, objctha, \
-      jd, jdhelio) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, \
-      ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? );"
-
-    intuple = (file_base_name, path, thumbpath, naxis, naxis1, naxis2, \
-      dateobs, exptime, ccdtemp, xbinning, ybinning, \
-      xorgsubf, yorgsubf, readoutm, isospeed, filt, \
-      imtype, traktime, egain, focuspos, objectX, \
-      objctra, objctdec, objctha, jd, jdhelio)
-
-    # Check to see if this file is already in the database.
-    cursor.execute("select * from images where name=? and path=?", (file_base_name,path,))
-    rows = cursor.fetchall()
-    if (len(rows) == 0):
-      cursor.execute(sqcommand, intuple)
-      conn.commit()
+    ingest_file(conn, cursor, infile, this_dir, do_stats=args.stats,
+                platescale=args.platescale)
 
     count = count + 1
     #if (count > 20): break
 
   conn.close()
-
-
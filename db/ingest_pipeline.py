@@ -0,0 +1,306 @@
+
+import sqlite3
+import argparse
+import glob
+import io
+import os, sys
+import queue
+import threading
+import time
+from astropy.io import fits
+
+import cone_search
+import ingest_fits
+
+this_path, this_file = os.path.split(os.path.abspath(__file__))
+sys.path.append(this_path + "/../web")
+import fitsToThumb
+
+# Usage: ingest_pipeline.py UT20210227 [UT20210301 ...] [--stats]
+#
+# Header ingest, data checksum, frame statistics and the PNG thumbnail
+# for each file in one pass: a reader thread reads the file once (from
+# the page cache, right after it was downloaded or written) and hands
+# the parsed frame to the checksum worker, which looks the checksum up
+# in the database and passes frames that aren't copies of an ingested
+# one on to the stats and thumbnail workers through queues; a single
+# writer thread then stores the results in the database.
+# drive_sync.py -ingest feeds it each file as soon as its download
+# completes, instead of running db/doit and web/doit afterwards.
+
+# Frames read but not yet written to the database (bounds memory).
+MAX_INFLIGHT = 16
+
+_DONE = None
+
+
+class Frame(object):
+  """ One file on its way through the pipeline."""
+
+  def __init__(self, infile, this_dir):
+    self.infile = infile
+    self.this_dir = this_dir
+    self.raw = None
+    self.span = None
+    self.data = None
+    self.width = None
+    self.satlevel = 65535
+    self.rec = None
+    self.datasum = None
+    self.stats = None
+    self.thumb = None
+    self.thumb_new = False
+    self.original = None
+    self.error = None
+    self.pending = 0
+    self.lock = threading.Lock()
+
+
+class Pipeline(object):
+  """ submit() files, then close() to wait for them all.  Workers run
+      as threads; numpy, hashlib and the PNG encoder release the GIL
+      for the heavy parts."""
+
+  def __init__(self, db_path, do_stats=False, do_thumbs=True, workers=2,
+               platescale=cone_search.DEFAULT_PLATE_SCALE, echo=True):
+    self.db_path = db_path
+    self.do_stats = do_stats
+    self.do_thumbs = do_thumbs
+    self.platescale = platescale
+    self.echo = echo
+    self.inflight = threading.BoundedSemaphore(MAX_INFLIGHT)
+    self.counts = {"added": 0, "updated": 0, "duplicates": 0, "failed": 0}
+    self.lookup = None
+
+    self.read_q = queue.Queue()
+    self.sum_q = queue.Queue()
+    self.stats_q = queue.Queue()
+    self.thumb_q = queue.Queue()
+    self.db_q = queue.Queue()
+
+    self.stages = [(self.read_q, self._read, workers),
+                   (self.sum_q, self._checksum, 1)]
+    if (do_stats):
+      self.stages.append((self.stats_q, self._stats, workers))
+    if (do_thumbs):
+      self.stages.append((self.thumb_q, self._thumb, workers))
+
+    self.threads = []
+    for q, func, n in self.stages:
+      threads = []
+      for i in range(n):
+        t = threading.Thread(target=self._work, args=(q, func), daemon=True)
+        t.start()
+        threads.append(t)
+      self.threads.append((q, threads))
+    self.writer = threading.Thread(target=self._write, daemon=True)
+    self.writer.start()
+
+  def submit(self, infile, this_dir):
+    """ Queue one FITS file of the night directory this_dir.  Blocks
+        while MAX_INFLIGHT frames are already in the pipeline."""
+
+    self.inflight.acquire()
+    self.read_q.put(Frame(infile, this_dir))
+
+  def close(self):
+    """ Wait for every submitted file to be stored.
+
+        Return: counts of added, updated, duplicate and failed frames"""
+
+    # Stage by stage: the readers still feed the later queues.
+    for q, threads in self.threads:
+      q.put(_DONE)
+      for t in threads:
+        t.join()
+    self.db_q.put(_DONE)
+    self.writer.join()
+    if (self.lookup != None):
+      self.lookup.close()
+      self.lookup = None
+    return self.counts
+
+  def _work(self, q, func):
+    while True:
+      frame = q.get()
+      if (frame is _DONE):
+        # Let the other workers of this stage see it too.
+        q.put(_DONE)
+        break
+      try:
+        func(frame)
+      except Exception as err:
+        frame.error = err
+      if (q is not self.read_q):
+        self._finish(frame)
+
+  def _finish(self, frame):
+    with frame.lock:
+      frame.pending = frame.pending - 1
+      last = (frame.pending == 0)
+    if (last):
+      self.db_q.put(frame)
+
+  def _read(self, frame):
+    """ Read the whole file once and pass the frame to the checksum
+        stage."""
+
+    try:
+      with open(frame.infile, "rb") as fp:
+        frame.raw = fp.read()
+      hdul = fits.open(io.BytesIO(frame.raw))
+      header = hdul[0].header
+      frame.rec = ingest_fits.frame_record(frame.infile, frame.this_dir,
+                                           header, self.platescale)
+      info = hdul.fileinfo(0)
+      frame.span = (info["datLoc"], info["datLoc"] + info["datSpan"])
+      frame.satlevel = header.get("SATURATE", 65535)
+      if (self.do_stats or self.do_thumbs):
+        frame.data = hdul[0].data
+        frame.width = header["NAXIS1"]
+      hdul.close()
+    except Exception as err:
+      frame.error = err
+      frame.pending = 1
+      self.db_q.put(frame)
+      return
+
+    frame.pending = 1
+    self.sum_q.put(frame)
+
+  def _find_duplicate(self, frame):
+    """ An already stored original of the frame, from a read-only
+        connection of the checksum stage (None until the writer has
+        made the tables)."""
+
+    try:
+      if (self.lookup == None):
+        self.lookup = sqlite3.connect(
+          "file:{}?mode=ro".format(os.path.abspath(self.db_path)), uri=True,
+          check_same_thread=False)
+      return ingest_fits.find_duplicate(self.lookup.cursor(), frame.datasum,
+                                        frame.rec["path"])
+    except sqlite3.OperationalError:
+      return None
+
+  def _checksum(self, frame):
+    """ Checksum the data unit, then fan the frame out to the stats
+        and thumbnail stages, unless it is a copy of a stored frame
+        (copies are linked to the original, like ingest_file does)."""
+
+    start, end = frame.span
+    frame.datasum = ingest_fits.buffer_checksum(
+      memoryview(frame.raw)[start:end])
+    frame.original = self._find_duplicate(frame)
+    if (frame.original != None):
+      frame.data = None
+      return
+
+    targets = []
+    if (self.do_stats):
+      targets.append(self.stats_q)
+    if (self.do_thumbs):
+      targets.append(self.thumb_q)
+    with frame.lock:
+      frame.pending = frame.pending + len(targets)
+    for q in targets:
+      q.put(frame)
+
+  def _stats(self, frame):
+    frame.stats = ingest_fits.compute_frame_stats(frame.data,
+                                                  satlevel=frame.satlevel)
+
+  def _thumb(self, frame):
+    thumb = os.path.splitext(frame.infile)[0] + ".png"
+    frame.thumb_new = not os.path.exists(thumb)
+    fitsToThumb.make_thumb(frame.data, frame.width, thumb)
+    frame.thumb = thumb
+
+  def _write(self):
+    """ The only thread touching the database."""
+
+    conn = sqlite3.connect(self.db_path)
+    cursor = conn.cursor()
+    ingest_fits.create_images_table(conn)
+    ingest_fits.create_headers_table(conn)
+    cone_search.create_pointing_tables(conn)
+    if (self.do_stats):
+      ingest_fits.create_frame_stats_table(conn)
+
+    while True:
+      frame = self.db_q.get()
+      if (frame is _DONE):
+        break
+      try:
+        if (frame.error != None):
+          raise frame.error
+        # Again here: the original may have been stored by this run
+        # after the checksum stage looked.
+        original = ingest_fits.find_duplicate(cursor, frame.datasum,
+                                              frame.rec["path"])
+        if (original == None):
+          original = frame.original
+        added = ingest_fits.store_frame(conn, cursor, frame.rec,
+                                        frame.datasum, original, frame.stats)
+        if (original != None):
+          # Copies share the original's thumbnail.
+          if ((frame.thumb != None) and os.path.exists(frame.thumb)):
+            os.remove(frame.thumb)
+          self.counts["duplicates"] = self.counts["duplicates"] + 1
+        key = "added" if added else "updated"
+        self.counts[key] = self.counts[key] + 1
+        if (self.echo):
+          print(frame.rec["path"] + ("" if (original == None) else
+                                     " (copy of {})".format(original[0])))
+      except Exception as err:
+        conn.rollback()
+        # Don't leave a thumbnail behind for a frame that isn't stored.
+        if (frame.thumb_new and os.path.exists(frame.thumb)):
+          os.remove(frame.thumb)
+        self.counts["failed"] = self.counts["failed"] + 1
+        print("{}: FAILED {}".format(frame.infile, err))
+      finally:
+        # Drop the buffers before the next frame is admitted.
+        frame.raw = None
+        frame.data = None
+        self.inflight.release()
+
+    conn.close()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="""
+  Ingest night directories in one pass per file: header, checksum,
+  optional statistics and the thumbnail, from a single read.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("directories", nargs="+",
+    help="night directories under ../../data, e.g. UT20210227")
+  parser.add_argument("--stats", default=False, action="store_true",
+    help="also compute per-frame statistics into the frame_stats table")
+  parser.add_argument("--nothumbs", default=False, action="store_true",
+    help="don't write the PNG thumbnails")
+  parser.add_argument("-j", default=2, type=int,
+    help="threads per stage")
+  parser.add_argument("--platescale", default=cone_search.DEFAULT_PLATE_SCALE,
+    type=float, help="arcsec per unbinned pixel when the header has none")
+  parser.add_argument("-db", default=None,
+    help="database file (default ../../db/PW17QSI.db from this script)")
+
+  args = parser.parse_args()
+
+  db_path = args.db
+  if (db_path == None):
+    db_path = this_path + "/../../db/PW17QSI.db"
+
+  start = time.time()
+  pipe = Pipeline(db_path, do_stats=args.stats, do_thumbs=not args.nothumbs,
+                  workers=args.j, platescale=args.platescale)
+  for directory in args.directories:
+    this_dir = this_path + "/../../data/" + directory
+    for infile in sorted(glob.glob(this_dir + "/*.fit")):
+      pipe.submit(infile, this_dir)
+  counts = pipe.close()
+  print("{added} added, {updated} updated, {duplicates} copies, "
+        "{failed} failed".format(**counts) +
+        " in {:.1f} s".format(time.time() - start))
@@ -0,0 +1,254 @@
+
+import sqlite3
+import argparse
+import csv
+import json
+import os, sys
+
+# Usage: query_frames.py [-night UT20210529] [-imagetyp 'Bias Frame']
+#          [-filter Red] [-binning 2] [-object M1]
+#          [-format csv|jsonl|parquet|list] [-out file]
+#
+# e.g. a file list for the calibration/stacking tools:
+#   query_frames.py -night UT20210529 -imagetyp 'Bias Frame' -format list
+
+DEFAULT_COLUMNS = ["name", "path", "dateobs", "exptime", "filter",
+                   "imagetyp", "xbinning", "ybinning", "object"]
+
+def night_to_date(night):
+  """ 'UT20210529', '20210529' or '2021-05-29' -> '2021-05-29'."""
+
+  text = night.upper().replace("UT", "")
+  if ((len(text) == 8) and text.isdigit()):
+    return text[0:4] + "-" + text[4:6] + "-" + text[6:]
+  return text
+
+
+def has_column(conn, column, table="images"):
+  """ True if the table has the column.  Databases ingested before a
+      column was added (ingest_fits.migrate_images_table()) lack it
+      until the next ingest, and readers may not migrate them."""
+
+  return column in [row[1] for row in
+                    conn.execute("pragma table_info(" + table + ")")]
+
+
+def build_query(columns, night=None, imagetyp=None, filt=None,
+                binning=None, objectX=None, duplicates=False,
+                order="dateobs"):
+  """ Build the select statement and its parameters for the filters.
+      String filters match exactly; object also accepts SQL LIKE
+      patterns (e.g. 'M%').  Copies of an already ingested frame
+      (duplicate_of set) are left out unless duplicates=True (which
+      a database without the duplicate_of column needs).
+
+      Return: (sql, params)"""
+
+  where = []
+  params = []
+  if (not duplicates):
+    where.append("duplicate_of is null")
+  if (night != None):
+    where.append("dateobs >= date(?) and dateobs < date(?, '+1 day')")
+    date = night_to_date(night)
+    params.extend([date, date])
+  if (imagetyp != None):
+    where.append("imagetyp = ?")
+    params.append(imagetyp)
+  if (filt != None):
+    where.append("filter = ?")
+    params.append(filt)
+  if (binning != None):
+    where.append("xbinning = ? and ybinning = ?")
+    params.extend([binning, binning])
+  if (objectX != None):
+    where.append("object like ?")
+    params.append(objectX)
+
+  sql = "select " + ", ".join(columns) + " from images"
+  if (len(where) > 0):
+    sql = sql + " where " + " and ".join(where)
+  if (order != None):
+    sql = sql + " order by " + order
+
+  return (sql, params)
+
+
+def iter_frames(conn, columns=DEFAULT_COLUMNS, batch=1000, **filters):
+  """ Stream matching images rows from a cursor, batch rows at a time.
+
+      Argument: connection, list of columns, filters for build_query()
+      Return: generator of row tuples"""
+
+  # No copies are marked before the duplicate_of column exists.
+  if (not has_column(conn, "duplicate_of")):
+    filters["duplicates"] = True
+  sql, params = build_query(columns, **filters)
+  cur = conn.cursor()
+  cur.arraysize = batch
+  cur.execute(sql, params)
+  while True:
+    rows = cur.fetchmany()
+    if (len(rows) == 0):
+      break
+    for row in rows:
+      yield row
+  cur.close()
+
+
+def column_types(conn, columns):
+  """ Declared images column types, for typed (parquet) output."""
+
+  declared = {}
+  for row in conn.execute("pragma table_info(images)"):
+    declared[row[1]] = row[2].lower()
+  return [declared.get(c, "text") for c in columns]
+
+
+def write_csv(rows, columns, fp):
+  writer = csv.writer(fp)
+  writer.writerow(columns)
+  for row in rows:
+    writer.writerow(row)
+
+
+def write_jsonl(rows, columns, fp):
+  for row in rows:
+    fp.write(json.dumps(dict(zip(columns, row))) + "\n")
+
+
+def write_list(rows, columns, fp, data_root):
+  """ One FITS path per line, as used by cal_tools and the stacking
+      scripts.  Needs the path column."""
+
+  ipath = columns.index("path")
+  for row in rows:
+    fp.write(os.path.join(data_root, row[ipath]) + "\n")
+
+
+def write_parquet(rows, columns, types, outfile, batch=10000):
+  """ Write a parquet file batch by batch, so memory stays bounded.
+      Non-numeric placeholders (e.g. 'NONE') in int/real columns
+      become nulls."""
+
+  try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+  except ImportError:
+    print("parquet output needs pyarrow (pip install pyarrow)")
+    sys.exit(2)
+
+  pa_types = []
+  for t in types:
+    if (t.startswith("int")):
+      pa_types.append(pa.int64())
+    elif (t.startswith("real")):
+      pa_types.append(pa.float64())
+    else:
+      pa_types.append(pa.string())
+  schema = pa.schema([pa.field(c, t) for c, t in zip(columns, pa_types)])
+
+  def clean(value, t):
+    if (value == None):
+      return None
+    if (t == pa.string()):
+      return str(value)
+    if (isinstance(value, (int, float))):
+      return int(value) if (t == pa.int64()) else float(value)
+    return None
+
+  def flush(writer, cols):
+    writer.write_table(pa.Table.from_arrays(
+      [pa.array(c, type=t) for c, t in zip(cols, pa_types)], schema=schema))
+
+  writer = pq.ParquetWriter(outfile, schema)
+  cols = [[] for c in columns]
+  n = 0
+  for row in rows:
+    for i, value in enumerate(row):
+      cols[i].append(clean(value, pa_types[i]))
+    n = n + 1
+    if (n == batch):
+      flush(writer, cols)
+      cols = [[] for c in columns]
+      n = 0
+  if (n > 0):
+    flush(writer, cols)
+  writer.close()
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="""
+  Query the images table and stream the matching rows out as CSV,
+  JSON lines, parquet, or a plain list of FITS files.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("-night", default=None,
+    help="UT night, e.g. UT20210529 or 2021-05-29")
+  parser.add_argument("-imagetyp", default=None,
+    help="frame type, e.g. 'Light Frame', 'Bias Frame'")
+  parser.add_argument("-filter", default=None, help="filter name")
+  parser.add_argument("-binning", default=None, type=int,
+    help="binning (same in x and y)")
+  parser.add_argument("-object", default=None,
+    help="object name, SQL LIKE patterns allowed")
+  parser.add_argument("-duplicates", default=False, action="store_true",
+    help="include copies of frames that were already ingested")
+  parser.add_argument("-columns", default=",".join(DEFAULT_COLUMNS),
+    help="comma separated images columns to output")
+  parser.add_argument("-format", default="csv",
+    choices=["csv", "jsonl", "parquet", "list"], help="output format")
+  parser.add_argument("-out", default=None,
+    help="output file (default stdout; required for parquet)")
+  parser.add_argument("-db", default=None,
+    help="database file (default ../../db/PW17QSI.db from this script)")
+
+  args = parser.parse_args()
+
+  # Get the path to the database.
+  this_path, this_file = os.path.split(os.path.abspath(__file__))
+  db_path = args.db
+  if (db_path == None):
+    db_path = this_path + "/../../db/PW17QSI.db"
+  data_root = this_path + "/../../data"
+
+  columns = args.columns.replace(" ", "").split(",")
+  if ((args.format == "list") and ("path" not in columns)):
+    columns.append("path")
+
+  conn = sqlite3.connect("file:{}?mode=ro".format(db_path), uri=True)
+
+  # Reject unknown column names before they reach the SQL.
+  known = [row[1] for row in conn.execute("pragma table_info(images)")]
+  for c in columns:
+    if (c not in known):
+      print("unknown column {}; choose from {}".format(c, ", ".join(known)))
+      sys.exit(2)
+
+  rows = iter_frames(conn, columns, night=args.night,
+    imagetyp=args.imagetyp, filt=args.filter, binning=args.binning,
+    objectX=args.object, duplicates=args.duplicates)
+
+  if (args.format == "parquet"):
+    if (args.out == None):
+      print("parquet output needs -out")
+      sys.exit(2)
+    write_parquet(rows, columns, column_types(conn, columns), args.out)
+
+  else:
+    if (args.out == None):
+      fp = sys.stdout
+    else:
+      fp = open(args.out, "w", newline="")
+
+    if (args.format == "csv"):
+      write_csv(rows, columns, fp)
+    elif (args.format == "jsonl"):
+      write_jsonl(rows, columns, fp)
+    elif (args.format == "list"):
+      write_list(rows, columns, fp, data_root)
+
+    if (fp != sys.stdout):
+      fp.close()
+
+  conn.close()
@@ -0,0 +1,636 @@
+
+import argparse
+import hashlib
+import json
+import os, sys
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Usage: drive_sync.py UT20210227 [UT20210301 ...]
+#        drive_sync.py list
+#        drive_sync.py -fake /path/to/tree UT20210227    (local fake Drive)
+#        drive_sync.py -sync                  (every night, incrementally)
+#
+# Downloads the FITS files of the night folders under the Drive folder
+# 'QSI testing ASB' into ../../data/<night>/.  Files are listed 1000 to
+# a page and fetched by a pool of worker threads, each streaming straight
+# into <file>.part and renaming it into place once the md5 matches, so
+# an interrupted run resumes where it stopped.  Files whose local size
+# and md5 already match Drive's md5Checksum are skipped.
+#
+# All Drive access goes through a transport object (GoogleTransport, or
+# LocalTransport for a directory tree standing in for Drive).
+#
+# -sync keeps a state file in the data directory with a Drive changes
+# page token and a manifest of the files downloaded.  The first run scans
+# every night folder; later runs ask Drive only for what changed since
+# the token, so a run with nothing new costs one or two API calls.
+
+SCOPES = ['https://www.googleapis.com/auth/drive']
+
+ROOT_FOLDER = "QSI testing ASB"
+FOLDER_MIME = "application/vnd.google-apps.folder"
+FILE_FIELDS = "id, name, size, md5Checksum, mimeType, modifiedTime, parents"
+
+STATE_FILE = ".drive_sync.json"
+
+CHUNK = 4 * 1024 * 1024
+PAGE_SIZE = 1000
+RETRIES = 3
+
+
+class GoogleTransport(object):
+  """ Drive v3 API.  Listing goes through googleapiclient (main thread
+      only); media is streamed with an AuthorizedSession per worker
+      thread, using a Range header to resume."""
+
+  def __init__(self, creds):
+    from googleapiclient.discovery import build
+    self.creds = creds
+    self.service = build("drive", "v3", credentials=creds)
+    self.local = threading.local()
+
+  def find_folders(self, name, parent=None):
+    q = "mimeType = '{}' and name = '{}' and trashed = false".format(
+      FOLDER_MIME, name.replace("'", "\\'"))
+    if (parent != None):
+      q = q + " and '{}' in parents".format(parent)
+    result = self.service.files().list(q=q, pageSize=PAGE_SIZE,
+      fields="files(id, name)").execute()
+    return [f["id"] for f in result.get("files", [])]
+
+  def list_page(self, parent, folders=False, name_contains=None,
+                page_token=None, page_size=PAGE_SIZE):
+    """ Return: (list of file dicts, next page token or None)"""
+
+    q = "'{}' in parents and trashed = false".format(parent)
+    if (folders):
+      q = q + " and mimeType = '{}'".format(FOLDER_MIME)
+    else:
+      q = q + " and mimeType != '{}'".format(FOLDER_MIME)
+    if (name_contains != None):
+      q = q + " and name contains '{}'".format(name_contains)
+    params = {"q": q, "pageSize": page_size,
+              "fields": "nextPageToken, files({})".format(FILE_FIELDS)}
+    if (page_token != None):
+      params["pageToken"] = page_token
+    result = self.service.files().list(**params).execute()
+    return result.get("files", []), result.get("nextPageToken")
+
+  def start_page_token(self):
+    return self.service.changes().getStartPageToken().execute()[
+      "startPageToken"]
+
+  def list_changes(self, page_token, page_size=PAGE_SIZE):
+    """ One page of changes since page_token.
+
+        Return: (list of (file id, file dict or None if removed),
+                 next page token, new start page token)"""
+
+    result = self.service.changes().list(pageToken=page_token,
+      pageSize=page_size, spaces="drive", includeRemoved=True,
+      fields="nextPageToken, newStartPageToken, "
+             "changes(fileId, removed, file({}, trashed))".format(
+               FILE_FIELDS)).execute()
+    changes = []
+    for c in result.get("changes", []):
+      f = c.get("file")
+      if (c.get("removed") or (f == None) or f.get("trashed")):
+        f = None
+      changes.append((c["fileId"], f))
+    return (changes, result.get("nextPageToken"),
+            result.get("newStartPageToken"))
+
+  def get_media(self, file_id, offset=0, chunk=CHUNK):
+    """ Stream the file content from byte offset on."""
+
+    from google.auth.transport.requests import AuthorizedSession
+    session = getattr(self.local, "session", None)
+    if (session == None):
+      session = self.local.session = AuthorizedSession(self.creds)
+    headers = {}
+    if (offset > 0):
+      headers["Range"] = "bytes={}-".format(offset)
+    url = "https://www.googleapis.com/drive/v3/files/{}?alt=media".format(
+      file_id)
+    with session.get(url, headers=headers, stream=True, timeout=60) as resp:
+      resp.raise_for_status()
+      if ((offset > 0) and (resp.status_code != 206)):
+        raise IOError("server ignored the range request")
+      for buf in resp.iter_content(chunk):
+        yield buf
+
+
+class LocalTransport(object):
+  """ A directory tree standing in for Drive, for testing: folder and
+      file ids are paths relative to the root, and md5Checksum is
+      computed from the files.  Listing pages are small on purpose, so
+      the paging code gets exercised."""
+
+  def __init__(self, root, page_size=50):
+    self.root = os.path.abspath(root)
+    self.page_size = page_size
+
+  def _path(self, file_id):
+    return os.path.join(self.root, file_id) if file_id else self.root
+
+  def find_folders(self, name, parent=None):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(self._path(parent)):
+      for d in dirnames:
+        if (d == name):
+          found.append(os.path.relpath(os.path.join(dirpath, d), self.root))
+    return found
+
+  def describe(self, file_id):
+    path = self._path(file_id)
+    st = os.stat(path)
+    item = {"id": file_id, "name": os.path.basename(path),
+            "modifiedTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z",
+                                          time.gmtime(st.st_mtime)),
+            "parents": [os.path.dirname(file_id)]}
+    if (os.path.isdir(path)):
+      item["mimeType"] = FOLDER_MIME
+    else:
+      item["mimeType"] = "application/octet-stream"
+      item["size"] = str(st.st_size)
+      item["md5Checksum"] = file_md5(path)
+    return item
+
+  def list_page(self, parent, folders=False, name_contains=None,
+                page_token=None, page_size=PAGE_SIZE):
+    names = sorted(os.listdir(self._path(parent)))
+    ids = []
+    for n in names:
+      fid = os.path.join(parent, n) if parent else n
+      if (os.path.isdir(self._path(fid)) != folders):
+        continue
+      if ((name_contains != None) and (name_contains not in n)):
+        continue
+      ids.append(fid)
+    start = int(page_token or 0)
+    end = start + min(page_size, self.page_size)
+    nxt = str(end) if (end < len(ids)) else None
+    return [self.describe(fid) for fid in ids[start:end]], nxt
+
+  def start_page_token(self):
+    return str(time.time_ns())
+
+  def list_changes(self, page_token, page_size=PAGE_SIZE):
+    """ Files and folders modified since the token (a time stamp).
+        Deletions are not reported."""
+
+    since = int(page_token)
+    new_token = str(time.time_ns())
+    changes = []
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      for n in dirnames + filenames:
+        path = os.path.join(dirpath, n)
+        if (os.stat(path).st_mtime_ns > since):
+          fid = os.path.relpath(path, self.root)
+          changes.append((fid, self.describe(fid)))
+    return changes, None, new_token
+
+  def get_media(self, file_id, offset=0, chunk=CHUNK):
+    with open(self._path(file_id), "rb") as fp:
+      fp.seek(offset)
+      while True:
+        buf = fp.read(chunk)
+        if (not buf):
+          break
+        yield buf
+
+
+def file_md5(path, chunk=CHUNK):
+  h = hashlib.md5()
+  with open(path, "rb") as fp:
+    while True:
+      buf = fp.read(chunk)
+      if (not buf):
+        break
+      h.update(buf)
+  return h.hexdigest()
+
+
+def list_all(transport, parent, folders=False, name_contains=None):
+  """ Every page of a folder listing.
+
+      Return: list of file dicts"""
+
+  items = []
+  token = None
+  while True:
+    page, token = transport.list_page(parent, folders=folders,
+      name_contains=name_contains, page_token=token)
+    items.extend(page)
+    if (token == None):
+      break
+  return items
+
+
+def is_current(path, item):
+  """ True if path already holds the Drive file (same size and md5)."""
+
+  if (not os.path.exists(path)):
+    return False
+  if (("size" in item) and (os.path.getsize(path) != int(item["size"]))):
+    return False
+  md5 = item.get("md5Checksum")
+  return ((md5 == None) or (file_md5(path) == md5))
+
+
+def download_file(transport, item, dest, chunk=CHUNK, retries=RETRIES):
+  """ Stream one Drive file to dest via dest.part, resuming from an
+      existing .part file and verifying the md5 before the rename.
+
+      Return: bytes transferred"""
+
+  part = dest + ".part"
+  size = int(item.get("size", -1))
+  md5 = item.get("md5Checksum")
+
+  for attempt in range(retries):
+    # Hash what is already there, then append the rest.
+    h = hashlib.md5()
+    offset = 0
+    if (os.path.exists(part)):
+      if ((size >= 0) and (os.path.getsize(part) > size)):
+        os.remove(part)
+      else:
+        with open(part, "rb") as fp:
+          while True:
+            buf = fp.read(chunk)
+            if (not buf):
+              break
+            h.update(buf)
+            offset = offset + len(buf)
+
+    sent = 0
+    try:
+      if ((size < 0) or (offset < size)):
+        with open(part, "ab") as out:
+          for buf in transport.get_media(item["id"], offset, chunk):
+            out.write(buf)
+            h.update(buf)
+            sent = sent + len(buf)
+    except Exception as err:
+      if (attempt == retries - 1):
+        raise
+      print("{}: {}; resuming".format(item["name"], err))
+      time.sleep(2 ** attempt)
+      continue
+
+    if ((md5 != None) and (h.hexdigest() != md5)):
+      # Corrupt or changed under us: start over.
+      os.remove(part)
+      if (attempt == retries - 1):
+        raise IOError("md5 mismatch for " + item["name"])
+      continue
+
+    os.replace(part, dest)
+    return sent
+
+  return 0
+
+
+def download_items(transport, jobs, workers=8, echo=True, on_done=None):
+  """ Download (item, destination) pairs through a pool of workers.
+      on_done(item, destination), if given, is called for each file as
+      soon as it is in place.
+
+      Return: (list of the jobs that completed, files failed, bytes)"""
+
+  completed = []
+  failed = 0
+  nbytes = 0
+  with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+    futures = dict((pool.submit(download_file, transport, item, dest),
+                    (item, dest)) for item, dest in jobs)
+    for fut in as_completed(futures):
+      item, dest = futures[fut]
+      try:
+        nbytes = nbytes + fut.result()
+        completed.append((item, dest))
+        if (echo):
+          print(item["name"])
+      except Exception as err:
+        failed = failed + 1
+        print("{}: FAILED {}".format(item["name"], err))
+        continue
+      if (on_done != None):
+        on_done(item, dest)
+
+  return completed, failed, nbytes
+
+
+def sync_folder(transport, folder_id, dest_dir, workers=8,
+                name_contains="fit", echo=True, on_done=None):
+  """ Bring dest_dir up to date with the files of one Drive folder.
+
+      Return: (files downloaded, files skipped, files failed, bytes)"""
+
+  os.makedirs(dest_dir, exist_ok=True)
+  items = list_all(transport, folder_id, name_contains=name_contains)
+
+  jobs = []
+  skipped = 0
+  for item in items:
+    dest = os.path.join(dest_dir, item["name"])
+    if (is_current(dest, item)):
+      skipped = skipped + 1
+    else:
+      jobs.append((item, dest))
+
+  completed, failed, nbytes = download_items(transport, jobs, workers, echo,
+                                             on_done)
+  return len(completed), skipped, failed, nbytes
+
+
+#------------------------------------------------------------------------
+# Incremental sync of every night folder (-sync)
+
+def load_state(state_file):
+  """ The saved sync state, or an empty one.
+
+      Return: {"root": id, "token": page token,
+               "folders": {folder id: night},
+               "files": {file id: manifest entry}}"""
+
+  if (os.path.exists(state_file)):
+    with open(state_file) as fp:
+      return json.load(fp)
+  return {"root": None, "token": None, "folders": {}, "files": {}}
+
+
+def save_state(state, state_file):
+  tmp = state_file + ".tmp"
+  with open(tmp, "w") as fp:
+    json.dump(state, fp, indent=1)
+  os.replace(tmp, state_file)
+
+
+def manifest_entry(item, night, dest):
+  st = os.stat(dest)
+  return {"name": item["name"], "night": night, "size": st.st_size,
+          "md5": item.get("md5Checksum"),
+          "modifiedTime": item.get("modifiedTime"),
+          "mtime_ns": st.st_mtime_ns}
+
+
+def in_manifest(entry, item, dest):
+  """ True if the manifest says dest already holds this version of
+      the Drive file, and the local file is untouched since (no
+      re-hash needed)."""
+
+  if ((entry == None) or (entry.get("md5") != item.get("md5Checksum"))):
+    return False
+  try:
+    st = os.stat(dest)
+  except OSError:
+    return False
+  return ((st.st_size == entry["size"]) and
+          (st.st_mtime_ns == entry["mtime_ns"]))
+
+
+def wanted(item, name_contains):
+  return ((item.get("mimeType") != FOLDER_MIME) and
+          ((name_contains == None) or (name_contains in item["name"])))
+
+
+def sync_all(transport, root_name, dest, state_file, workers=8,
+             name_contains="fit", echo=True, on_done=None):
+  """ One incremental pass over every night folder under root_name.
+
+      Return: (files downloaded, files failed, bytes)"""
+
+  state = load_state(state_file)
+  candidates = []   # (item, night) that may need downloading
+
+  if (state["token"] == None):
+    # Full scan.  Take the token first so nothing that changes during
+    # the scan is missed next time.
+    token = transport.start_page_token()
+    roots = transport.find_folders(root_name)
+    if (len(roots) == 0):
+      raise IOError("Drive folder '{}' not found".format(root_name))
+    state["root"] = roots[0]
+    state["folders"] = {}
+    for folder in list_all(transport, state["root"], folders=True):
+      state["folders"][folder["id"]] = folder["name"]
+      for item in list_all(transport, folder["id"],
+                           name_contains=name_contains):
+        candidates.append((item, folder["name"]))
+
+  else:
+    token = state["token"]
+    # Drive lists only each item's latest change, so a file can come
+    # before the change record of its (new or renamed) night folder.
+    # Apply every folder change first, then place the files.
+    changed = []
+    new_folders = []
+    while True:
+      changes, next_token, new_start = transport.list_changes(token)
+      for file_id, item in changes:
+        if (item == None):
+          # Deleted on Drive: forget it, but keep the local copy.
+          state["folders"].pop(file_id, None)
+          state["files"].pop(file_id, None)
+          continue
+        if (item.get("mimeType") == FOLDER_MIME):
+          if (state["root"] in item.get("parents", [])):
+            if (file_id not in state["folders"]):
+              new_folders.append(file_id)
+            state["folders"][file_id] = item["name"]
+          else:
+            # Moved out from under the root folder.
+            state["folders"].pop(file_id, None)
+          continue
+        if (wanted(item, name_contains)):
+          changed.append(item)
+      if (next_token != None):
+        token = next_token
+      else:
+        token = new_start
+        break
+
+    for item in changed:
+      for parent in item.get("parents", []):
+        if (parent in state["folders"]):
+          candidates.append((item, state["folders"][parent]))
+          break
+
+    # A folder moved in under the root brings files that have no
+    # change records of their own.
+    for folder_id in new_folders:
+      if (folder_id in state["folders"]):
+        for item in list_all(transport, folder_id,
+                             name_contains=name_contains):
+          candidates.append((item, state["folders"][folder_id]))
+
+  # Files that failed last time are retried.
+  for file_id, pending in state.get("pending", {}).items():
+    candidates.append((pending["item"], pending["night"]))
+
+  jobs = []
+  nights = {}
+  for item, night in candidates:
+    target = os.path.join(dest, night, item["name"])
+    if (in_manifest(state["files"].get(item["id"]), item, target)):
+      continue
+    if (is_current(target, item)):
+      state["files"][item["id"]] = manifest_entry(item, night, target)
+      continue
+    if (item["id"] in nights):
+      continue
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    jobs.append((item, target))
+    nights[item["id"]] = night
+
+  completed, failed, nbytes = download_items(transport, jobs, workers, echo,
+                                             on_done)
+
+  state["pending"] = {}
+  ok = set()
+  for item, dest in completed:
+    state["files"][item["id"]] = manifest_entry(item, nights[item["id"]], dest)
+    ok.add(item["id"])
+  for item, dest in jobs:
+    if (item["id"] not in ok):
+      state["pending"][item["id"]] = {"item": item,
+                                      "night": nights[item["id"]]}
+
+  state["token"] = token
+  save_state(state, state_file)
+  return len(completed), failed, nbytes
+
+
+def get_credentials(creds_file, token_file):
+  """ OAuth credentials, cached in token_file (as before)."""
+
+  from google_auth_oauthlib.flow import InstalledAppFlow
+  from google.auth.transport.requests import Request
+
+  creds = None
+  if os.path.exists(token_file):
+    with open(token_file, "rb") as token:
+      creds = pickle.load(token)
+  if not creds or not creds.valid:
+    if creds and creds.expired and creds.refresh_token:
+      creds.refresh(Request())
+    else:
+      flow = InstalledAppFlow.from_client_secrets_file(creds_file, SCOPES)
+      creds = flow.run_local_server(port=0)
+    with open(token_file, "wb") as token:
+      pickle.dump(creds, token)
+  return creds
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="""
+  Download night folders from Google Drive into the data directory,
+  concurrently and resumably, skipping files already up to date.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("nights", nargs="*",
+    help="night folder names, or 'list' to list them")
+  parser.add_argument("-sync", default=False, action="store_true",
+    help="incrementally sync every night folder (uses a change token)")
+  parser.add_argument("-state", default=None,
+    help="sync state file (default <dest>/" + STATE_FILE + ")")
+  parser.add_argument("-dest", default=None,
+    help="data directory (default ../../data from this script)")
+  parser.add_argument("-root", default=ROOT_FOLDER,
+    help="Drive folder holding the night folders")
+  parser.add_argument("-j", default=8, type=int,
+    help="concurrent downloads")
+  parser.add_argument("-creds",
+    default="/home/webrat/python/astrophotography/astro-google-creds.json",
+    help="OAuth client secrets file")
+  parser.add_argument("-token", default="token.pickle",
+    help="cached OAuth token")
+  parser.add_argument("-fake", default=None,
+    help="use this directory tree as a fake Drive (testing)")
+  parser.add_argument("-ingest", default=False, action="store_true",
+    help="ingest and thumbnail each file as soon as it is downloaded")
+  parser.add_argument("--stats", default=False, action="store_true",
+    help="with -ingest, also compute frame statistics")
+  parser.add_argument("-db", default=None,
+    help="database for -ingest (default ../../db/PW17QSI.db)")
+
+  args = parser.parse_args()
+
+  this_path, this_file = os.path.split(os.path.abspath(__file__))
+  dest = args.dest
+  if (dest == None):
+    dest = this_path + "/../../data"
+
+  if (args.fake != None):
+    transport = LocalTransport(args.fake)
+  else:
+    transport = GoogleTransport(get_credentials(args.creds, args.token))
+
+  # Downloaded files go straight into the ingest pipeline.
+  pipe = None
+  on_done = None
+  if (args.ingest):
+    sys.path.append(this_path + "/../db")
+    import ingest_pipeline
+    db_path = args.db
+    if (db_path == None):
+      db_path = this_path + "/../../db/PW17QSI.db"
+    pipe = ingest_pipeline.Pipeline(db_path, do_stats=args.stats,
+                                    echo=False)
+    on_done = lambda item, path: pipe.submit(path, os.path.dirname(path))
+
+  def finish(status):
+    if (pipe != None):
+      print("ingest: {added} added, {updated} updated, {duplicates} copies, "
+            "{failed} failed".format(**pipe.close()))
+    sys.exit(status)
+
+  if (args.sync):
+    state_file = args.state
+    if (state_file == None):
+      state_file = os.path.join(dest, STATE_FILE)
+    start = time.time()
+    done, failed, nbytes = sync_all(transport, args.root, dest, state_file,
+                                    workers=args.j, echo=True,
+                                    on_done=on_done)
+    print("sync: {} downloaded, {} failed, {:.1f} MB in {:.1f} s".format(
+      done, failed, nbytes / 1e6, time.time() - start))
+    finish(1 if (failed > 0) else 0)
+
+  if (len(args.nights) == 0):
+    parser.error("give night folder names, 'list' or -sync")
+
+  roots = transport.find_folders(args.root)
+  if (len(roots) == 0):
+    print("Drive folder '{}' not found!".format(args.root))
+    sys.exit(2)
+  nights = dict((f["name"], f["id"])
+                for f in list_all(transport, roots[0], folders=True))
+
+  if (args.nights == ["list"]):
+    for name in sorted(nights):
+      print(name)
+    sys.exit(0)
+
+  status = 0
+  for night in args.nights:
+    if (night not in nights):
+      print(night + ": directory not found!")
+      status = 2
+      continue
+    start = time.time()
+    done, skipped, failed, nbytes = sync_folder(transport, nights[night],
+      os.path.join(dest, night), workers=args.j, echo=True, on_done=on_done)
+    elapsed = max(time.time() - start, 1e-6)
+    print("{}: {} downloaded, {} up to date, {} failed, {:.1f} MB in "
+          "{:.1f} s ({:.1f} MB/s)".format(night, done, skipped, failed,
+          nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed))
+    if (failed > 0):
+      status = 1
+
+  finish(status)
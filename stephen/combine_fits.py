@@ -13,6 +13,8 @@ img_bitshift() - allows bit shifting image data
 combine_imgs() - simple image combination (mean, median etc)
 do_ixion_timo_10to1 () - specific image combination for Ixion 20201013 data
 
+2026 Oct 19 - cube_normalize() uses reduc_stat_utils (and median/sum
+              normalization works again)
 2021 Mar 09 - sel@ell - some clean up
 2021 Mar 02 - sel@ell - added min,max,minmax clipping
 2020 Dec 27 - sel@ell - shift to reduc_fits_util, and add c_main() driver
@@ -33,7 +35,7 @@ If given an image N-cube, can squash in the axis=0 dimension to return
 an (N-1)-dim cube (e.g. 2D from 3D).
 """
 __author__="S. Levine"
-__date__="2021 Mar 09"
+__date__="2026 Oct 19"
 
 #------------------------------------------------------------------------
 # import glob
@@ -49,6 +51,7 @@ import numpy as np
 # sel reduction utility routines
 import reduc_utils as ru
 import reduc_fits_utils as rf
+import reduc_stat_utils as rs
 
 #------------------------------------------------------------------------
 
@@ -76,13 +79,9 @@ def cube_normalize (cube2norm, normalize='none'):
     """
     normval = 1.0
 
-    if (normalize != 'none'):
-        if (normalize == 'mean'):
-            normval = np.mean (cube2norm)
-        elif (method_arg == 'median'):
-            normval = np.median (cube2norm)
-        elif (method_arg == 'sum'):
-            normval = np.sum (cube2norm)
+    # mean, median or sum - a histogram pass for integer data
+    if (normalize in ['mean', 'median', 'sum']):
+        normval = rs.array_stats (cube2norm, [normalize])[normalize]
 
     return normval
 
@@ -8,13 +8,19 @@ Simple FITS image load and display. Only meant for quick visuals and checks.
 __intro__= """\
 Simple FITS image load and display. Only meant for quick visuals and checks.
 Also displays the marginal sums for the displayed part of the image.
-Scaling is linear.
-Allows for zscale and minmax auto range set as well as explicit limits.
+Scaling is linear, or histogram equalized.
+Allows for zscale, rms, minmax, percentile and histeq auto range set
+as well as explicit limits. Auto ranges come from a sample of the
+pixels, computed once per file (cube).
+Cube animations are written to movies through an ffmpeg pipe,
+one plane at a time.
 Toggle for marginal sum plots.
+Files written to disk are rendered headless, optionally in parallel
+(-j), and with -f straight to PNG without plot axes.
 Allow plotting subregions.
 """
 __author__="S. Levine"
-__date__="2021 Jan 31"
+__date__="2026 Oct 19"
 
 #------------------------------------------------------------------------
 # import glob
@@ -23,16 +29,19 @@ __date__="2021 Jan 31"
 
 # Command line arg parsing
 import argparse
+import os
+import shutil
+import subprocess
 
 import matplotlib.pyplot    as plt
 import matplotlib.animation as animation
 
-# Use FFMpeg for generation of movie files
+# Use FFMpeg for generation of movie files: $FFMPEG, else the one
+# on the PATH.  Without it movies are written as PNG sequences.
 import matplotlib as mpl
-mpl.rcParams['animation.ffmpeg_path'] = r'/Users/sel/Software/Media/ffmpeg-4.3.1/ffmpeg'
-# mpl.rcParams['animation.ffmpeg_path'] = r'/usr/local/bin/ffmpeg'
-# can also use
-# plt.rcParams['animation.ffmpeg_path'] = r'/usr/local/bin/ffmpeg'
+FFMPEG = os.environ.get('FFMPEG') or shutil.which('ffmpeg')
+if (FFMPEG != None):
+    mpl.rcParams['animation.ffmpeg_path'] = FFMPEG
 
 import numpy as np
 
@@ -40,21 +49,162 @@ import reduc_utils as ru
 import reduc_fits_utils as rf
 
 #------------------------------------------------------------------------
-def compute_scaling_limits (dat, lims, lrms=1, disp_lims=[], echo=False):
+# zscale parameters, as in IRAF display
+ZSCALE_NSAMPLES = 5000    # pixels sampled from the image (or cube)
+ZSCALE_CONTRAST = 0.25
+ZSCALE_KREJ     = 2.5     # rejection threshold in sigma
+ZSCALE_MAXITER  = 5
+ZSCALE_MINFRAC  = 0.5     # stop if fewer than this fraction remain
+
+# Cube planes used for the sample, and number of histogram equalization
+# levels.
+SAMPLE_PLANES  = 16
+HISTEQ_NLEVELS = 256
+
+# Scaling computed per frame, keyed by the caller's cache_key
+_scaling_cache = {}
+SCALING_CACHE_SIZE = 64
+
+def sample_image (dat, nsamples=ZSCALE_NSAMPLES):
+    """\
+    Sample a 2-D image or 3-D cube on a regular grid.
+    Up to SAMPLE_PLANES evenly spaced planes of a cube are used, each
+    with an equal share of the nsamples pixels.
+    Returns a sorted 1-D array of the finite sampled values.
     """
-    Compute display scaling min and max.
-    dat == 2-D image to compute limits for
+    dat = np.asarray(dat)
+    if (dat.ndim == 3):
+        nz = dat.shape[0]
+        planes = np.unique(np.linspace(0, nz - 1,
+                                       min(nz, SAMPLE_PLANES)).astype(int))
+        nplane = max(1, nsamples // len(planes))
+        samp = np.concatenate([sample_image(dat[iz], nplane) for iz in planes])
+        return np.sort(samp)
+
+    dat = np.atleast_2d(dat)
+    stride = max(1, int(np.sqrt(dat.size / float(nsamples))))
+    samp = np.asarray(dat[::stride, ::stride], dtype=np.float64).ravel()
+    samp = samp[np.isfinite(samp)]
+    return np.sort(samp)
+
+def zscale_limits (samp, contrast=ZSCALE_CONTRAST, krej=ZSCALE_KREJ,
+                   maxiter=ZSCALE_MAXITER, minfrac=ZSCALE_MINFRAC):
+    """\
+    IRAF zscale on a sorted sample: fit a line to the sorted values
+    with iterative rejection, and set the range from the median +/-
+    the fitted slope / contrast over the sample, clipped to the
+    sample min and max.
+    """
+    npix = len(samp)
+    if (npix == 0):
+        return 0., 1.
+    zmin = samp[0]
+    zmax = samp[-1]
+    center = (npix - 1) // 2
+    if (npix % 2 == 1):
+        median = samp[center]
+    else:
+        median = 0.5 * (samp[center] + samp[center + 1])
+
+    minpix = max(5, int(npix * minfrac))
+    ngrow = max(1, int(npix * 0.01))
+    kernel = np.ones(ngrow)
+    xidx = np.arange(npix)
+    badpix = np.zeros(npix, dtype=bool)
+    ngood = npix
+    last_ngood = npix + 1
+    slope = 0.
+
+    for niter in range(maxiter):
+        if ((ngood >= last_ngood) or (ngood < minpix)):
+            break
+        slope, icept = np.polyfit(xidx, samp, 1,
+                                  w=(~badpix).astype(np.float64))
+        flat = samp - (icept + slope * xidx)
+        thresh = krej * np.std(flat[~badpix])
+        badpix = badpix | (np.abs(flat) > thresh)
+        # grow the rejected regions by ngrow pixels
+        badpix = np.convolve(badpix, kernel, mode='same') > 0
+        last_ngood = ngood
+        ngood = np.sum(~badpix)
+
+    if ((ngood >= minpix) and (contrast > 0)):
+        slope = slope / contrast
+        zmin = max(zmin, median - (center - 1) * slope)
+        zmax = min(zmax, median + (npix - center) * slope)
+
+    return zmin, zmax
+
+def histeq_levels (samp, nlevels=HISTEQ_NLEVELS):
+    """\
+    Data values at nlevels evenly spaced quantiles of the sorted sample,
+    for histogram equalization.
+    """
+    if (len(samp) == 0):
+        return np.linspace(0., 1., nlevels)
+    return np.quantile(samp, np.linspace(0., 1., nlevels))
+
+def histeq_stretch (dat, levels):
+    """\
+    Histogram equalize dat through the quantile levels, to 0-1.
+    """
+    return np.interp(dat, levels, np.linspace(0., 1., len(levels)))
+
+def plane_minmax (dat):
+    """\
+    Min and max of an image, or of a cube one plane at a time
+    (so a memory mapped cube is never loaded whole).
+    """
+    if (np.ndim(dat) == 3):
+        mins = [np.nanmin(dat[iz]) for iz in range(dat.shape[0])]
+        maxs = [np.nanmax(dat[iz]) for iz in range(dat.shape[0])]
+        return np.min(mins), np.max(maxs)
+    return np.nanmin(dat), np.nanmax(dat)
+
+def plane_moments (dat):
+    """\
+    Average and RMS of an image, or of a cube one plane at a time.
+    """
+    if (np.ndim(dat) != 3):
+        return np.nanmean(dat), np.nanstd(dat)
+    npix = 0
+    tot = 0.
+    for iz in range(dat.shape[0]):
+        pln = np.asarray(dat[iz], dtype=np.float64)
+        npix += np.count_nonzero(np.isfinite(pln))
+        tot += np.nansum(pln)
+    avg = tot / npix
+    sqr = 0.
+    for iz in range(dat.shape[0]):
+        pln = np.asarray(dat[iz], dtype=np.float64)
+        sqr += np.nansum((pln - avg)**2)
+    return avg, np.sqrt(sqr / npix)
+
+def compute_scaling (dat, lims, lrms=1, disp_lims=[], pct=[0.5, 99.5],
+                     cache_key=None, echo=False):
+    """
+    Compute display scaling for an image or a whole cube.
+    dat == 2-D image or 3-D cube to compute the scaling for
     lims == the type of scale range
+            zscale == IRAF zscale on a sample of the pixels
+            rms == average +/- lrms * rms
+            minmax == min to max data value
+            percentile == pct[0] to pct[1] percentiles of the sample
+            histeq == histogram equalization from the sample
     lrms == optional args to lims
     disp_lims == optional pre-specified limits. Overrides others
+    pct == [low, high] percentiles for lims == percentile
+    cache_key == if not None, reuse the scaling computed earlier
+                 for the same key (e.g. file name and bounds)
+    Returns: dict with min, max and, for histeq, the levels
     """
 
-    # Set display value limits for 2-D image
-    # Default to min, max
-    im_min = np.min(dat)
-    im_max = np.max(dat)
-    if (echo == True):
-        print ('Nominal img min,max = {}, {}'.format(im_min, im_max))
+    if (cache_key != None):
+        key = (cache_key, lims, lrms, tuple(disp_lims), tuple(pct))
+        if (key in _scaling_cache):
+            return _scaling_cache[key]
+
+    scl = {'min': None, 'max': None, 'levels': None}
 
     # and if desired reset scaling and limits
     if (disp_lims != []):
@@ -62,36 +212,70 @@ def compute_scaling_limits (dat, lims, lrms=1, disp_lims=[], echo=False):
             print ('Computing w/in limits {} {}'.format(disp_lims[0], 
                                                         disp_lims[1]))
         if (disp_lims[0] != disp_lims[1]):
-            im_min = np.min(disp_lims)
-            im_max = np.max(disp_lims)
+            scl['min'] = np.min(disp_lims)
+            scl['max'] = np.max(disp_lims)
         else:
-            im_min = np.min(dat)
-            im_max = np.max(dat)
+            scl['min'] = np.nanmin(dat)
+            scl['max'] = np.nanmax(dat)
 
-    elif (lims == 'zscale'):
-        # Set default image min,max = avg +/- 1 RMS
-        im_average = np.average(dat)
-        im_rms = np.std(dat)
+    elif (lims == 'rms'):
+        # Set image min,max = avg +/- lrms RMS
+        im_average, im_rms = plane_moments(dat)
 
         if (echo == True):
-            print ('Computing zscale, Nrms = {}, RMS = {}'.format(lrms, 
-                                                                  im_rms))
-
-        im_min = im_average - lrms * im_rms
-        im_max = im_average + lrms * im_rms
+            print ('Computing rms, Nrms = {}, RMS = {}'.format(lrms, 
+                                                               im_rms))
+
+        scl['min'] = im_average - lrms * im_rms
+        scl['max'] = im_average + lrms * im_rms
+
+    elif (lims in ['zscale', 'percentile', 'histeq']):
+        samp = sample_image(dat)
+        if (lims == 'zscale'):
+            scl['min'], scl['max'] = zscale_limits(samp)
+        elif (lims == 'percentile'):
+            if (len(samp) > 0):
+                scl['min'], scl['max'] = np.percentile(samp, pct)
+            else:
+                scl['min'], scl['max'] = 0., 1.
+        else:
+            scl['levels'] = histeq_levels(samp)
+            scl['min'] = scl['levels'][0]
+            scl['max'] = scl['levels'][-1]
+        if (echo == True):
+            print ('Computing {} from {} samples'.format(lims, len(samp)))
 
-    elif (lims == 'minmax'):
+    else:
+        # Default to min, max
         if (echo == True):
             print ('Computing minmax')
-        im_min = np.min(dat)
-        im_max = np.max(dat)
+        scl['min'], scl['max'] = plane_minmax(dat)
 
     if (echo == True):
-        print ('Computed img min,max = {}, {}'.format(im_min, im_max))
+        print ('Computed img min,max = {}, {}'.format(scl['min'], scl['max']))
 
-    return im_min, im_max
+    if (cache_key != None):
+        if (len(_scaling_cache) >= SCALING_CACHE_SIZE):
+            _scaling_cache.clear()
+        _scaling_cache[key] = scl
 
-def rgb_scaling (dat, lims, lrms, disp_lims):
+    return scl
+
+def compute_scaling_limits (dat, lims, lrms=1, disp_lims=[], pct=[0.5, 99.5],
+                            cache_key=None, echo=False):
+    """
+    Compute display scaling min and max.
+    dat == 2-D image to compute limits for
+    lims == the type of scale range (see compute_scaling)
+    lrms == optional args to lims
+    disp_lims == optional pre-specified limits. Overrides others
+    """
+    scl = compute_scaling (dat, lims, lrms=lrms, disp_lims=disp_lims, pct=pct,
+                           cache_key=cache_key, echo=echo)
+
+    return scl['min'], scl['max']
+
+def rgb_scaling (dat, lims, lrms, disp_lims, pct=[0.5, 99.5]):
     """\
     Compute RGB scaling limits and rescale the data array for display.
     """
@@ -107,12 +291,23 @@ def rgb_scaling (dat, lims, lrms, disp_lims):
     dat[:,:,1] = (dat[:,:,1] - gminF) / (gmaxF - gminF)
     dat[:,:,2] = (dat[:,:,2] - bminF) / (bmaxF - bminF)
 
+    if ((lims == 'histeq') and (disp_lims == [])):
+        # Equalize each color plane separately
+        for ic in range(3):
+            scl = compute_scaling (dat[:,:,ic], lims)
+            dat[:,:,ic] = histeq_stretch (dat[:,:,ic], scl['levels'])
+        print ('RGB histogram equalized')
+        return dat, 0., 1.
+
     rmin, rmax = compute_scaling_limits (dat[:,:,0], lims=lims,
-                                         lrms=lrms, disp_lims=disp_lims)
+                                         lrms=lrms, disp_lims=disp_lims,
+                                         pct=pct)
     gmin, gmax = compute_scaling_limits (dat[:,:,1], lims=lims,
-                                         lrms=lrms, disp_lims=disp_lims)
+                                         lrms=lrms, disp_lims=disp_lims,
+                                         pct=pct)
     bmin, bmax = compute_scaling_limits (dat[:,:,2], lims=lims,
-                                         lrms=lrms, disp_lims=disp_lims)
+                                         lrms=lrms, disp_lims=disp_lims,
+                                         pct=pct)
 
     print ('RGB min,max = {},{} {},{} {},{}'.format(rmin, rmax, 
                                                     gmin, gmax, 
@@ -128,10 +323,225 @@ def rgb_scaling (dat, lims, lrms, disp_lims):
 
     return dat, im_min, im_max
 
+#------------------------------------------------------------------------
+# Movie output: frames are rendered straight to RGB buffers through a
+# lookup table and streamed out one at a time, so memory does not grow
+# with the length of the cube.
+
+MARKER_RGB = [255, 0, 0]
+MOVIE_SUFFIXES = ['.mp4', '.mov', '.mkv', '.avi', '.gif', '.webm']
+
+def is_movie_file (outfile):
+    """\
+    True if outfile names a movie file write_movie can produce.
+    """
+    return ((outfile != None) and
+            (os.path.splitext(outfile)[1].lower() in MOVIE_SUFFIXES))
+
+def anim_fps (anim):
+    """\
+    Movie frame rate for an animation delay of anim ms.
+    """
+    return max(1, int(round(1000. / abs(anim))))
+
+def colormap_lut (cm_arg, nlevels=256):
+    """\
+    nlevels x 3 uint8 RGB lookup table for a matplotlib colormap name.
+    """
+    cmap = plt.get_cmap(cm_arg, nlevels)
+    return (cmap(np.arange(nlevels))[:, :3] * 255. + 0.5).astype(np.uint8)
+
+def stretch_to_index (dat, scl, nlevels=256):
+    """\
+    Stretch a 2-D plane to 0..nlevels-1 LUT indices with the scaling
+    from compute_scaling.
+    """
+    if (scl['levels'] is not None):
+        frac = histeq_stretch(dat, scl['levels'])
+    else:
+        rng = scl['max'] - scl['min']
+        if (rng == 0):
+            rng = 1.
+        frac = (np.asarray(dat, dtype=np.float32) - scl['min']) / rng
+    idx = np.clip(frac * (nlevels - 1) + 0.5, 0, nlevels - 1)
+    return np.nan_to_num(idx).astype(np.uint8)
+
+def render_plane (dat, scl, lut, rows, cols, marker=None):
+    """\
+    Render one plane as a uint8 RGB buffer (top row first).
+    rows, cols == source pixel of every output row and column, which
+    sets the y expansion, the flip for origin='lower', and the padding
+    to even dimensions.
+    marker == (x, height) of the time marker drawn along the bottom
+    """
+    rgb = lut[stretch_to_index(dat, scl, len(lut))[rows][:, cols]]
+    if (marker != None):
+        mx, mdy = marker
+        ocol = np.searchsorted(cols, mx)
+        if (ocol >= len(cols)):
+            ocol = len(cols) - 1
+        rgb[len(rows)-mdy:, ocol] = MARKER_RGB
+    return rgb
+
+def movie_geometry (ylen, xlen, yratio=1.0, even=True):
+    """\
+    Output pixel maps for movie frames: rows flipped and expanded by
+    yratio, and if even, both dimensions padded to even sizes (needed
+    by yuv420p).
+    """
+    oh = max(1, int(round(ylen * yratio)))
+    ow = xlen
+    if (even == True):
+        oh = oh + (oh % 2)
+        ow = ow + (ow % 2)
+    rows = np.minimum((np.arange(oh) / yratio).astype(int), ylen - 1)[::-1]
+    cols = np.minimum(np.arange(ow), xlen - 1)
+    return rows, cols
+
+class FrameSink:
+    """\
+    Write RGB frames to ffmpeg through a pipe, or, if there is no
+    ffmpeg, to a numbered PNG sequence next to outfile.
+    """
+    def __init__ (self, outfile, width, height, fps=10, ffmpeg=None):
+        self.outfile = outfile
+        self.nframes = 0
+        self.proc = None
+        if (ffmpeg == None):
+            ffmpeg = FFMPEG
+
+        if (ffmpeg != None):
+            cmd = [ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '{}x{}'.format(width, height),
+                   '-r', str(fps), '-i', '-', '-an']
+            if (os.path.splitext(outfile)[1].lower() != '.gif'):
+                cmd += ['-vcodec', 'libx264', '-pix_fmt', 'yuv420p']
+            cmd.append(outfile)
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            print ('Writing movie {} with {}'.format(outfile, ffmpeg))
+        else:
+            self.base = os.path.splitext(outfile)[0]
+            print ('No ffmpeg, writing frames to {}_NNNNN.png'.\
+                       format(self.base))
+
+    def write (self, rgb):
+        if (self.proc != None):
+            self.proc.stdin.write(np.ascontiguousarray(rgb).tobytes())
+        else:
+            plt.imsave('{}_{:05d}.png'.format(self.base, self.nframes), rgb)
+        self.nframes += 1
+
+    def close (self):
+        if (self.proc != None):
+            self.proc.stdin.close()
+            if (self.proc.wait() != 0):
+                print ('ffmpeg failed writing {}'.format(self.outfile))
+        print ('{} frames written'.format(self.nframes))
+
+def write_movie (cdat, outfile, scl, cm_arg='Greys', yratio=1.0, zstep=1,
+                 fps=10, marker=True, ffmpeg=None):
+    """\
+    Render the planes of a 3-D cube to a movie file, one plane at a
+    time.  cdat may be a memory mapped cube; only the current plane is
+    read.  The scaling (scl from compute_scaling) is the same for all
+    planes.  If marker, a time marker moves along the bottom edge.
+    """
+    nfr, ylen, xlen = np.shape(cdat)
+    lut = colormap_lut(cm_arg)
+    rows, cols = movie_geometry(ylen, xlen, yratio)
+    mr_dy = int(np.min([10, np.max([len(rows)/20, 1])]))
+
+    sink = FrameSink(outfile, len(cols), len(rows), fps=fps, ffmpeg=ffmpeg)
+    try:
+        for inum in range(0, nfr, zstep):
+            mrk = None
+            if (marker == True):
+                mrk = (int(inum / max(nfr-1, 1) * (xlen - 1)), mr_dy)
+            sink.write(render_plane(cdat[inum], scl, lut, rows, cols, mrk))
+    finally:
+        sink.close()
+
+    return
+
+#------------------------------------------------------------------------
+# Fast PNG output: no matplotlib figure or axes, just the stretched
+# image with the marginal sums drawn beside it.  For QA plots of many
+# frames.
+
+MARG_RGB    = [31, 119, 180]
+MARG_GAP    = 2
+MARG_FRAC   = 0.15        # marginal strip size, fraction of the image
+
+def marginal_strip (marg, depth):
+    """\
+    Rasterize a marginal sum as a line in a depth x len(marg) mask,
+    higher values toward row 0.  Neighbouring points are joined by
+    vertical runs so the line is continuous.
+    """
+    marg = np.asarray(marg, dtype=np.float64)
+    mlo = np.nanmin(marg)
+    mrng = np.nanmax(marg) - mlo
+    if ((mrng == 0) or (np.isfinite(mrng) == False)):
+        mrng = 1.
+    ypos = np.nan_to_num((depth - 1) * (1. - (marg - mlo) / mrng))
+    ypos = np.rint(ypos).astype(int)
+    yprev = np.concatenate([ypos[:1], ypos[:-1]])
+    lo = np.minimum(ypos, yprev)
+    hi = np.maximum(ypos, yprev)
+    ridx = np.arange(depth)[:, None]
+    return (ridx >= lo[None, :]) & (ridx <= hi[None, :])
+
+def render_png_margs (dat, outfile, scl, cm_arg='Greys', yratio=1.0,
+                      marg_plot=True, isrgb=False, margs=None):
+    """\
+    Write a 2-D image (or 0-1 scaled RGB image) straight to a PNG
+    through the colormap LUT, with the x marginal above and the y
+    marginal to the right if marg_plot.
+    margs == (xmarg, ymarg) if already computed
+    """
+    ylen, xlen = np.shape(dat)[0:2]
+    rows, cols = movie_geometry(ylen, xlen, yratio, even=False)
+
+    if (isrgb == True):
+        img = (np.clip(np.nan_to_num(dat), 0., 1.) * 255. + 0.5).\
+            astype(np.uint8)[rows][:, cols]
+    else:
+        img = render_plane(dat, scl, colormap_lut(cm_arg), rows, cols)
+
+    if (marg_plot == False):
+        plt.imsave(outfile, img)
+        return
+
+    if (margs == None):
+        xmarg, ymarg = rf.compute_xy_marginals(dat)[0:2]
+    else:
+        xmarg, ymarg = margs
+    if (isrgb == True):
+        xmarg = np.mean(xmarg, axis=-1)
+        ymarg = np.mean(ymarg, axis=-1)
+
+    oh, ow = len(rows), len(cols)
+    depth = max(16, int(MARG_FRAC * max(oh, ow)))
+    top = depth + MARG_GAP
+    canvas = np.full((top + oh, ow + MARG_GAP + depth, 3), 255, np.uint8)
+    canvas[top:, 0:ow] = img
+
+    # x marginal above the image, y marginal to the right (rows flipped
+    # to match the image)
+    xline = marginal_strip(np.asarray(xmarg)[cols], depth)
+    canvas[0:depth, 0:ow][xline] = MARG_RGB
+    yline = marginal_strip(np.asarray(ymarg)[rows], depth)[::-1].T
+    canvas[top:, ow+MARG_GAP:][yline] = MARG_RGB
+
+    plt.imsave(outfile, canvas)
+    return
+
 def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
                           disp_lims=[], lims='zscale', lrms=1.0,
                           marg_plot=True, naxlims=[], isrgb=False,
-                          yratio=1.0, anim=0, zstep=1):
+                          yratio=1.0, anim=0, zstep=1, pct=[0.5, 99.5],
+                          cache_key=None, fast=False):
     """\
     Display a single 2-D FITS image plus marginals, or
     planes of a 3-D cube, or a single RGB (3plane, 3color) image.
@@ -141,8 +551,13 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
                         non == normal gray scale
     - disp_lims == [min, max] if not equal, they set the min and max scale range
     - lims == type of auto limits
-              zscale, lrms == +/- lrms * rms about the average value
+              zscale == IRAF zscale from a sample of the pixels
+              rms, lrms == +/- lrms * rms about the average value
               minmax == min to max data value
+              percentile == pct[0] to pct[1] percentiles of a sample
+              histeq == histogram equalization from a sample
+              For a cube, the scaling is computed once for the
+              whole cube and used for every plane.
     - marg_plot == true/false - plot or don't plot marginal sums
     - naxlims == [xmin, xmax, ymin, ymax] - plot subregion. If [], full image
     - isrgb == true if the image is a 3 plane RGB image
@@ -151,7 +566,14 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
                 equivalent to setting the aspect ratio
     - anim == delay in millisec between animation frames. animate only if != 0.
                anim < 0 means repeat loop, else only once.
+               A cube animation written to a file is rendered by
+               write_movie, at 1000/|anim| frames per second.
     - zstep == stride in Z dimension when displaying a 3D cube. default = 1
+    - pct == [low, high] percentiles for lims == percentile
+    - cache_key == reuse the scaling computed for the same key
+    - fast == write PNG output directly through the colormap, without
+              matplotlib axes, ticks or title (planes of a cube go to
+              outfile_NNNNN.png)
     """
 
     # Set up plot box fractions
@@ -191,6 +613,19 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
     elif ((img_ndim == 3) and (rgb_flag == True)):
         nfr = 1
 
+    # Monochrome scaling, once for the whole image or cube
+    if (rgb_flag == False):
+        scl = compute_scaling (cdat, lims, lrms=lrms, disp_lims=disp_lims,
+                               pct=pct, cache_key=cache_key)
+
+    # Animation to a movie file: stream rendered frames, without
+    # matplotlib.  Other outputs go through the matplotlib path below.
+    if ((anim != 0) and (img_ndim == 3) and (rgb_flag == False) and
+        is_movie_file(outfile)):
+        write_movie (cdat, outfile, scl, cm_arg=cm_arg, yratio=yratio,
+                     zstep=zstep, fps=anim_fps(anim))
+        return
+
     # if doing an animation, set up the fig and ax for accumulating
     if (anim != 0):
         an_frames = []
@@ -212,13 +647,36 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
         # for each color plane
         if (rgb_flag == True):
             # Compute display limits for RGB and rescale 3-d data array
-            dat, im_min, im_max = rgb_scaling (dat, lims, lrms, disp_lims)
+            dat, im_min, im_max = rgb_scaling (dat, lims, lrms, disp_lims,
+                                               pct=pct)
+
+        elif (scl['levels'] is not None):
+            # Histogram equalized - Monochrome
+            dat = histeq_stretch (dat, scl['levels'])
+            im_min = 0.
+            im_max = 1.
 
         else:
-            # Compute display pixel value limits - Monochrome
-            im_min, im_max = compute_scaling_limits (dat, lims=lims, 
-                                                     lrms=lrms, 
-                                                     disp_lims=disp_lims)
+            # Display pixel value limits - Monochrome
+            im_min = scl['min']
+            im_max = scl['max']
+
+        if ((fast == True) and (anim == 0) and (outfile != None) and
+            (outfile.lower() not in ['screen', 'skip'])):
+            # No axes: write the PNG directly
+            if (nfr > 1):
+                ofile = '{}_{:05d}.png'.format(os.path.splitext(outfile)[0],
+                                               inum)
+            else:
+                ofile = outfile
+            if (rgb_flag == False):
+                dscl = {'min': im_min, 'max': im_max, 'levels': None}
+            else:
+                dscl = None
+            render_png_margs (dat, ofile, dscl, cm_arg=cm_arg, yratio=yratio,
+                              marg_plot=marg_plot, isrgb=rgb_flag,
+                              margs=(xmarg, ymarg))
+            continue
 
         # Compute boundaries and definitions for the axes
         yscale = ylen * yratio
@@ -246,11 +704,10 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
         if (anim != 0):
             #  Setup and load for animation
 
-            # add time marker by overwriting pixels on the image
-            mrkrpix_x = int(inum / (img_shape[0]-1) * (xlen - 1))
+            # time marker along the bottom edge, drawn over the image
+            mrkrpix_x = int(inum / max(nfr-1, 1) * (xlen - 1))
             mrkrpix_y = 0
             mr_dy = int(np.min([10, np.max([ylen/20, 1])]))
-            dat[mrkrpix_y:mrkrpix_y+mr_dy, mrkrpix_x] = im_max
 
             if (inum == 0):
                 an_fg = plt.figure(figsize=(6.5, 6.5))
@@ -267,10 +724,13 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
                                        vmin=im_min, vmax=im_max, 
                                        cmap=cm_arg, aspect=yratio,
                                        animated=True)
+            an_mrk, = an_ax_img.plot ([mrkrpix_x, mrkrpix_x],
+                                      [mrkrpix_y, mrkrpix_y + mr_dy],
+                                      color='r', linewidth=1, animated=True)
             # an_ttl.set_text(inum)
             # an_ttl.figure.canvas.draw()
 
-            an_frames.append([an_fr1])
+            an_frames.append([an_fr1, an_mrk])
 
         else:
             # Regular frame display
@@ -290,9 +750,9 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
                 ax_yma.tick_params(direction='in', labelsize='x-small',
                                    labelleft=False)
             
-                ax_img.imshow (dat, origin='lower', vmin=im_min, vmax=im_max,
-                               cmap=cm_arg, aspect=yratio)
-                # norm=clrs.Normalize().autoscale(lgs))
+            ax_img.imshow (dat, origin='lower', vmin=im_min, vmax=im_max,
+                           cmap=cm_arg, aspect=yratio)
+            # norm=clrs.Normalize().autoscale(lgs))
 
             # Add plot title, with possible frame counter
             if (title != None):
@@ -329,6 +789,9 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
             else:
                 plt.show()
 
+            # release the figure, so batches of files don't accumulate
+            plt.close (fg)
+
     if (anim != 0):
         # If requested, write out animation file
 
@@ -348,10 +811,8 @@ def display_2d_margs_img (hdr, indat, title=None, outfile=None, cm='inv',
             pass
 
         elif (outfile != None):
-            an_writer = animation.FFMpegWriter(fps=10)
-#                                               metadata=dict(artist='Me'),
-#                                               bitrate=1800)
-# extra_args=['-vcodec', 'libx264']
+            # (cubes to movie files are written by write_movie above)
+            an_writer = animation.FFMpegWriter(fps=anim_fps(anim))
             ani.save(outfile, writer=an_writer)
 
         else:
@@ -412,7 +873,7 @@ def parse_cmd_line (iargv):
                       'Default: ' + def_cmap)
 
     def_lims = 'zscale'
-    lims_options = ['zscale', 'minmax']
+    lims_options = ['zscale', 'rms', 'minmax', 'percentile', 'histeq']
     cli.add_argument ('-l', '--lims', type=str, default=def_lims,
                       choices=lims_options,
                       help='Auto Scaling Limit Choices. ' + 
@@ -429,8 +890,17 @@ def parse_cmd_line (iargv):
     cli.add_argument ('-o', '--output', type=str, default=def_output,
                       help='Output file name. Output file type is ' +
                       'determined from the file post-fix. ' + 
+                      'With -a, a movie file (.mp4 etc) is streamed ' +
+                      'through ffmpeg, or written as PNG frames ' +
+                      'without it. ' + 
                       'Default: ' + def_output)
 
+    def_pct = [0.5, 99.5]
+    cli.add_argument ('-p', '--pct', type=float, nargs=2, default=def_pct,
+                      help='Low and high percentiles for percentile ' +
+                      'scaling. ' +
+                      'Default: ' + str(def_pct))
+
     def_rgb = 'n'
     rgb_options = ['+', 'y', 'Y', '-', 'n', 'N']
     cli.add_argument ('-R', '--rgb', type=str, default=def_rgb,
@@ -440,7 +910,7 @@ def parse_cmd_line (iargv):
 
     def_rms = 1
     cli.add_argument ('-r', '--rms', type=float, default=def_rms,
-                      help='Num of +/- RMS about average for zscale. ' + 
+                      help='Num of +/- RMS about average for rms. ' + 
                       'Default: ' + str(def_rms))
 
     def_mplot = '+'
@@ -455,6 +925,21 @@ def parse_cmd_line (iargv):
                       help='Display title. ' + 
                       'Default: ' + str(def_title))
 
+    def_jobs = 1
+    cli.add_argument ('-j', '--jobs', type=int, default=def_jobs,
+                      help='Number of processes rendering files in ' +
+                      'parallel, when writing output files. ' +
+                      'Default: ' + str(def_jobs))
+
+    def_fast = '-'
+    fast_options = ['+', 'y', 'Y', '-', 'n', 'N']
+    cli.add_argument ('-f', '--fast', type=str, default=def_fast,
+                      choices=fast_options,
+                      help='Write PNG output directly, without plot ' +
+                      'axes, ticks or titles (much faster for many ' +
+                      'files). ' +
+                      'Default: ' + def_fast)
+
     def_yscl = 1.0
     cli.add_argument ('-y', '--yscale', type=float, default=def_yscl,
                       help='Y expansion factor. ' + 
@@ -485,7 +970,8 @@ def parse_cmd_line (iargv):
 
     lims = args.lims
     lrms = args.rms
-    print ('limits, lrms = {} {}'.format(lims, lrms))
+    pct = args.pct
+    print ('limits, lrms, pct = {} {} {}'.format(lims, lrms, pct))
 
     mplot = args.sums
     print ('display marginal sums = {}'.format(mplot))
@@ -528,27 +1014,72 @@ def parse_cmd_line (iargv):
         print ('Setting to 1')
         zstep = 1
     print ('z stride = {}'.format(zstep))
+
+    jobs = max(1, args.jobs)
+    print ('jobs = {}'.format(jobs))
+
+    fast = args.fast
+    print ('fast PNG output = {}'.format(fast))
+    if ((fast == '+') or (fast == 'y') or (fast == 'Y')):
+        fast = True
+    else:
+        fast = False
         
-    return anim, fits_input, cmap, disp_lims, lims, lrms, \
-        marg_plot, title, outfile, naxlims, isrgb, yscale, zstep
+    return anim, fits_input, cmap, disp_lims, lims, lrms, pct, \
+        marg_plot, title, outfile, naxlims, isrgb, yscale, zstep, \
+        jobs, fast
 
 #------------------------------------------------------------------------
+def display_fits_file (pf, ofile, dtitle, opts):
+    """\
+    Load and display (or render to ofile) one FITS file.
+    opts == dict of display_2d_margs_img keyword options
+    Top level so it can run in a worker process.
+    """
+    flims = opts['disp_lims']
+    if ((opts['anim'] != 0) and (opts['isrgb'] == False) and
+        is_movie_file(ofile)):
+        # Movie of a (possibly very long) cube: memory map the raw
+        # data so planes are read one at a time.  The stretch is
+        # linear in the raw values, so only explicit display
+        # limits need converting.
+        hdr, dat, bscale, bzero = rf.load_fits_memmap (pf)
+        if (flims != []):
+            flims = [(v - bzero) / bscale for v in flims]
+    else:
+        hdr, dat = rf.load_fits_file (pf)
+
+    if (dat is None):
+        return pf
+
+    dopts = dict(opts)
+    dopts['disp_lims'] = flims
+    display_2d_margs_img (hdr, dat, title=dtitle, outfile=ofile,
+                          cache_key=(pf, tuple(opts['naxlims'])), **dopts)
+
+    return pf
+
 def display_fits_main (iargv):
     """
     Run simple fits image display.
     """
 
     # Read and parse the command line
-    anim, fits_input, cmap, disp_lims, lims, lrms, \
-        marg_plot, title, outfile, naxlims, isrgb, yscale, zstep \
-        = parse_cmd_line (iargv)
+    anim, fits_input, cmap, disp_lims, lims, lrms, pct, \
+        marg_plot, title, outfile, naxlims, isrgb, yscale, zstep, \
+        jobs, fast = parse_cmd_line (iargv)
 
     # Get list of files for display
     f_files = ru.expand_list_files2(ipfiles=fits_input)
 
-    # Loop through files, open and display
+    opts = {'cm': cmap, 'disp_lims': disp_lims, 'lims': lims, 'lrms': lrms,
+            'marg_plot': marg_plot, 'naxlims': naxlims, 'isrgb': isrgb,
+            'yratio': yscale, 'anim': anim, 'zstep': zstep, 'pct': pct,
+            'fast': fast}
+
+    # Work out title and output for each file
+    todo = []
     for pf in f_files:
-        hdr, dat = rf.load_fits_file (pf)
         if (title == 'filename'):
             dtitle = pf
         else:
@@ -562,16 +1093,31 @@ def display_fits_main (iargv):
             ofile = pf + '.png'
         elif (outfile == 'filename.pdf'):
             ofile = pf + '.pdf'
+        elif (outfile == 'filename.mp4'):
+            ofile = pf + '.mp4'
         else:
             ofile = outfile
 
-        display_2d_margs_img (hdr, dat, title=dtitle, outfile=ofile,
-                              cm=cmap, 
-                              disp_lims=disp_lims, lims=lims, lrms=lrms,
-                              marg_plot=marg_plot,
-                              naxlims=naxlims, isrgb=isrgb,
-                              yratio=yscale,
-                              anim=anim, zstep=zstep)
+        todo.append((pf, ofile, dtitle))
+
+    # Writing files only: render headless, in parallel if asked
+    batch = ((outfile != None) and (outfile.lower() != 'screen'))
+    if (batch == True):
+        plt.switch_backend('Agg')
+
+    if ((batch == True) and (jobs > 1) and (len(todo) > 1)):
+        import concurrent.futures as cf
+        with cf.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futs = [pool.submit(display_fits_file, pf, ofile, dtitle, opts)
+                    for pf, ofile, dtitle in todo]
+            for fut in cf.as_completed(futs):
+                try:
+                    print ('Done {}'.format(fut.result()))
+                except Exception as err:
+                    print ('Failed: {}'.format(err))
+    else:
+        for pf, ofile, dtitle in todo:
+            display_fits_file (pf, ofile, dtitle, opts)
 
     return
 
@@ -17,7 +17,13 @@ format of the input iargv.
 TBD: At some point I would be inclined to set up alternate args to 
 img_log_main() in place of iargv that simplifies calling as a function.
 
+With -d/--database the log is built from the headers table written
+by db/ingest_fits.py instead of re-opening the FITS files. The file
+argument is then a glob pattern matched against the stored path,
+e.g. 'UT20210227/*.fit'.
+
 Updates:
+2026 Oct 19 - add -d/--database to read headers from the ingest DB
 2021 Feb 28 - initial version
 """
 
@@ -25,13 +31,17 @@ __intro__= """\
 Image header extraction and construction of single tabular log.
 """
 __author__="Stephen Levine"
-__date__="2021 Feb 28"
+__date__="2026 Oct 19"
 
 #------------------------------------------------------------------------
 
 # Command line arg parsing
 import argparse
 
+# Header store written by db/ingest_fits.py
+import sqlite3
+from itertools import groupby
+
 # SEL reduction utilities
 import reduc_utils as ru
 import reduc_fits_utils as rf
@@ -61,6 +71,13 @@ def parse_cmd_line (iargv):
                       help='Required Input Filename - Fits files. ' + 
                       'Default: ' + fits_input0)
 
+    def_db = ''
+    cli.add_argument ('-d', '--database', type=str, default=def_db,
+                      help='Read headers from this ingest database ' +
+                      'rather than the fits files. The file argument ' +
+                      'is then a glob on the stored path. ' +
+                      'Default: read the fits files')
+
     def_keyw = 'All'
     cli.add_argument ('-k', '--keywords', type=str, default=def_keyw,
                       help='Keywords to extract  ' +
@@ -93,6 +110,12 @@ def parse_cmd_line (iargv):
     if (verbose == True):
         print ('fits_input = {}'.format(fits_input))
 
+    dbfile = args.database
+    if (verbose == True):
+        print ('database = {}'.format(dbfile))
+    if ((dbfile != '') and (fits_input == fits_input0)):
+        fits_input = '*'
+
     keyw = args.keywords.replace('\n','').replace(' ','').split(',')
     if ((keyw == []) or (keyw == '') or (keyw == ['All']) or
         (keyw == ['sort'])):
@@ -104,7 +127,34 @@ def parse_cmd_line (iargv):
     if (verbose == True):
         print ('output file = {}'.format(outfile))
 
-    return  fits_input, keyw, outfile, verbose
+    return  fits_input, keyw, outfile, dbfile, verbose
+
+#------------------------------------------------------------------------
+def load_db_hdrs (dbfile, pattern='*', echo=False):
+    """
+    Generator over (path, header dict) pairs from the headers table
+    of the ingest database, for stored paths matching the glob pattern.
+    Rows are streamed in (path, card) order, one header at a time.
+    Commentary cards (COMMENT, HISTORY, blank) are skipped, and the
+    first occurrence of a repeated keyword wins, as for a fits header.
+    """
+    conn = sqlite3.connect('file:{}?mode=ro'.format(dbfile), uri=True)
+    try:
+        cur = conn.execute ('select path, keyword, value from headers ' +
+                            'where path glob ? order by path, seq',
+                            (pattern,))
+        for path, cards in groupby(cur, key=lambda row: row[0]):
+            hdr = {}
+            for row in cards:
+                if ((row[1] in ('', 'COMMENT', 'HISTORY')) or
+                    (row[1] in hdr)):
+                    continue
+                hdr[row[1]] = row[2]
+            if (echo != False):
+                print ('{} {} keywords'.format(path, len(hdr)))
+            yield path, hdr
+    finally:
+        conn.close()
 
 #------------------------------------------------------------------------
 def img_log_main (iargv):
@@ -113,10 +163,20 @@ def img_log_main (iargv):
     """
 
     # Parse the command line
-    fits_input, keyw, outfile, verbose = parse_cmd_line (iargv)
-
-    # Get list of files to work on
-    f_files = ru.expand_list_files2(ipfiles=fits_input, echo=verbose)
+    fits_input, keyw, outfile, dbfile, verbose = parse_cmd_line (iargv)
+
+    # Get list of files, or stored headers, to work on
+    if (dbfile != ''):
+        f_files = [fits_input]
+        hdr_source = load_db_hdrs (dbfile, fits_input,
+                                   echo=('Short' if (verbose == True)
+                                         else False))
+    else:
+        f_files = ru.expand_list_files2(ipfiles=fits_input, echo=verbose)
+        hdr_source = ((pf, rf.load_fits_hdr (pf, echo=('Short' if
+                                                      (verbose == True)
+                                                      else False)))
+                      for pf in f_files)
     num_files = len(f_files)
 
     # Loop through files, open, extract headers and write out a line
@@ -138,10 +198,7 @@ def img_log_main (iargv):
         print ('Keywords: {}'.format(keyorder))
         print ('{} files: {}'.format(num_files, f_files))
 
-    for pf in f_files:
-        # open fits file
-        hdr = rf.load_fits_hdr (pf, echo=('Short' if (verbose == True) 
-                                          else False))
+    for pf, hdr in hdr_source:
 
         if (hdr == None):
             # Failed to load for some reason, skip
@@ -19,6 +19,15 @@ TBD: At some point I would be inclined to set up alternate args to
 img_stats_main() in place of iargv that simplifies calling as a function.
 
 Updates:
+2026 Oct 19 - -r reads image;shape(...) lines, reports exclude, sky and
+              unparseable regions instead of dropping or failing on them
+2026 Oct 19 - -d writes stat_ columns, and is refused with -b/-B
+2026 Oct 19 - parallel files (-j), csv/jsonl/parquet tables, frame_stats
+              database sink (-d); -u writes STAT_REG in place
+2026 Oct 19 - -r region file: clipped stats in many regions per load
+2026 Oct 19 - stats from reduc_stat_utils (histogram for integer data),
+              add mad and pNN percentiles; mode works again
+2026 Oct 19 - per frame (-t) stats as axis-wise reductions over chunks
 2021 Mar 09 - moved val_fmt() to reduc_utils.
 2021 Jan 29 - updates to make img_stats_main() callable as fcn, returns stats
 2021 Jan 17 - initial version
@@ -29,22 +38,37 @@ Image manipulation tool to extract a portion of a 2-D image or 3-D
 image cube and compute statistics.
 """
 __author__="Stephen Levine"
-__date__="2021 Mar 09"
+__date__="2026 Oct 19"
 
 #------------------------------------------------------------------------
 
 # Command line arg parsing
 import argparse
 
+# Region file parsing
+import re
+
+# Table output and database sink
+import csv
+import json
+import os
+import sqlite3
+import sys
+
 # Numpy
 import numpy as np
 
-# Scipy - used for mode computation
-from scipy import stats as scst
-
 # SEL reduction utilities
 import reduc_utils as ru
 import reduc_fits_utils as rf
+import reduc_stat_utils as rs
+
+#------------------------------------------------------------------------
+
+# Per frame (-t) stats are computed on blocks of planes at a time; this
+# bounds the size of a block (as float64), and so the temporary copies
+# made by median, var etc.
+PLANE_CHUNK_BYTES = 64 * 1024 * 1024
 
 #------------------------------------------------------------------------
 
@@ -88,18 +112,51 @@ def parse_cmd_line (iargv):
                       'BUT FITS files use ONE based counting. ' +
                       'Default: ' + str(str_def_xylims))
 
+    def_db = ''
+    cli.add_argument ('-d', '--database', type=str, default=def_db,
+                      help='Also store whole-frame stats in the ' +
+                      'frame_stats table of this (ingest) database, ' +
+                      'keyed by NIGHT/file, in stat_ prefixed columns ' +
+                      '(e.g. stat_median). Not with -b or -B. ' +
+                      'Default: none')
+
     def_output = ''
     cli.add_argument ('-o', '--output', type=str, default=def_output,
                       help='Output file name. No value, stdio, or screen ' +
                       'will write the output to the screen. Anything else ' +
                       'will be interpretted as the name for an output file. ' +
+                      'Names ending .csv, .jsonl or .parquet get a table ' +
+                      'in that format, appended to an existing file. ' +
                       'Default: ' + def_output)
 
+    def_jobs = 1
+    cli.add_argument ('-j', '--jobs', type=int, default=def_jobs,
+                      help='Number of processes working on files in ' +
+                      'parallel. ' +
+                      'Default: ' + str(def_jobs))
+
+    def_nsigma = 3.0
+    cli.add_argument ('-n', '--nsigma', type=float, default=def_nsigma,
+                      help='Clipping threshold (in sigma) for the ' +
+                      'region stats. ' +
+                      'Default: ' + str(def_nsigma))
+
+    def_regions = ''
+    cli.add_argument ('-r', '--regions', type=str, default=def_regions,
+                      help='DS9 style region file (image coordinates) ' +
+                      'with box, circle and annulus regions. Gives ' +
+                      'num, mean, median, std, MAD and sigma clipped ' +
+                      'mean, median and std for every region of every ' +
+                      'file as one table; -b, -B, -s and -t are ' +
+                      'ignored. ' +
+                      'Default: none')
+
     def_stats = 'num,sum,mean,median,rms'
     cli.add_argument ('-s', '--stats', type=str, default=def_stats,
                       help='Select statistical quantities to compute. ' +
-                      'Options include: average, max, min, mean, ' +
-                      'median, mode, num, rms, std, sum, var. ' +
+                      'Options include: average, mad, max, min, mean, ' +
+                      'median, mode, num, rms, std, sum, var, and ' +
+                      'pNN for the NN-th percentile (e.g. p99.5). ' +
                       'Default: ' + def_stats)
 
     twodframe = False
@@ -110,8 +167,8 @@ def parse_cmd_line (iargv):
 
     update = False
     cli.add_argument ('-u', '--update', action="store_true",
-                      help='Add stats keywords and update input ' +
-                      'fits file header.')
+                      help='Write the stat region (STAT_REG) into the ' +
+                      'input fits file header, in place.')
 
     verbose = False
     cli.add_argument ('-v', '--verbose', action="store_true",
@@ -148,6 +205,11 @@ def parse_cmd_line (iargv):
         print ('output file = {}'.format(outfile))
 
     stats = args.stats.split(',')
+    try:
+        rs.check_stats (stats)
+    except ValueError as err:
+        print ('Error: {}'.format(err))
+        exit()
     if (verbose == True):
         print ('stats to compute = {}'.format(stats))
 
@@ -164,211 +226,648 @@ def parse_cmd_line (iargv):
         if (verbose == True):
             print ('Update fits file headers with stats information')
 
-    return  fits_input, naxlims, outfile, stats, twodframe, update, verbose
+    regfile = args.regions
+    nsigma = args.nsigma
+    jobs = max(1, args.jobs)
+    if (verbose == True):
+        print ('regions, nsigma, jobs = {} {} {}'.format(regfile, nsigma,
+                                                         jobs))
+
+    dbfile = args.database
+    if ((dbfile != '') and (naxlims != [])):
+        print ('Error: -d stores whole-frame stats, not with -b or -B')
+        exit()
+    if (verbose == True):
+        print ('database = {}'.format(dbfile))
+
+    return  fits_input, naxlims, outfile, stats, twodframe, update, \
+        regfile, nsigma, jobs, dbfile, verbose
 
-def compute_stat (stat_to_comp, ipdat):
+def compute_stat (stat_to_comp, ipdat, axis=None):
     """
     Compute requested statistic (stat_to_comp) over array (ipdat)
+    If axis is given, reduce over those axes only, e.g. axis=(1,2)
+    gives one value per plane of a cube.
+    Over the whole array this is rs.array_stats(), which can also
+    compute several statistics in one pass.
     """
 
+    if (axis == None):
+        return rs.array_stats (ipdat, [stat_to_comp])[stat_to_comp]
+
+    pct = rs.percentile_stat (stat_to_comp)
+
     if (stat_to_comp == 'average'):
-        stat_value = np.average (ipdat, weights=None)
+        stat_value = np.average (ipdat, axis=axis, weights=None)
+
+    elif (stat_to_comp == 'mad'):
+        med = np.median (ipdat, axis=axis, keepdims=True)
+        stat_value = np.median (np.abs(ipdat - med), axis=axis)
 
     elif (stat_to_comp == 'max'):
-        stat_value = np.max (ipdat)
+        stat_value = np.max (ipdat, axis=axis)
 
     elif (stat_to_comp == 'mean'):
-        stat_value = np.mean (ipdat)
+        stat_value = np.mean (ipdat, axis=axis)
 
     elif (stat_to_comp == 'median'):
-        stat_value = np.median (ipdat)
+        stat_value = np.median (ipdat, axis=axis)
 
     elif (stat_to_comp == 'min'):
-        stat_value = np.min (ipdat)
+        stat_value = np.min (ipdat, axis=axis)
 
     elif (stat_to_comp == 'mode'):
-        stat_value = scst.mode (ipdat, axis=None)[0][0]
+        # no axis-wise mode in numpy: one histogram per plane
+        stat_value = np.array([compute_stat('mode', pln) for pln in ipdat])
 
     elif ((stat_to_comp == 'rms') or (stat_to_comp == 'std')):
-        stat_value = np.std (ipdat)
+        stat_value = np.std (ipdat, axis=axis)
 
     elif (stat_to_comp == 'sum'):
-        stat_value = np.sum (ipdat)
+        stat_value = np.sum (ipdat, axis=axis)
 
     elif (stat_to_comp == 'var'):
-        stat_value = np.var (ipdat)
+        stat_value = np.var (ipdat, axis=axis)
+
+    elif (pct != None):
+        stat_value = np.percentile (ipdat, pct, axis=axis)
 
     return stat_value
 
+def compute_plane_stats (stats, cdat, chunk_bytes=PLANE_CHUNK_BYTES):
+    """
+    Compute the requested statistics for every 2-D plane of a 3-D cube.
+    Each statistic is a single axis-wise reduction over a block of
+    planes, with blocks of at most chunk_bytes (as float64) along z.
+    Returns a dictionary of 1-D arrays, one value per plane, by stat.
+    """
+    nz = cdat.shape[0]
+    npix = cdat.shape[1] * cdat.shape[2]
+    zchunk = max(1, int(chunk_bytes // (npix * 8)))
+
+    st_arr = {}
+    for st_comp in stats:
+        if (st_comp == 'num'):
+            st_arr[st_comp] = np.full(nz, npix, dtype=np.int64)
+        else:
+            st_arr[st_comp] = np.zeros(nz, dtype=np.float64)
+
+    for z0 in range(0, nz, zchunk):
+        raw = cdat[z0:z0+zchunk]
+        blk = np.asarray(raw, dtype=np.float64)
+        z1 = z0 + blk.shape[0]
+        for st_comp in stats:
+            if (st_comp == 'mode'):
+                # from the raw (integer) planes, for the histogram path
+                st_arr[st_comp][z0:z1] = compute_stat(st_comp, raw,
+                                                      axis=(1,2))
+            elif (st_comp != 'num'):
+                st_arr[st_comp][z0:z1] = compute_stat(st_comp, blk,
+                                                      axis=(1,2))
+
+    return st_arr
+
 #------------------------------------------------------------------------
-def img_stats_main (iargv):
+# Region statistics (-r): DS9 style region file, image coordinates
+
+# [system;][-]shape(args): DS9 one line form, - marks an exclude region
+REGION_RE = re.compile(r'^\s*(?:(\w+)\s*;\s*)?([-+]?)\s*(\w+)\s*\(([^)]*)\)')
+REGION_NAME_RE = re.compile(r'text\s*=\s*[{"]([^}"]*)[}"]')
+
+# DS9 coordinate systems (also wcs, wcsa ... wcsz); regions are only
+# read in image or physical (taken to be the same) coordinates
+REGION_SYSTEMS = ['image', 'physical', 'fk4', 'fk5', 'icrs', 'galactic',
+                  'ecliptic', 'j2000', 'b1950', 'linear', 'amplifier',
+                  'detector']
+REGION_SHAPES = {'box': 4, 'circle': 3, 'annulus': 4}
+
+# Columns of the region stats table, after filename and region
+REGION_STATS = ['shape', 'num', 'mean', 'median', 'std', 'mad',
+                'clipmean', 'clipmedian', 'clipstd', 'nclip']
+
+# Region pixel indices by (region file, image shape), so they are
+# computed once for all the files of a run
+_region_idx = {}
+
+def region_value (text):
     """
-    Extract a subvolume from a 2-D or 3-D image array and compute stats.
+    Float value of a region argument, allowing the DS9 image/physical
+    pixel unit suffixes (i, p).  Others (", ', d, r, sexagesimal) need
+    the WCS and raise ValueError.
     """
+    text = text.strip()
+    if ((len(text) > 1) and (text[-1] in 'ip')):
+        text = text[:-1]
+    return float(text)
 
-    # Parse the command line
-    fits_input, naxlims, outfile, stats, twodframe, update, verbose = \
-        parse_cmd_line (iargv)
+def read_regions (regfile):
+    """
+    Read box, circle and annulus regions from a DS9 style region file
+    in image coordinates (ONE based FITS pixels, as DS9 writes them):
+      box(xc,yc,width,height)  circle(xc,yc,r)  annulus(xc,yc,rin,rout)
+    also in the one line form image;circle(...).  A text={name} tag
+    names the region.  Box rotation angles, global and comment lines
+    are ignored.  Exclude (-) regions, other shapes, regions in sky
+    coordinates and unparseable values are reported and skipped.
+    Returns a list of (name, shape, parameters).
+    """
+    regions = []
+    system = 'image'
+    with open(regfile, 'r') as fr:
+        for line in fr:
+            text = line.strip()
+            if ((text == '') or (text[0] == '#')):
+                continue
+
+            # coordinate system for the lines that follow
+            word = text.split('#')[0].strip().rstrip(';').lower()
+            if ((word in REGION_SYSTEMS) or
+                ((word[0:3] == 'wcs') and (len(word) <= 4))):
+                system = word
+                continue
+
+            mtch = REGION_RE.match(text)
+            if (mtch == None):
+                continue
+            prefix, sign, shape, args = mtch.groups()
+            shape = shape.lower()
+            if (shape not in REGION_SHAPES):
+                print ('Skipping unsupported region: {}'.format(text))
+                continue
+            regsys = system if (prefix == None) else prefix.lower()
+            if (regsys not in ['image', 'physical']):
+                print ('Skipping region not in image coordinates: {}'.\
+                           format(text))
+                continue
+            if (sign == '-'):
+                print ('Skipping exclude region: {}'.format(text))
+                continue
+            try:
+                pars = [region_value(v) for v in args.split(',')]
+            except ValueError:
+                print ('Skipping unparseable region: {}'.format(text))
+                continue
+            npars = REGION_SHAPES[shape]
+            if (len(pars) < npars):
+                print ('Skipping short region: {}'.format(text))
+                continue
+            name = REGION_NAME_RE.search(line)
+            if (name != None):
+                name = name.group(1)
+            else:
+                name = '{}{}'.format(shape, len(regions) + 1)
+            regions.append((name, shape, pars[0:npars]))
 
-    # Get list of files to work on
-    f_files = ru.expand_list_files2(ipfiles=fits_input, echo=verbose)
-    num_files = len(f_files)
+    return regions
 
-    # Loop through files, open, extract roi and compute stats
-    iseq = 0
+def region_indices (regions, img_shape, regfile=None):
+    """
+    Flat pixel indices (into one 2-D plane of img_shape) of the pixels
+    whose centers fall in each region, clipped to the image.
+    Cached by region file and image shape.
+    """
+    ny, nx = img_shape[-2:]
+    key = (regfile, ny, nx)
+    if ((regfile != None) and (key in _region_idx)):
+        return _region_idx[key]
+
+    reg_idx = []
+    for name, shape, pars in regions:
+        # ZERO based center
+        xc = pars[0] - 1.
+        yc = pars[1] - 1.
+        if (shape == 'box'):
+            hx = pars[2] / 2.
+            hy = pars[3] / 2.
+        else:
+            hx = hy = pars[-1]
+
+        # work in the bounding box only
+        x0 = max(0, int(np.floor(xc - hx)))
+        x1 = min(nx, int(np.ceil(xc + hx)) + 1)
+        y0 = max(0, int(np.floor(yc - hy)))
+        y1 = min(ny, int(np.ceil(yc + hy)) + 1)
+        if ((x0 >= x1) or (y0 >= y1)):
+            reg_idx.append(np.zeros(0, dtype=np.intp))
+            continue
 
-    # Stats value(s) dictionary space
-    st_val = {}
-    
-    # setup output stats arrays
-    st_val['filename'] = []
-    for st_comp in stats:
-        st_val[st_comp] = []
+        yy, xx = np.mgrid[y0:y1, x0:x1]
+        if (shape == 'box'):
+            inreg = (np.abs(xx - xc) <= hx) & (np.abs(yy - yc) <= hy)
+        else:
+            rsq = (xx - xc)**2 + (yy - yc)**2
+            inreg = (rsq <= pars[-1]**2)
+            if (shape == 'annulus'):
+                inreg &= (rsq > pars[2]**2)
 
+        reg_idx.append(yy[inreg] * nx + xx[inreg])
 
-    for pf in f_files:
-        # open fits file
-        hdr, dat = rf.load_fits_file (pf, 
-                                      echo=('Short' if (verbose == True) 
-                                            else False))
+    if (regfile != None):
+        _region_idx[key] = reg_idx
+
+    return reg_idx
 
-        if (hdr == None):
-            # Failed to load for some reason, skip
+def file_region_stats (pf, regions, nsigma=3.0, verbose=False,
+                       regfile=None):
+    """
+    Load one file and compute the statistics of every region in
+    regions (from read_regions; regfile, its file name, keys the pixel
+    index cache).  For a cube, each region covers all the planes.
+    Returns a list of rows, [filename, region] + REGION_STATS.
+    """
+    hdr, dat = rf.load_fits_file (pf, echo=('Short' if (verbose == True)
+                                            else False))
+    if (hdr == None):
+        return []
+
+    reg_idx = region_indices (regions, np.shape(dat), regfile)
+    ny, nx = np.shape(dat)[-2:]
+    flat = np.reshape(dat, (-1, ny * nx))
+
+    rows = []
+    for (name, shape, pars), idx in zip(regions, reg_idx):
+        vals = flat[:, idx]
+        if (vals.size == 0):
+            print ('{}: region {} is off the image'.format(pf, name))
             continue
+        st_one = rs.array_stats (vals, ['num', 'mean', 'median', 'std',
+                                        'mad'])
+        st_one.update (rs.sigma_clip_stats (vals, nsigma=nsigma))
+        st_one['shape'] = shape
+        rows.append([pf, name] + [st_one[st_comp]
+                                  for st_comp in REGION_STATS])
 
-        # Extract a subset of an image cube (either 2 or 3-D)
-        # Set rgb to false for this application
-        cdat, rgb_flag, img_ndim, img_shape = \
-            rf.extract_subimage (dat, naxlims, isrgb=False)
-
-        # If ROI axis limits not set, set to existing image limits
-        if (naxlims == []):
-            if (img_ndim == 2):
-                naxlims = [0, img_shape[1],
-                           0, img_shape[0]]
-            elif (img_ndim == 3):
-                naxlims = [0, img_shape[2], 
-                           0, img_shape[1], 
-                           0, img_shape[0]]
-            else:
-                print ('Error: unable to set naxlims')
-                exit()
+    return rows
+
+def img_region_stats (f_files, regfile, outfile, nsigma=3.0, jobs=1,
+                      verbose=False):
+    """
+    Statistics in every region of regfile for every file, in parallel
+    over files if jobs > 1, as one table with a row per file and region.
+    Returns the column names and a dictionary of columns.
+    """
+    cols = ['filename', 'region'] + REGION_STATS
 
-        # Construct string showing original file
-        # and bounds, in FITS base ONE values
+    # parsed once here, not by every file (or worker)
+    regions = read_regions (regfile)
+
+    per_file = map_files (file_region_stats, f_files,
+                          (regions, nsigma, verbose, regfile), jobs)
+
+    rows = [row for frows in per_file for row in frows]
+
+    st_val = {}
+    for icol, col in enumerate(cols):
+        st_val[col] = [row[icol] for row in rows]
+
+    if (table_format(outfile) != 'text'):
+        write_table (outfile, cols, st_val)
+        return cols, st_val
+
+    hdr_line = '#' + ' '.join([col.capitalize() for col in cols])
+    op_line = ''.join(['{} \n'.format(' '.join([ru.val_fmt(cval)
+                                                 for cval in row]))
+                       for row in rows])
+
+    if ((outfile == '') or (outfile == 'screen') or (outfile == 'stdio')):
+        print (hdr_line)
+        print (op_line)
+    elif (outfile != 'skip'):
+        with open(outfile, 'a') as fo:
+            fo.write ('{}\n'.format(hdr_line))
+            fo.write ('{}'.format(op_line))
+
+    return cols, st_val
+
+#------------------------------------------------------------------------
+def file_stats (pf, naxlims, stats, twodframe=False, verbose=False):
+    """
+    Load one file, extract the subvolume and compute the stats, either
+    for the whole volume or (twodframe) for each plane of a cube.
+    Returns a dictionary with the stat region string (histline), the
+    text output header and lines, and the rows as dictionaries; or
+    None if the file could not be loaded.
+    """
+    # open fits file
+    hdr, dat = rf.load_fits_file (pf, 
+                                  echo=('Short' if (verbose == True) 
+                                        else False))
+
+    if (hdr == None):
+        # Failed to load for some reason, skip
+        return None
+
+    # Extract a subset of an image cube (either 2 or 3-D)
+    # Set rgb to false for this application
+    cdat, rgb_flag, img_ndim, img_shape = \
+        rf.extract_subimage (dat, naxlims, isrgb=False)
+
+    # If ROI axis limits not set, set to existing image limits
+    if (naxlims == []):
         if (img_ndim == 2):
-            histline = '{}[{}:{},{}:{}]'.format(pf, 
-                                                naxlims[0]+1, naxlims[1],
-                                                naxlims[2]+1, naxlims[3])
+            naxlims = [0, img_shape[1],
+                       0, img_shape[0]]
         elif (img_ndim == 3):
-            histline = '{}[{}:{},{}:{},{}:{}]'.format(pf, 
-                                                      naxlims[0]+1, naxlims[1],
-                                                      naxlims[2]+1, naxlims[3],
-                                                      naxlims[4]+1, naxlims[5])
+            naxlims = [0, img_shape[2], 
+                       0, img_shape[1], 
+                       0, img_shape[0]]
         else:
-            histline = '{}'.format(pf)
+            print ('Error: unable to set naxlims for {}'.format(pf))
+            return None
+
+    # Construct string showing original file
+    # and bounds, in FITS base ONE values
+    if (img_ndim == 2):
+        histline = '{}[{}:{},{}:{}]'.format(pf, 
+                                            naxlims[0]+1, naxlims[1],
+                                            naxlims[2]+1, naxlims[3])
+    elif (img_ndim == 3):
+        histline = '{}[{}:{},{}:{},{}:{}]'.format(pf, 
+                                                  naxlims[0]+1, naxlims[1],
+                                                  naxlims[2]+1, naxlims[3],
+                                                  naxlims[4]+1, naxlims[5])
+    else:
+        histline = '{}'.format(pf)
 
-        # Construct printing header line (column ids)
-        hdr_line = '#{} '.format('FileName')
-        if ((img_ndim == 3) and (twodframe == True)):
-            hdr_line += '{} '.format('zidx'.capitalize())
+    # Construct printing header line (column ids)
+    hdr_line = '#{} '.format('FileName')
+    if ((img_ndim == 3) and (twodframe == True)):
+        hdr_line += '{} '.format('zidx'.capitalize())
 
-        for st_comp in stats:
-            hdr_line += '{} '.format(st_comp.capitalize())
+    for st_comp in stats:
+        hdr_line += '{} '.format(st_comp.capitalize())
 
-        # compute statistics - either for the whole volume, or
-        #   if 3-D and requested, for each frame in the z-direction
-        # ['num', 'max', 'min', 'average', 'mean', 'median', 'mode',
-        #  'rms', 'std', 'sum', 'var']
-        # 'quantile' - quantile not implemented
+    # compute statistics - either for the whole volume, or
+    #   if 3-D and requested, for each frame in the z-direction
+    # ['num', 'max', 'min', 'average', 'mean', 'median', 'mode',
+    #  'rms', 'std', 'sum', 'var']
+    # 'pNN' - NN-th percentile, 'mad' - median absolute deviation
 
-#        # Stats value(s) dictionary space
-#        st_val = {}
-        
-        # Set up output printing line
-        op_line = ''
+    rows = []
 
-        # Separate out the frame by frame computation of stats from the
-        # computation for the full selected region
+    # 2D Frame by frame in 3D cube
+    if ((img_ndim == 3) and (twodframe == True)):
 
-        # 2D Frame by frame in 3D cube
-        if ((img_ndim == 3) and (twodframe == True)):
+        # All the planes at once, one column per stat
+        st_arr = compute_plane_stats (stats, cdat)
+        st_cols = [st_arr[st_comp].tolist() for st_comp in stats]
+
+        for zidx, st_row in enumerate(zip(*st_cols)):
+            row = {'filename': pf, 'zidx': zidx}
+            row.update(zip(stats, st_row))
+            rows.append(row)
+
+        op_line = ''.join(
+            ['{} {:4d} {} \n'.format(histline, zidx+1,
+                                     ' '.join([ru.val_fmt(cstat)
+                                               for cstat in st_row]))
+             for zidx, st_row in enumerate(zip(*st_cols))])
+
+    # Full 2D or 3D region stats
+    else:
+        # All the stats requested, in one pass over the data
+        st_one = rs.array_stats (cdat, stats)
 
-#            # setup output stats arrays
-#            for st_comp in stats:
-#                st_val[st_comp] = []
+        row = {'filename': pf}
+        row.update([(st_comp, st_one[st_comp]) for st_comp in stats])
+        rows.append(row)
 
-            # add an index array
-            st_val['zidx'] = []
+        op_line = '{} {} \n'.format(histline,
+                                    ' '.join([ru.val_fmt(st_one[st_comp])
+                                              for st_comp in stats]))
 
-            # Loop over the planes in the cube
-            for zidx in range(img_shape[0]):
+    return {'filename': pf, 'histline': histline, 'hdr_line': hdr_line,
+            'op_line': op_line, 'rows': rows}
+
+def plain_value (cval):
+    """
+    Numpy scalar to the python equivalent, for csv/json/sqlite.
+    """
+    if (isinstance(cval, np.generic)):
+        return cval.item()
+    return cval
+
+def table_format (outfile):
+    """
+    Output table format from the output file name: csv, jsonl or
+    parquet by suffix, otherwise the text format.
+    """
+    sfx = os.path.splitext(outfile)[1].lower()
+    if (sfx == '.csv'):
+        return 'csv'
+    elif ((sfx == '.jsonl') or (sfx == '.json')):
+        return 'jsonl'
+    elif (sfx == '.parquet'):
+        return 'parquet'
+    return 'text'
+
+def write_table (outfile, cols, st_val):
+    """
+    Append the stats columns to a csv (header row only for a new
+    file), json lines or parquet file.  csv and parquet files must
+    already have the same columns.
+    """
+    nrows = len(st_val[cols[0]]) if (cols != []) else 0
+    rows = [[plain_value(st_val[col][irow]) for col in cols]
+            for irow in range(nrows)]
+    tfmt = table_format (outfile)
+
+    if (tfmt == 'csv'):
+        newfile = ((os.path.exists(outfile) == False) or
+                   (os.path.getsize(outfile) == 0))
+        if (newfile == False):
+            with open(outfile, 'r', newline='') as fi:
+                if (next(csv.reader(fi), []) != cols):
+                    print ('Error: columns differ from those in {}'.\
+                               format(outfile))
+                    return
+        with open(outfile, 'a', newline='') as fo:
+            writer = csv.writer(fo)
+            if (newfile == True):
+                writer.writerow(cols)
+            writer.writerows(rows)
+
+    elif (tfmt == 'jsonl'):
+        with open(outfile, 'a') as fo:
+            for row in rows:
+                fo.write(json.dumps(dict(zip(cols, row))) + '\n')
+
+    elif (tfmt == 'parquet'):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print ('parquet output needs pyarrow (pip install pyarrow)')
+            return
+        table = pa.Table.from_pydict(
+            dict([(col, [row[icol] for row in rows])
+                  for icol, col in enumerate(cols)]))
+        # parquet files can't be appended to: rewrite with the old rows
+        if (os.path.exists(outfile) and (os.path.getsize(outfile) > 0)):
+            old = pq.read_table(outfile)
+            if (old.column_names != cols):
+                print ('Error: columns differ from those in {}'.\
+                           format(outfile))
+                return
+            table = pa.concat_tables([old, table.cast(old.schema)])
+        pq.write_table(table, outfile)
+
+    return
+
+def db_column (st_comp):
+    """
+    frame_stats column name for a stat (p99.5 -> stat_p99_5).  The
+    stat_ prefix keeps them apart from the ingest's own columns
+    (median, mad, ...).
+    """
+    return 'stat_' + st_comp.replace('.', '_')
 
-                st_val['filename'].append(pf)
+def db_frame_stats (dbfile, stats, st_val, verbose=False):
+    """
+    Store whole-frame stats in the frame_stats table of the ingest
+    database, one row per file keyed by path (NIGHT/<base>.fit, as
+    the ingest builds it for the images table).  Missing stat_
+    columns are added (see db_column); columns written by the ingest
+    (or other stats) are left as they are.
+    """
+    # images table path key from the ingest code in ../db
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', 'db'))
+    import ingest_fits
+
+    conn = sqlite3.connect(dbfile)
+
+    # same schema as create_frame_stats_table() in db/ingest_fits.py
+    conn.execute(
+        '''create table if not exists frame_stats
+             ( path           text   primary key not null,
+               median         real,
+               mad            real,
+               clipmean       real,
+               clipstd        real,
+               nsat           int,
+               satlevel       real,
+               nstars         int,
+               fwhm           real);''')
+    have = [row[1] for row in conn.execute('pragma table_info(frame_stats)')]
+    for st_comp in stats:
+        if (db_column(st_comp) not in have):
+            conn.execute('alter table frame_stats add column "{}" {}'.\
+                             format(db_column(st_comp),
+                                    'int' if (st_comp == 'num') else 'real'))
+
+    sets = ', '.join(['"{}" = ?'.format(db_column(st_comp))
+                      for st_comp in stats])
+    for irow, pf in enumerate(st_val['filename']):
+        path = ingest_fits.frame_paths(
+            pf, os.path.dirname(os.path.abspath(pf)))[0]
+        conn.execute('insert or ignore into frame_stats (path) values (?)',
+                     (path,))
+        conn.execute('update frame_stats set {} where path = ?'.format(sets),
+                     [plain_value(st_val[st_comp][irow])
+                      for st_comp in stats] + [path])
+        if (verbose == True):
+            print ('frame_stats {}'.format(path))
 
-                st_val['zidx'].append(zidx)
-                op_line += '{} {:4d} '.format(histline, zidx+1)
+    conn.commit()
+    conn.close()
 
-                # Loop over the stats requested
-                for st_comp in stats:
+    return
 
-                    if (st_comp == 'num'):
-                        cstat = img_shape[1] * img_shape[2]
-                    else:
-                        cstat = compute_stat(st_comp, cdat[zidx])
+def map_files (func, f_files, args, jobs=1):
+    """
+    func(pf, *args) for every file, in a process pool if jobs > 1.
+    Results come back in file order (each one once it and those
+    before it are done).
+    """
+    if ((jobs > 1) and (len(f_files) > 1)):
+        import concurrent.futures as cf
+        with cf.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futs = [pool.submit(func, pf, *args) for pf in f_files]
+            for fut in futs:
+                yield fut.result()
+    else:
+        for pf in f_files:
+            yield func(pf, *args)
 
-                    st_val[st_comp].append(cstat)
-                    op_line += '{} '.format(ru.val_fmt(cstat))
+#------------------------------------------------------------------------
+def img_stats_main (iargv):
+    """
+    Extract a subvolume from a 2-D or 3-D image array and compute stats.
+    """
 
-                op_line += '\n'
+    # Parse the command line
+    fits_input, naxlims, outfile, stats, twodframe, update, \
+        regfile, nsigma, jobs, dbfile, verbose = parse_cmd_line (iargv)
 
-        # Full 2D or 3D region stats
-        else:
-            op_line += '{} '.format(histline)
+    # Get list of files to work on
+    f_files = ru.expand_list_files2(ipfiles=fits_input, echo=verbose)
+    num_files = len(f_files)
 
-            st_val['filename'].append(pf)
+    # Stats in the regions of a region file: one table for all files
+    if (regfile != ''):
+        return img_region_stats (f_files, regfile, outfile, nsigma=nsigma,
+                                 jobs=jobs, verbose=verbose)
 
-            # Loop over the stats requested
-            for st_comp in stats:
-                if (st_comp == 'num'):
-                    if (img_ndim == 2):
-                        cstat = img_shape[0] * img_shape[1]
-                    elif (img_ndim == 3):
-                        cstat = img_shape[0] * img_shape[1] * img_shape[2]
-                else:
-                    cstat = compute_stat(st_comp, cdat)
+    # Stats value(s) dictionary space
+    st_val = {}
+    
+    # setup output stats arrays
+    st_val['filename'] = []
+    for st_comp in stats:
+        st_val[st_comp] = []
 
-#                st_val[st_comp] = cstat
-                st_val[st_comp].append(cstat)
-                op_line += '{} '.format(ru.val_fmt(cstat))
+    tfmt = table_format (outfile)
 
-            op_line += '\n'
+    # Loop through files (in parallel if requested), open, extract roi
+    # and compute stats
+    rows = []
+    for res in map_files (file_stats, f_files,
+                          (naxlims, stats, twodframe, verbose), jobs):
+        if (res == None):
+            continue
 
-        # print (st_val)
+        rows.extend(res['rows'])
 
         # direct output
         if ((outfile == '') or (outfile == 'screen') or
             (outfile == 'stdio')):
             # send to screen
-            print (hdr_line)
-            print (op_line)
+            print (res['hdr_line'])
+            print (res['op_line'])
 
-        elif (outfile == 'skip'):
-            # skip display
+        elif ((outfile == 'skip') or (tfmt != 'text')):
+            # skip display, or written as a table below
             pass
 
         else:
             # write to a file
             with open(outfile, 'a') as fo:
-                fo.write ('{}\n'.format(hdr_line))
-                fo.write ('{}'.format(op_line))
+                fo.write ('{}\n'.format(res['hdr_line']))
+                fo.write ('{}'.format(res['op_line']))
 
         if (update == True):
-            hdr['STAT_REG'] = histline
-
-        # Write stats to image header(s)
-        #        if (update == True):
-        #            rf.write_fits_file (outnam, hdr=hdr, data=cdat)
+            # Write the stat region to the image header, in place
+            rf.update_fits_header (res['filename'],
+                                   {'STAT_REG': res['histline']},
+                                   echo=verbose)
+
+    # Columns - zidx only if some file was done plane by plane
+    cols = ['filename']
+    if (any(['zidx' in row for row in rows])):
+        cols.append('zidx')
+    cols += stats
+    for col in cols:
+        st_val[col] = [row.get(col) for row in rows]
+
+    if (tfmt != 'text'):
+        write_table (outfile, cols, st_val)
+
+    if (dbfile != ''):
+        if ('zidx' in cols):
+            print ('Per frame (-t) stats are not written to the database')
+        else:
+            db_frame_stats (dbfile, stats, st_val, verbose=verbose)
 
     return stats, st_val
 
@@ -8,6 +8,8 @@ Simple Fits I/O utilities:
 Usage: import reduc_utils as ru
 
 Updates:
+2026 Oct 19 - add update_fits_header(), header-only in place update
+2026 Oct 19 - add load_fits_memmap() for large cubes
 2021 Feb 28 - updates to load_fits_hdr()
 2020 Dec 27 - initial version
 """
@@ -16,7 +18,7 @@ __intro__= """\
 A small library of fits routines for use in the image reduction pipeline.
 """
 __author__="Stephen Levine"
-__date__="2021 Feb 28"
+__date__="2026 Oct 19"
 
 #------------------------------------------------------------------------
 from   astropy.io import fits
@@ -56,6 +58,33 @@ def load_fits_file (name=None, mode='readonly', echo=False):
 
     return hdr, dat
 
+def load_fits_memmap (name=None, echo=False):
+    """\
+    Memory map the data of a FITS image file, without loading it.
+    The data are returned unscaled (astropy can not memory map data
+    with BSCALE/BZERO), so planes of a large cube can be read one at
+    a time; physical value = bscale * raw + bzero.
+    Returns hdr, raw data, bscale, bzero.
+    """
+    try:
+        hdu1 = fits.open(name, 'readonly', memmap=True,
+                         do_not_scale_image_data=True)
+        hdr = hdu1[0].header
+        dat = hdu1[0].data
+        bscale = hdr.get('BSCALE', 1.0)
+        bzero = hdr.get('BZERO', 0.0)
+        if (echo != False):
+            hdu1.info()
+
+    except:
+        hdr = None
+        dat = None
+        bscale = 1.0
+        bzero = 0.0
+        print ('Failed to open {}'.format(name))
+
+    return hdr, dat, bscale, bzero
+
 def load_fits_hdr (name=None, mode='readonly', echo=False):
     """\
     Load in a FITS file hdr.
@@ -112,6 +141,47 @@ def write_fits_file (name=None, hdr=None, data=None):
 
     return retval
 
+def update_fits_header (name, keyvals, echo=False):
+    """\
+    Set keywords (dict keyvals) in the primary header of a FITS file,
+    in place.  If the header still fits in its 2880 byte blocks only
+    the header blocks are rewritten, and the data unit is untouched.
+    Otherwise, and for compressed files (gzip, bzip2, zip, or tile
+    compressed .fz) whose bytes are not the header, astropy has to
+    rewrite the file.
+    """
+    with open(name, 'rb') as fp:
+        magic = fp.read(4)
+    compressed = (magic[0:2] == b'\x1f\x8b') or (magic[0:3] == b'BZh') or \
+        (magic == b'PK\x03\x04')
+
+    with fits.open(name, memmap=(compressed == False)) as hdu1:
+        hdr = hdu1[0].header.copy()
+        hdrlen = hdu1.fileinfo(0)['datLoc'] - hdu1.fileinfo(0)['hdrLoc']
+        for hdu in hdu1:
+            if (isinstance(hdu, fits.CompImageHDU)):
+                compressed = True
+
+    for key in keyvals:
+        hdr[key] = keyvals[key]
+
+    # cards, blank cards to fill, END as the last card of the last block
+    cards = hdr.tostring(padding=False, endcard=False)
+    nfill = hdrlen - len(cards) - 80
+    if ((nfill >= 0) and (compressed == False)):
+        with open(name, 'r+b') as fp:
+            fp.write((cards + ' ' * nfill + 'END'.ljust(80)).encode('ascii'))
+        if (echo != False):
+            print ('Updated header of {} in place'.format(name))
+    else:
+        with fits.open(name, mode='update') as hdu1:
+            for key in keyvals:
+                hdu1[0].header[key] = keyvals[key]
+        if (echo != False):
+            print ('Rewrote {} to update its header'.format(name))
+
+    return
+
 def extract_subimage (indat, naxlims=[], isrgb=False, echo=False):
     """\
     Extract a subset of an image cube (either 2 or 3-D)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+__doc__="""\
+reduc_stat_utils.py - Array statistics for the reduction pipeline
+
+Several statistics of an image (or cube) computed together:
+array_stats() - num, min, max, sum, mean, var, std/rms, median, mode,
+                MAD and any percentile (given as pNN, e.g. p99.5)
+sigma_clip_stats() - iteratively sigma clipped mean, median and std
+
+Integer data (e.g. uint16 camera frames) are reduced to a histogram
+with one bincount pass; every statistic, including the order
+statistics (median, mode, percentiles, MAD), then comes exactly from
+the histogram.  Float data fall back to numpy, with all the
+percentiles taken in a single call.
+
+Usage: import reduc_stat_utils as rs
+       st = rs.array_stats(dat, ['median', 'mode', 'p99.5'])
+
+Updates:
+2026 Oct 19 - initial version
+"""
+
+__intro__= """\
+Histogram based statistics of image arrays for use in the image
+reduction pipeline.
+"""
+__author__="Stephen Levine"
+__date__="2026 Oct 19"
+
+#------------------------------------------------------------------------
+import numpy as np
+
+#------------------------------------------------------------------------
+# Integer data spanning more values than this use the float methods
+HIST_MAX_BINS = 1 << 22
+
+STAT_NAMES = ['average', 'mad', 'max', 'mean', 'median', 'min', 'mode',
+              'num', 'rms', 'std', 'sum', 'var']
+
+#------------------------------------------------------------------------
+def percentile_stat (stat_name):
+    """\
+    Percentile requested by a stat name of the form pNN (e.g. p99.5),
+    or None if it is not one.
+    """
+    if ((len(stat_name) > 1) and (stat_name[0] == 'p')):
+        try:
+            pct = float(stat_name[1:])
+        except ValueError:
+            return None
+        if ((pct >= 0.) and (pct <= 100.)):
+            return pct
+    return None
+
+def check_stats (stats):
+    """\
+    Raise ValueError for any stat name array_stats() does not know.
+    """
+    for st_comp in stats:
+        if ((st_comp not in STAT_NAMES) and
+            (percentile_stat(st_comp) == None)):
+            raise ValueError('Unknown statistic {}'.format(st_comp))
+
+def int_histogram (dat):
+    """\
+    Histogram of integer data with one bin per integer value, from
+    the data min to max.
+    Returns counts, offset (the value of bin 0), or None, 0 if the
+    data are not integer or span more than HIST_MAX_BINS values.
+    """
+    dat = np.asarray(dat)
+    if ((dat.dtype.kind not in 'iu') or (dat.size == 0)):
+        return None, 0
+
+    if ((dat.dtype.kind == 'u') and (dat.dtype.itemsize <= 2)):
+        # uint8/uint16 index the bins directly: a single pass
+        counts = np.bincount(dat.ravel())
+        nzidx = np.flatnonzero(counts)
+        return counts[nzidx[0]:nzidx[-1]+1], int(nzidx[0])
+
+    dmin = int(dat.min())
+    dmax = int(dat.max())
+    if (dmax - dmin >= HIST_MAX_BINS):
+        return None, 0
+    counts = np.bincount(np.subtract(dat.ravel(), dmin, dtype=np.int64))
+    return counts, dmin
+
+def hist_quantile (vals, cum, qfrac):
+    """\
+    Quantile qfrac (0-1) of histogrammed data, interpolated between
+    ranks as np.percentile does.
+    vals == value of each bin (ascending), cum == cumulative counts
+    """
+    npix = cum[-1]
+    hpos = (npix - 1) * qfrac
+    klo = int(np.floor(hpos))
+    khi = min(klo + 1, npix - 1)
+    vlo = vals[np.searchsorted(cum, klo, side='right')]
+    vhi = vals[np.searchsorted(cum, khi, side='right')]
+    return float(vlo + (hpos - klo) * (vhi - vlo))
+
+def hist_stats (counts, offset, stats):
+    """\
+    Statistics of integer data from its histogram (see int_histogram).
+    """
+    ivals = np.arange(len(counts), dtype=np.int64) + offset
+    fvals = ivals.astype(np.float64)
+    cum = np.cumsum(counts)
+    npix = int(cum[-1])
+
+    st_val = {}
+    total = int(np.dot(counts, ivals))
+    mean = total / npix
+    var = None
+    median = None
+
+    for st_comp in stats:
+        pct = percentile_stat(st_comp)
+        if (st_comp == 'num'):
+            st_val[st_comp] = npix
+        elif (st_comp == 'min'):
+            st_val[st_comp] = int(ivals[0])
+        elif (st_comp == 'max'):
+            st_val[st_comp] = int(ivals[-1])
+        elif (st_comp == 'sum'):
+            st_val[st_comp] = total
+        elif ((st_comp == 'mean') or (st_comp == 'average')):
+            st_val[st_comp] = mean
+        elif (st_comp in ['var', 'std', 'rms']):
+            if (var == None):
+                var = float(np.dot(counts, (fvals - mean)**2)) / npix
+            st_val[st_comp] = var if (st_comp == 'var') else np.sqrt(var)
+        elif (st_comp == 'mode'):
+            # lowest of equally common values, as scipy.stats.mode
+            st_val[st_comp] = int(ivals[np.argmax(counts)])
+        elif ((st_comp == 'median') or (st_comp == 'mad')):
+            if (median == None):
+                median = hist_quantile(fvals, cum, 0.5)
+            if (st_comp == 'median'):
+                st_val[st_comp] = median
+            else:
+                # median |value - median|, the distances histogrammed
+                # by reordering the same bins
+                dist = np.abs(fvals - median)
+                order = np.argsort(dist, kind='stable')
+                st_val[st_comp] = hist_quantile(dist[order],
+                                                np.cumsum(counts[order]), 0.5)
+        elif (pct != None):
+            st_val[st_comp] = hist_quantile(fvals, cum, pct / 100.)
+
+    return st_val
+
+def float_stats (dat, stats):
+    """\
+    Statistics of (float) data with numpy.  All the order statistics
+    come from one np.percentile call.
+    """
+    flat = np.asarray(dat).ravel()
+
+    # percentiles needed: median (also for mad) and any pNN
+    pcts = []
+    for st_comp in stats:
+        if ((st_comp == 'median') or (st_comp == 'mad')):
+            pcts.append(50.)
+        elif (percentile_stat(st_comp) != None):
+            pcts.append(percentile_stat(st_comp))
+    pcts = sorted(set(pcts))
+    if (pcts != []):
+        pvals = dict(zip(pcts, np.percentile(flat, pcts)))
+
+    st_val = {}
+    for st_comp in stats:
+        pct = percentile_stat(st_comp)
+        if (st_comp == 'num'):
+            st_val[st_comp] = flat.size
+        elif (st_comp == 'min'):
+            st_val[st_comp] = np.min(flat)
+        elif (st_comp == 'max'):
+            st_val[st_comp] = np.max(flat)
+        elif (st_comp == 'sum'):
+            st_val[st_comp] = np.sum(flat)
+        elif ((st_comp == 'mean') or (st_comp == 'average')):
+            st_val[st_comp] = float(np.mean(flat))
+        elif (st_comp == 'var'):
+            st_val[st_comp] = float(np.var(flat))
+        elif ((st_comp == 'std') or (st_comp == 'rms')):
+            st_val[st_comp] = float(np.std(flat))
+        elif (st_comp == 'mode'):
+            uvals, ucnts = np.unique(flat, return_counts=True)
+            st_val[st_comp] = uvals[np.argmax(ucnts)]
+        elif (st_comp == 'median'):
+            st_val[st_comp] = float(pvals[50.])
+        elif (st_comp == 'mad'):
+            st_val[st_comp] = float(np.median(np.abs(flat - pvals[50.])))
+        elif (pct != None):
+            st_val[st_comp] = float(pvals[pct])
+
+    return st_val
+
+def array_stats (dat, stats, echo=False):
+    """\
+    Compute several statistics of an array (any dimension) at once.
+    stats == list of names: average, mad, max, mean, median, min,
+             mode, num, rms, std, sum, var, or pNN for the NN-th
+             percentile (e.g. p0.2, p99.5)
+    Integer data use a single histogram (bincount) pass and give exact
+    results for all of them; float data, or integers spanning more
+    than HIST_MAX_BINS values, use numpy.
+    Returns a dictionary of values by stat name.
+    """
+    check_stats (stats)
+
+    counts, offset = int_histogram (dat)
+    if (counts is not None):
+        if (echo == True):
+            print ('Histogram stats, {} bins from {}'.format(len(counts),
+                                                            offset))
+        return hist_stats (counts, offset, stats)
+
+    if (echo == True):
+        print ('Float stats')
+    return float_stats (dat, stats)
+
+def sigma_clip_stats (dat, nsigma=3.0, maxiter=5):
+    """\
+    Iteratively reject values more than nsigma standard deviations from
+    the median, until none are rejected or maxiter passes.
+    Returns a dictionary with clipmean, clipmedian, clipstd and nclip,
+    the number of values kept.
+    """
+    vals = np.asarray(dat, dtype=np.float64).ravel()
+    vals = vals[np.isfinite(vals)]
+    if (vals.size == 0):
+        return {'clipmean': np.nan, 'clipmedian': np.nan,
+                'clipstd': np.nan, 'nclip': 0}
+
+    center = np.median(vals)
+    for niter in range(maxiter):
+        std = vals.std()
+        if (std == 0):
+            break
+        keep = np.abs(vals - center) < nsigma * std
+        if (keep.all()):
+            break
+        vals = vals[keep]
+        center = np.median(vals)
+
+    return {'clipmean': float(vals.mean()), 'clipmedian': float(center),
+            'clipstd': float(vals.std()), 'nclip': int(vals.size)}
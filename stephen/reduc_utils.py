@@ -61,6 +61,9 @@ import json
 from math import sqrt, cos, pi
 #import math
 
+# Numpy - value types in val_fmt()
+import numpy as np
+
 # For use in sorting by a dictionary key within a list of dictionaries
 from operator import itemgetter
 
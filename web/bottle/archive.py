@@ -0,0 +1,115 @@
+'''
+Streaming zip and tar archives of frames for /download.
+
+Both writers are generators that yield the archive in pieces of at
+most about CHUNK bytes while reading each frame in CHUNK sized blocks,
+so a whole night is never held in memory or staged on disk.
+
+The tar stream is built directly (ustar/pax headers from tarfile,
+data, padding), which also makes its total length known up front.
+Zip members are stored uncompressed (FITS data compresses poorly and
+deflate would make the CPU the bottleneck); zipfile writes to the
+unseekable stream using data descriptors and zip64 where needed.
+'''
+import os
+import tarfile
+import zipfile
+
+CHUNK = 1024 * 1024
+
+FORMATS = ['zip', 'tar']
+
+class _Spool(object):
+    '''
+    Write-only file object collecting what zipfile writes, so the
+    generator can hand it on.  Deliberately not seekable.
+    '''
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self.offset = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.size += len(data)
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+def _read_chunks(path):
+    with open(path, 'rb') as fp:
+        while True:
+            buf = fp.read(CHUNK)
+            if (not buf):
+                break
+            yield buf
+
+def stream_zip(files):
+    '''
+    files == list of (path on disk, name in the archive)
+    Yields the zip archive.
+    '''
+    spool = _Spool()
+    with zipfile.ZipFile(spool, 'w', zipfile.ZIP_STORED) as zf:
+        for path, arcname in files:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname)
+            with zf.open(zinfo, 'w') as member:
+                for buf in _read_chunks(path):
+                    member.write(buf)
+                    if (spool.size >= CHUNK):
+                        yield spool.drain()
+            if (spool.size >= CHUNK):
+                yield spool.drain()
+    yield spool.drain()
+
+def _tar_header(path, arcname):
+    st = os.stat(path)
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mtime = int(st.st_mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT), st.st_size
+
+def tar_size(files):
+    '''
+    Exact length of the stream_tar() output for files.
+    '''
+    total = 2 * tarfile.BLOCKSIZE
+    for path, arcname in files:
+        header, size = _tar_header(path, arcname)
+        total += len(header) + size + (-size % tarfile.BLOCKSIZE)
+    return total
+
+def stream_tar(files):
+    '''
+    files == list of (path on disk, name in the archive)
+    Yields an uncompressed tar archive.
+    '''
+    for path, arcname in files:
+        header, size = _tar_header(path, arcname)
+        yield header
+        sent = 0
+        for buf in _read_chunks(path):
+            # Never send more than the header promised, even if the
+            # file grew meanwhile.
+            buf = buf[:size - sent]
+            sent += len(buf)
+            yield buf
+            if (sent >= size):
+                break
+        if (sent < size):
+            # File shrank meanwhile: keep the archive well formed.
+            yield bytes(size - sent)
+        yield bytes(-size % tarfile.BLOCKSIZE)
+    yield bytes(2 * tarfile.BLOCKSIZE)
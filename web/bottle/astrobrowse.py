@@ -3,49 +3,265 @@ import sqlite3
 from bottle import route, static_file, run, debug, template, url
 import bottle
 import os
+import socketserver
+import sys
+from wsgiref.simple_server import WSGIServer
 from os import listdir
 from os.path import isdir, join
 
-app = application = bottle.Bottle()
+# Pointing index queries live with the ingest code in ../../db
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)),
+                     "..", "..", "db"))
+import cone_search
+import query_frames
+import archive
+import feed
+import framedb
+import httpfiles
+import metrics
+import previews
+
+app = bottle.Bottle()
+# Templates build links against this app's named routes, not the default app.
+url = app.get_url
 
 @app.route('/data/<filepath:path>', name='data')
 def server_static(filepath):
-    return bottle.static_file(filepath, root='./data')
+    # Thumbnails fitsToThumb has not made yet are rendered on demand.
+    if (filepath.endswith('.png') and
+        (not os.path.exists(join('data', filepath)))):
+        fitspath = filepath[:-4] + '.fit'
+        if (framedb.query('select 1 from images where path=?', (fitspath,))):
+            return frame_preview(fitspath)
+    # ETag/304, Range and precompressed .gz handling in httpfiles.
+    return httpfiles.serve_file(filepath, root='./data')
 
 @app.route('/assets/<filepath:path>', name='assets')
 def server_static(filepath):
-    return bottle.static_file(filepath, root='./assets')
+    return httpfiles.serve_file(filepath, root='./assets')
+
+@app.route('/astrobrowse/color')
+def show_color():
+    # Gallery of the color composites recorded by makeColor.py.
+    # Cached until the next database commit.
+    output = template('templates/color', url=url,
+      colorlist=framedb.color_products())
+    return output
 
 @app.route('/astrobrowse')
 @app.route('/astrobrowse/<date>')
 def astro_browse(date='UT20210227'):
-    # Get a list of the daily directories.
-    onlydirs = [f for f in listdir("data") if (isdir(join("data", f)) and f != "color")]
-    onlydirs.sort()
+    # Get a list of the daily directories (cached until data/ changes).
+    onlydirs = framedb.night_dirs()
     # move this date to the top of the list.
-    onlydirs.insert(0, onlydirs.pop(onlydirs.index(date)))
+    if (date in onlydirs):
+        onlydirs.insert(0, onlydirs.pop(onlydirs.index(date)))
     # restructure the date for database
     year = date[2:6]
     month = date[6:8]
     day = date[8:]
     date = year + "-" + month + "-" + day
-    print("date = " + date)
-    conn = sqlite3.connect('PW17QSI.db')
-    c = conn.cursor()
-    c.execute("select name,dateobs,naxis1,exptime,filter, \
-                 imagetyp,thumbpath FROM images \
-                 where dateobs >= date(?) \
-                 and dateobs <  date(?, '+1 day') order by imagetyp desc",(date, date,))
-                # where imagetyp='Light Frame' \
-
-    result = c.fetchall()
-    print(result)
-    c.close()
+    # cached per night until the next ingest commits
+    result = framedb.night_frames(date)
 
     output = template('templates/main', url=url, dirlist=onlydirs,
-      imlist = result)
+      imlist = result, feed=url('feed'))
+    return output
+
+@app.route('/astrobrowse/search', name='search')
+def astro_search():
+    # Cone search on the pointing index: ?ra=&dec=&radius=
+    # ra/dec in degrees or sexagesimal (ra in hours; '5.5h' / '82.5d'
+    # for plain ra in hours or degrees), radius in degrees.
+    ra_txt = bottle.request.query.get('ra', '').strip()
+    dec_txt = bottle.request.query.get('dec', '').strip()
+    try:
+        radius = float(bottle.request.query.get('radius', '0') or 0)
+    except ValueError:
+        radius = 0.0
+    ra = cone_search.parse_sexagesimal(ra_txt,
+        hours=(':' in ra_txt or ' ' in ra_txt))
+    dec = cone_search.parse_sexagesimal(dec_txt)
+
+    result = []
+    if ((ra != None) and (dec != None)):
+        with framedb.lock(), metrics.sql_timer():
+            conn = framedb.connection()
+            matches = cone_search.cone_search(conn, ra, dec, radius)
+            for path, fra, fdec, sep in matches:
+                row = conn.execute("select name,dateobs,naxis1,exptime, \
+                         filter,imagetyp,thumbpath FROM images where path=?",
+                                   (path,)).fetchone()
+                if (row != None):
+                    result.append(row + ('{:.4f}'.format(sep),))
+
+    output = template('templates/search', url=url, ra=ra_txt, dec=dec_txt,
+      radius=radius, imlist=result)
     return output
 
+@app.route('/preview/<frame:path>', name='preview')
+def frame_preview(frame):
+    # PNG preview of an ingested frame: ?size=<width>&stretch=<name>
+    # Rendered from the FITS file on a cache miss, then redirected to
+    # its immutable content-addressed /previews/ URL.
+    if (not framedb.query('select 1 from images where path=?', (frame,))):
+        raise bottle.HTTPError(404, 'unknown frame')
+    size = query_number('size', int)
+    if (size == None):
+        size = previews.DEFAULT_SIZE
+    size = min(max(size, previews.MIN_SIZE), previews.MAX_SIZE)
+    stretch = bottle.request.query.get('stretch', 'linear')
+    if (stretch not in previews.STRETCHES):
+        raise bottle.HTTPError(400, 'stretch must be one of {}'.format(
+            ', '.join(previews.STRETCHES)))
+
+    fitsfile = join('data', frame)
+    if (not os.path.exists(fitsfile)):
+        raise bottle.HTTPError(404, 'frame file missing')
+    name = previews.preview_file(fitsfile, size, stretch)[1]
+    bottle.redirect(url('previews', name=name), 302)
+
+@app.route('/previews/<name>', name='previews')
+def cached_preview(name):
+    # Content-addressed preview files (linked from /preview/):
+    # never change once written.
+    return httpfiles.serve_file(name, root=previews.CACHE_DIR,
+                                mimetype='image/png',
+                                cache_control=httpfiles.IMMUTABLE_CACHE)
+
+@app.route('/download/<night>', name='download')
+def night_download(night):
+    # Stream a night's frames as one archive:
+    # ?imagetyp=&filter=&format=zip|tar
+    if (night not in framedb.night_dirs()):
+        raise bottle.HTTPError(404, 'unknown night')
+    q = bottle.request.query
+    fmt = q.get('format', 'zip')
+    if (fmt not in archive.FORMATS):
+        raise bottle.HTTPError(400, 'format must be one of {}'.format(
+            ', '.join(archive.FORMATS)))
+
+    # Frame list from the dateobs/imagetyp/filter indexes.
+    sql, params = query_frames.build_query(['path'], night=night,
+        imagetyp=q.getunicode('imagetyp') or None,
+        filt=q.getunicode('filter') or None, order='dateobs, path',
+        duplicates=not framedb.has_duplicate_column())
+    files = []
+    for (path,) in framedb.query(sql, params):
+        if (os.path.isfile(join('data', path))):
+            files.append((join('data', path), path))
+    if (len(files) == 0):
+        raise bottle.HTTPError(404, 'no frames match')
+
+    bottle.response.set_header('Content-Disposition',
+        'attachment; filename="{}.{}"'.format(night, fmt))
+    if (fmt == 'tar'):
+        bottle.response.content_type = 'application/x-tar'
+        bottle.response.content_length = archive.tar_size(files)
+        return archive.stream_tar(files)
+    # zip length is not known ahead: sent chunked
+    bottle.response.content_type = 'application/zip'
+    return archive.stream_zip(files)
+
+def json_response(body, etag):
+    # Send a cached JSON body, or 304 if the client already has it.
+    bottle.response.content_type = 'application/json'
+    bottle.response.set_header('ETag', etag)
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    inm = bottle.request.headers.get('If-None-Match', '')
+    if ((inm.strip() == '*') or
+        (etag in [t.strip() for t in inm.split(',')])):
+        bottle.response.status = 304
+        return b''
+    return body
+
+def query_number(name, cast):
+    # Optional numeric query parameter; 400 if it does not parse.
+    value = bottle.request.query.get(name, '').strip()
+    if (value == ''):
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        raise bottle.HTTPError(400, 'bad value for {}'.format(name))
+
+def query_limit():
+    limit = query_number('limit', int)
+    if (limit == None):
+        limit = 100
+    return min(max(limit, 1), framedb.MAX_LIMIT)
+
+@app.route('/api/frames')
+def api_frames():
+    # Keyset-paginated frame list.
+    # Filters: night, imagetyp, filter, object, exptime_min, exptime_max,
+    #          binning.  sort=<column>, order=asc|desc, after=<next cursor>,
+    #          limit=<rows>
+    q = bottle.request.query
+    filters = {}
+    for key in ('night', 'imagetyp', 'filter', 'object'):
+        if (q.get(key)):
+            filters[key] = q.getunicode(key)
+    for key in ('exptime_min', 'exptime_max'):
+        value = query_number(key, float)
+        if (value != None):
+            filters[key] = value
+    value = query_number('binning', int)
+    if (value != None):
+        filters['binning'] = value
+
+    sort = q.get('sort', 'dateobs')
+    if (sort not in framedb.SORT_COLUMNS):
+        raise bottle.HTTPError(400, 'sort must be one of {}'.format(
+            ', '.join(framedb.SORT_COLUMNS)))
+    desc = (q.get('order', 'asc') == 'desc')
+
+    after = None
+    if (q.get('after')):
+        try:
+            after = framedb.decode_cursor(q.get('after'), sort)
+        except ValueError:
+            raise bottle.HTTPError(400, 'bad cursor')
+
+    body, etag = framedb.frames_json(filters, sort=sort, desc=desc,
+                                     after=after, limit=query_limit())
+    return json_response(body, etag)
+
+@app.route('/api/nights')
+def api_nights():
+    # Nights newest first; after=<night> for the next page.
+    after = bottle.request.query.get('after') or None
+    body, etag = framedb.nights_json(after=after, limit=query_limit())
+    return json_response(body, etag)
+
+@app.route('/api/feed', name='feed')
+def api_feed():
+    # Server-sent events, one 'frame' event per newly ingested frame.
+    # A reconnecting EventSource resumes from its Last-Event-ID.
+    # The poller thread has no request context to build URLs in.
+    prefix = url('preview', frame='')
+    feed.start(lambda path: prefix + path)
+    last_id = None
+    try:
+        last_id = int(bottle.request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        pass
+    bottle.response.content_type = 'text/event-stream'
+    bottle.response.set_header('Cache-Control', 'no-cache')
+    # Keep proxies (nginx) from buffering the stream.
+    bottle.response.set_header('X-Accel-Buffering', 'no')
+    return feed.stream(last_id)
+
+@app.route('/metrics')
+def show_metrics():
+    # Prometheus scrape endpoint; only answered to scrapers sending the
+    # ASTROBROWSE_METRICS_TOKEN bearer token (the client address can't
+    # be trusted: behind the proxy every request is from loopback).
+    if (not metrics.authorized(bottle.request.environ)):
+        raise bottle.HTTPError(403, 'metrics need the scrape token')
+    bottle.response.content_type = 'text/plain; version=0.0.4'
+    return metrics.render()
+
 class StripPathMiddleware(object):
     '''
     Get that slash out of the request
@@ -56,9 +272,20 @@ class StripPathMiddleware(object):
         e['PATH_INFO'] = e['PATH_INFO'].rstrip('/')
         return self.a(e, h)
 
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    '''
+    wsgiref server with a thread per request, so open /api/feed
+    streams don't block the other requests.
+    '''
+    daemon_threads = True
+
+# The WSGI entry point (wsgi.py and __main__ both serve this).
+application = metrics.MetricsMiddleware(StripPathMiddleware(app))
+
 if (__name__ == "__main__"):
-  bottle.run(app=StripPathMiddleware(app),
+  bottle.run(app=application,
       reloader = True,
       host='0.0.0.0',
       port=6000,
+      server_class=ThreadingWSGIServer,
       debug=True)
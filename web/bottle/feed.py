@@ -0,0 +1,132 @@
+'''
+Live feed of newly ingested frames for /api/feed (server-sent events).
+
+One poller thread per process watches the images table and turns new
+rows into events; every connected client just waits on a condition
+variable and is handed the events it has not seen.  Polling is cheap:
+PRAGMA data_version tells whether anything was committed since the
+last look, and only then is the table read past the rowid high-water
+mark.  So N observers cost one small query per ingest, not N page loads.
+
+Event ids are image rowids, so a reconnecting EventSource resumes
+from Last-Event-ID, as long as the event is still in the backlog.
+'''
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import framedb
+
+# Seconds between checks for new rows.
+POLL_INTERVAL = 2.0
+# Seconds of silence before a keep-alive comment is sent.
+HEARTBEAT = 15.0
+# Recent events kept for clients that fall behind or reconnect.
+BACKLOG = 1000
+# Rows read per poll at most; the rest follow on the next poll.
+BATCH = 500
+
+_cond = threading.Condition()
+_events = deque(maxlen=BACKLOG)
+_high = None
+_thread = None
+_preview_url = None
+
+def _poll_once(last_gen):
+    '''
+    Queue events for rows past the high-water mark.
+    Returns the database generation seen.
+    '''
+    global _high
+    gen = framedb.generation()
+    if (gen == last_gen):
+        return gen
+
+    cols = ', '.join(framedb.FRAME_COLUMNS)
+    # (no copies are marked in databases from before duplicate_of)
+    dup = 'duplicate_of' if framedb.has_duplicate_column() else 'null'
+    while True:
+        rows = framedb.query('select rowid, ' + dup + ', ' + cols +
+                             ' from images where rowid > ? order by rowid' +
+                             ' limit ?', (_high, BATCH))
+        if (len(rows) == 0):
+            break
+        new = []
+        for row in rows:
+            # Copies of an earlier frame are not news.
+            if (row[1] == None):
+                frame = dict(zip(framedb.FRAME_COLUMNS, row[2:]))
+                if (_preview_url != None):
+                    frame['preview'] = _preview_url(frame['path'])
+                new.append((row[0], json.dumps(frame,
+                                               separators=(',', ':'))))
+        with _cond:
+            _high = rows[-1][0]
+            _events.extend(new)
+            _cond.notify_all()
+        if (len(rows) < BATCH):
+            break
+    return gen
+
+def _run():
+    gen = None
+    while True:
+        try:
+            gen = _poll_once(gen)
+        except sqlite3.Error:
+            # Database busy or replaced; try again next interval.
+            gen = None
+        time.sleep(POLL_INTERVAL)
+
+def start(preview_url=None):
+    '''
+    Start the shared poller (once per process).
+    preview_url == optional function path -> preview URL for events
+    '''
+    global _thread, _preview_url, _high
+    with _cond:
+        if (_thread == None):
+            _preview_url = preview_url
+            _high = framedb.query('select coalesce(max(rowid), 0) \
+                                   from images')[0][0]
+            _thread = threading.Thread(target=_run, name='frame-feed',
+                                       daemon=True)
+            _thread.start()
+
+def _pending(last_id):
+    '''
+    Events after last_id, oldest first.  Called with _cond held.
+    '''
+    out = []
+    for event in reversed(_events):
+        if (event[0] <= last_id):
+            break
+        out.append(event)
+    out.reverse()
+    return out
+
+def stream(last_id=None):
+    '''
+    Generator of server-sent-event text for one client, starting after
+    rowid last_id (default: only frames ingested from now on).
+    '''
+    if (last_id == None):
+        last_id = _high
+    yield b'retry: 5000\n\n'
+    while True:
+        with _cond:
+            pending = _pending(last_id)
+            if (len(pending) == 0):
+                _cond.wait(HEARTBEAT)
+                pending = _pending(last_id)
+        if (len(pending) == 0):
+            yield b': keep-alive\n\n'
+            continue
+        parts = []
+        for rowid, data in pending:
+            parts.append('id: {}\nevent: frame\ndata: {}\n\n'.format(rowid,
+                                                                     data))
+            last_id = rowid
+        yield ''.join(parts).encode()
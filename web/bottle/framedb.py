@@ -0,0 +1,292 @@
+'''
+Shared, cached access to the images database for astrobrowse.
+
+One read-only sqlite connection is opened per process and reused by
+every request (serialised with a lock, so it also works under a
+threaded server).  Query results are cached per process and dropped
+whenever the database generation changes: sqlite bumps
+PRAGMA data_version on this connection each time another connection
+(i.e. an ingest run) commits, so no extra bookkeeping is needed on
+the ingest side.
+'''
+import base64
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from os import listdir, stat
+from os.path import isdir, join
+
+import metrics
+import query_frames
+
+DB_FILE = 'PW17QSI.db'
+DATA_DIR = 'data'
+
+# Nights of query results kept in the cache.
+MAX_CACHED = 64
+
+_lock = threading.RLock()
+_conn = None
+_generation = None
+_cache = OrderedDict()
+_nights = (None, [])
+
+def connection():
+    '''
+    The shared read-only connection; opened on first use.
+    Callers must hold lock() while using it.
+    '''
+    global _conn
+    if (_conn == None):
+        _conn = sqlite3.connect('file:{}?mode=ro'.format(DB_FILE), uri=True,
+                                check_same_thread=False)
+    return _conn
+
+def lock():
+    return _lock
+
+def generation():
+    '''
+    Current database generation.  Clears the query cache when it
+    has moved on since the last call.
+    '''
+    global _generation
+    with _lock:
+        gen = connection().execute('pragma data_version').fetchone()[0]
+        if (gen != _generation):
+            _cache.clear()
+            _generation = gen
+        return gen
+
+def cached(key, compute):
+    '''
+    Return the cached value for key, computing (and caching) it with
+    compute(conn) on a miss.  Valid for the current generation only.
+    '''
+    with _lock:
+        generation()
+        if (key in _cache):
+            _cache.move_to_end(key)
+            return _cache[key]
+        with metrics.sql_timer():
+            value = compute(connection())
+        _cache[key] = value
+        while (len(_cache) > MAX_CACHED):
+            _cache.popitem(last=False)
+        return value
+
+def query(sql, params=()):
+    '''
+    Run a query on the shared connection and return all the rows.
+    '''
+    with _lock, metrics.sql_timer():
+        return connection().execute(sql, params).fetchall()
+
+def has_duplicate_column():
+    '''
+    True if images has the duplicate_of column (databases not
+    ingested since it was added don't, and this connection can't add
+    it).  Cached per generation.
+    '''
+    return cached('has_duplicate_of',
+                  lambda conn: query_frames.has_column(conn, 'duplicate_of'))
+
+def night_dirs():
+    '''
+    Sorted list of the nightly directories under data/.  Re-read
+    only when the data directory itself changes (a night is added or
+    removed), which costs one stat per request instead of a listdir
+    plus an isdir per entry.
+    '''
+    global _nights
+    mtime = stat(DATA_DIR).st_mtime_ns
+    if (_nights[0] != mtime):
+        dirs = [f for f in listdir(DATA_DIR)
+                if (isdir(join(DATA_DIR, f)) and f != 'color')]
+        dirs.sort()
+        _nights = (mtime, dirs)
+    return list(_nights[1])
+
+def night_frames(date):
+    '''
+    Frames observed on the UT date (YYYY-MM-DD) for the main table.
+    Uses the images(dateobs) index created by the ingest.
+    '''
+    def compute(conn):
+        return conn.execute("select name,dateobs,naxis1,exptime,filter, \
+                 imagetyp,thumbpath FROM images \
+                 where dateobs >= date(?) \
+                 and dateobs <  date(?, '+1 day') order by imagetyp desc",
+                            (date, date,)).fetchall()
+    return cached(('night', date), compute)
+
+def color_products():
+    '''
+    Color composites for the gallery, newest first (empty until
+    makeColor.py or color_products.py --rebuild has made the table).
+    '''
+    def compute(conn):
+        try:
+            return conn.execute('select path, previewpath, previewwidth, \
+                     previewheight, width, height, red, green, blue, created \
+                     from color_products order by created desc, path') \
+                     .fetchall()
+        except sqlite3.OperationalError:
+            return []
+    return cached('color', compute)
+
+#------------------------------------------------------------------------
+# JSON API queries (/api/frames, /api/nights)
+
+# Columns returned by /api/frames, in order.
+FRAME_COLUMNS = ['name', 'path', 'thumbpath', 'dateobs', 'exptime',
+                 'filter', 'imagetyp', 'object', 'xbinning', 'ybinning',
+                 'naxis1', 'naxis2']
+
+# Columns /api/frames can sort on, and the keyset each sorts by (rowid
+# is appended as the final tiebreak).  Each keyset matches an index the
+# ingest creates: (dateobs), (exptime) and (name) carry the rowid
+# implicitly, and filter/imagetyp/object are indexed as (col, dateobs),
+# so a sort (alone, or with its own column as the filter) is read in
+# index order rather than through a temporary b-tree.
+SORT_KEYS = {'dateobs': ['dateobs'],
+             'exptime': ['exptime'],
+             'name': ['name'],
+             'filter': ['filter', 'dateobs'],
+             'imagetyp': ['imagetyp', 'dateobs'],
+             'object': ['object', 'dateobs']}
+SORT_COLUMNS = list(SORT_KEYS)
+
+MAX_LIMIT = 1000
+
+def encode_cursor(values):
+    '''
+    Opaque keyset cursor: the sort key values and rowid of the last row.
+    '''
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(text, sort='dateobs'):
+    '''
+    Inverse of encode_cursor() for a cursor of the given sort.
+    Raises ValueError if malformed.
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError('bad cursor')
+    if ((type(values) is not list) or
+        (len(values) != len(SORT_KEYS[sort]) + 1)):
+        raise ValueError('bad cursor')
+    return values
+
+def frames_query(filters, sort='dateobs', desc=False, after=None, limit=100,
+                 unique=True):
+    '''
+    Build the keyset-paginated /api/frames query.
+    filters == dict with any of night, imagetyp, filter, object,
+               exptime_min, exptime_max, binning
+    unique == leave out copies of earlier frames (needs duplicate_of)
+    Returns (sql, params); the query asks for limit+1 rows so the
+    caller can tell whether there is another page.
+    '''
+    where = ['duplicate_of is null'] if unique else ['1']
+    params = []
+    if (filters.get('night') != None):
+        # same night syntax as query_frames.py
+        night = query_frames.night_to_date(filters['night'])
+        where.append("dateobs >= date(?) and dateobs < date(?, '+1 day')")
+        params.extend([night, night])
+    for key in ('imagetyp', 'filter', 'object'):
+        if (filters.get(key) != None):
+            where.append(key + ' = ?')
+            params.append(filters[key])
+    if (filters.get('exptime_min') != None):
+        where.append('exptime >= ?')
+        params.append(filters['exptime_min'])
+    if (filters.get('exptime_max') != None):
+        where.append('exptime <= ?')
+        params.append(filters['exptime_max'])
+    if (filters.get('binning') != None):
+        where.append('xbinning = ? and ybinning = ?')
+        params.extend([filters['binning'], filters['binning']])
+
+    direction = 'desc' if desc else 'asc'
+    keys = SORT_KEYS[sort] + ['rowid']
+    if (after != None):
+        where.append('({}) {} ({})'.format(', '.join(keys),
+                                           '<' if desc else '>',
+                                           ', '.join(['?'] * len(keys))))
+        params.extend(after)
+
+    sql = 'select rowid, ' + ', '.join(FRAME_COLUMNS) + ' from images' + \
+        ' where ' + ' and '.join(where) + ' order by ' + \
+        ', '.join([key + ' ' + direction for key in keys]) + ' limit ?'
+    params.append(limit + 1)
+    return sql, params
+
+def frames_json(filters, sort='dateobs', desc=False, after=None, limit=100):
+    '''
+    One page of /api/frames as compact JSON plus its ETag.
+    Cached per generation and query.
+    Returns (body bytes, etag)
+    '''
+    key = ('api_frames', tuple(sorted(filters.items())), sort, desc,
+           None if (after == None) else tuple(after), limit)
+
+    def compute(conn):
+        sql, params = frames_query(filters, sort, desc, after, limit,
+                                   unique=has_duplicate_column())
+        rows = conn.execute(sql, params).fetchall()
+        nxt = None
+        if (len(rows) > limit):
+            rows = rows[:limit]
+            last = rows[-1]
+            nxt = encode_cursor([last[1 + FRAME_COLUMNS.index(key)]
+                                 for key in SORT_KEYS[sort]] + [last[0]])
+        doc = {'columns': FRAME_COLUMNS,
+               'rows': [list(r[1:]) for r in rows],
+               'next': nxt}
+        return json_body(doc)
+
+    return cached(key, compute)
+
+def nights_json(after=None, limit=100):
+    '''
+    One page of /api/nights (night directory, frame count, first and
+    last DATE-OBS), newest first, with keyset pagination on the night.
+    Returns (body bytes, etag)
+    '''
+    def compute_all(conn):
+        where = 'where duplicate_of is null' if has_duplicate_column() \
+            else ''
+        return conn.execute("select substr(path, 1, instr(path, '/') - 1) \
+                as night, count(*), min(dateobs), max(dateobs) \
+                from images " + where + " \
+                group by night order by night desc").fetchall()
+
+    def compute(conn):
+        nights = cached('nights', compute_all)
+        if (after != None):
+            nights = [n for n in nights if (n[0] < after)]
+        page = nights[:limit]
+        nxt = None
+        if (len(nights) > limit):
+            nxt = page[-1][0]
+        doc = {'columns': ['night', 'count', 'first', 'last'],
+               'rows': [list(n) for n in page],
+               'next': nxt}
+        return json_body(doc)
+
+    return cached(('api_nights', after, limit), compute)
+
+def json_body(doc):
+    '''
+    Compact JSON body and a strong ETag computed from it.
+    '''
+    body = json.dumps(doc, separators=(',', ':')).encode()
+    etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+    return body, etag
@@ -0,0 +1,149 @@
+'''
+Static file responses with HTTP caching for astrobrowse.
+
+serve_file() is a drop-in for bottle.static_file() that adds
+- a strong ETag from the file size and mtime, and Cache-Control
+- 304 Not Modified for If-None-Match / If-Modified-Since
+- single byte-range requests (206, 416, If-Range), so large FITS
+  downloads can be resumed
+- precompressed variants: if <file>.gz exists, is at least as new, and
+  the client accepts gzip, it is sent with Content-Encoding: gzip
+'''
+import mimetypes
+import os
+
+import bottle
+
+# Thumbnails and frames may be regenerated, so revalidate hourly.
+DATA_CACHE = 'public, max-age=3600'
+# Content-addressed files (the name changes when the content does).
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+CHUNK = 64 * 1024
+
+mimetypes.add_type('application/fits', '.fit')
+mimetypes.add_type('application/fits', '.fits')
+
+def file_etag(st, suffix=''):
+    '''
+    Strong validator from size and mtime (ns).
+    '''
+    return '"{:x}-{:x}{}"'.format(st.st_size, st.st_mtime_ns, suffix)
+
+def etag_matches(header, etag):
+    '''
+    True if an If-None-Match header lists etag (or is *), by the weak
+    comparison: W/ tags match too.
+    '''
+    if (header.strip() == '*'):
+        return True
+    tags = [t.strip() for t in header.split(',')]
+    return ((etag in tags) or (('W/' + etag) in tags))
+
+def etag_strong_match(header, etag):
+    '''
+    True if an If-Range header is exactly etag.  If-Range needs the
+    strong comparison (RFC 7233): weak tags never match.
+    '''
+    tag = header.strip()
+    return ((not tag.startswith('W/')) and (not etag.startswith('W/')) and
+            (tag == etag))
+
+def _range_iter(fp, offset, length):
+    try:
+        fp.seek(offset)
+        while (length > 0):
+            buf = fp.read(min(CHUNK, length))
+            if (not buf):
+                break
+            length -= len(buf)
+            yield buf
+    finally:
+        fp.close()
+
+def serve_file(filename, root, mimetype=None, cache_control=DATA_CACHE,
+               etag=None):
+    '''
+    Serve root/filename with validators, conditional and range support.
+    etag == optional validator to use instead of size/mtime.
+    Returns a bottle HTTPResponse (or HTTPError).
+    '''
+    environ = bottle.request.environ
+    root = os.path.join(os.path.abspath(root), '')
+    path = os.path.abspath(os.path.join(root, filename.strip('/\\')))
+    if (not path.startswith(root)):
+        return bottle.HTTPError(403, 'Access denied.')
+    if (not os.path.isfile(path)):
+        return bottle.HTTPError(404, 'File does not exist.')
+    if (not os.access(path, os.R_OK)):
+        return bottle.HTTPError(403, 'No permission to access the file.')
+
+    headers = {'Accept-Ranges': 'bytes', 'Cache-Control': cache_control}
+    if (mimetype == None):
+        mimetype = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+    headers['Content-Type'] = mimetype
+
+    # Precompressed variant
+    suffix = ''
+    gz = path + '.gz'
+    if (os.path.isfile(gz)):
+        headers['Vary'] = 'Accept-Encoding'
+        if (('gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')) and
+            (os.stat(gz).st_mtime >= os.stat(path).st_mtime)):
+            path = gz
+            suffix = '-gz'
+            headers['Content-Encoding'] = 'gzip'
+
+    st = os.stat(path)
+    if (etag == None):
+        etag = file_etag(st, suffix)
+    headers['ETag'] = etag
+    headers['Last-Modified'] = bottle.http_date(st.st_mtime)
+
+    # Conditional GET: If-None-Match takes precedence over the date.
+    inm = environ.get('HTTP_IF_NONE_MATCH')
+    if (inm != None):
+        if (etag_matches(inm, etag)):
+            return bottle.HTTPResponse(status=304, headers=headers)
+    else:
+        ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if (ims != None):
+            ims = bottle.parse_date(ims.split(';')[0].strip())
+            if ((ims != None) and (ims >= int(st.st_mtime))):
+                return bottle.HTTPResponse(status=304, headers=headers)
+
+    size = st.st_size
+    fp = None if (environ['REQUEST_METHOD'] == 'HEAD') else open(path, 'rb')
+
+    # Byte ranges, unless If-Range says the client's copy is stale.
+    rng = environ.get('HTTP_RANGE')
+    if_range = environ.get('HTTP_IF_RANGE')
+    if ((rng != None) and (if_range != None)):
+        if (if_range.strip().startswith('"') or
+            if_range.strip().startswith('W/')):
+            if (not etag_strong_match(if_range, etag)):
+                rng = None
+        else:
+            ird = bottle.parse_date(if_range)
+            if ((ird == None) or (ird < int(st.st_mtime))):
+                rng = None
+
+    if ((rng != None) and rng.strip().startswith('bytes=')):
+        ranges = list(bottle.parse_range_header(rng, size))
+        if (len(ranges) == 0):
+            if (fp != None):
+                fp.close()
+            headers['Content-Range'] = 'bytes */{}'.format(size)
+            return bottle.HTTPResponse(status=416, headers=headers)
+        if (len(ranges) == 1):
+            start, end = ranges[0]
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end - 1,
+                                                               size)
+            headers['Content-Length'] = str(end - start)
+            body = '' if (fp == None) else _range_iter(fp, start, end - start)
+            return bottle.HTTPResponse(body, status=206, headers=headers)
+        # Multiple ranges: send the whole file instead.
+
+    headers['Content-Length'] = str(size)
+    return bottle.HTTPResponse('' if (fp == None) else fp, headers=headers)
@@ -0,0 +1,397 @@
+#!/usr/bin/python3
+'''
+Load test for astrobrowse against a synthetic archive.
+
+Build an archive of N nights x M small frames (FITS files, PNG
+thumbnails and a database made by the real ingest code):
+
+    python3 loadtest.py /tmp/archive -build -nights 30 -frames 200
+
+then run C simulated browsers against it for a while and report the
+throughput and the p50/p95/p99 latency per route:
+
+    python3 loadtest.py /tmp/archive -clients 8 -duration 30
+    python3 loadtest.py /tmp/archive -clients 8 -mode http
+    python3 loadtest.py -url http://localhost:6000 -clients 8
+
+-mode wsgi calls the app in-process (no sockets, measures the app
+alone); -mode http serves it from a threaded server on localhost and
+goes through HTTP; -url targets an already running server.  The
+browsers find nights and frames through /api/nights and /api/frames,
+so any archive can be targeted.
+'''
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+from os.path import abspath, dirname, join
+
+import numpy as np
+from astropy.io import fits
+from PIL import Image
+
+WEB_DIR = dirname(abspath(__file__))
+sys.path.append(join(WEB_DIR, '..', '..', 'db'))
+
+IMAGETYPES = ['Light Frame', 'Light Frame', 'Light Frame', 'Bias Frame',
+              'Dark Frame', 'Flat Field']
+FILTERS = ['Red', 'Green', 'Blue', 'Lum']
+OBJECTS = [('M1', '05 34 31.94', '+22 00 52.2'),
+           ('M42', '05 35 17.30', '-05 23 28.0'),
+           ('M51', '13 29 52.70', '+47 11 43.0'),
+           ('M57', '18 53 35.08', '+33 01 45.0')]
+
+#------------------------------------------------------------------------
+# Synthetic archive
+
+def night_name(i, first=(2021, 1, 1)):
+    day = np.datetime64('{:04d}-{:02d}-{:02d}'.format(*first)) + i
+    return 'UT' + str(day).replace('-', '')
+
+def fake_frame(rng, night, i, size):
+    '''
+    Small frame with a MaxIm-like header for the ingest.
+    Returns (uint16 data, header)
+    '''
+    imtype = IMAGETYPES[i % len(IMAGETYPES)]
+    name, ra, dec = OBJECTS[(i // 10) % len(OBJECTS)]
+    data = rng.normal(1000.0, 10.0, (size, size))
+    if (imtype == 'Light Frame'):
+        for k in range(5):
+            y, x = rng.integers(2, size - 2, 2)
+            data[y - 1:y + 2, x - 1:x + 2] += 3000.0
+    date = night[2:6] + '-' + night[6:8] + '-' + night[8:]
+    hdr = fits.Header()
+    for key, value in (('DATE-OBS', '{}T{:02d}:{:02d}:{:02d}'.format(
+                            date, (i // 3600) % 24, (i // 60) % 60, i % 60)),
+                       ('EXPTIME', float(rng.choice([1, 10, 60, 120]))),
+                       ('CCD-TEMP', -20.0), ('XBINNING', 1), ('YBINNING', 1),
+                       ('XORGSUBF', 0), ('YORGSUBF', 0),
+                       ('READOUTM', 'Fast'), ('ISOSPEED', '0'),
+                       ('FILTER', FILTERS[i % len(FILTERS)]),
+                       ('IMAGETYP', imtype), ('EGAIN', 1.2),
+                       ('OBJECT', name), ('OBJCTRA', ra), ('OBJCTDEC', dec),
+                       ('JD', 2459215.5 + i / 86400.0),
+                       ('JD-HELIO', 2459215.5 + i / 86400.0)):
+        hdr[key] = value
+    return np.clip(data, 0, 65535).astype(np.uint16), hdr
+
+def build_archive(archive, nights, frames, size=64, seed=1):
+    '''
+    Write archive/data/<night>/*.fit plus .png thumbnails and ingest
+    them into archive/PW17QSI.db with the regular ingest code.
+    '''
+    import cone_search
+    import ingest_fits
+
+    os.makedirs(join(archive, 'data'), exist_ok=True)
+    conn = sqlite3.connect(join(archive, 'PW17QSI.db'))
+    # Throwaway database: skip the fsync per commit.
+    conn.execute('pragma synchronous=off')
+    cursor = conn.cursor()
+    ingest_fits.create_images_table(conn)
+    ingest_fits.create_headers_table(conn)
+    cone_search.create_pointing_tables(conn)
+
+    rng = np.random.default_rng(seed)
+    start = time.time()
+    for n in range(nights):
+        night = night_name(n)
+        night_dir = join(archive, 'data', night)
+        os.makedirs(night_dir, exist_ok=True)
+        for i in range(frames):
+            base = join(night_dir, '{}-{:04d}L'.format(night[2:], i))
+            data, hdr = fake_frame(rng, night, i, size)
+            fits.writeto(base + '.fit', data, hdr, overwrite=True)
+            lo, hi = np.percentile(data, (0.2, 99.5))
+            thumb = np.clip((data - lo) / max(hi - lo, 1.0) * 255.0, 0, 255)
+            Image.fromarray(thumb[::-1].astype(np.uint8)).save(base + '.png')
+            # The ingest reports every keyword; keep the console quiet.
+            with contextlib.redirect_stdout(io.StringIO()):
+                ingest_fits.ingest_file(conn, cursor, base + '.fit', night_dir)
+        print('{}  {} frames  {:.1f} s'.format(night, frames,
+                                               time.time() - start))
+    conn.close()
+
+#------------------------------------------------------------------------
+# Clients
+
+class WSGIClient(object):
+    '''
+    Calls the WSGI app directly, as a server would.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def get(self, path):
+        parts = path.split('?', 1)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': parts[0],
+                   'QUERY_STRING': parts[1] if (len(parts) > 1) else '',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'SERVER_PROTOCOL': 'HTTP/1.1', 'SCRIPT_NAME': '',
+                   'REMOTE_ADDR': '127.0.0.1', 'wsgi.version': (1, 0),
+                   'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+                   'wsgi.errors': sys.stderr, 'wsgi.multithread': True,
+                   'wsgi.multiprocess': False, 'wsgi.run_once': False}
+        status = []
+        rheaders = {}
+
+        def start_response(stat, headers, exc_info=None):
+            status.append(int(stat.split(' ', 1)[0]))
+            rheaders.update((k.lower(), v) for k, v in headers)
+
+        result = self.app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if (hasattr(result, 'close')):
+                result.close()
+        return status[0], rheaders, body
+
+class HTTPClient(object):
+    '''
+    One keep-alive connection per simulated browser.
+    '''
+    def __init__(self, base):
+        url = urllib.parse.urlsplit(base)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.prefix = url.path.rstrip('/')
+        self.conn = None
+
+    def get(self, path):
+        for attempt in (0, 1):
+            if (self.conn == None):
+                self.conn = http.client.HTTPConnection(self.host, self.port,
+                                                       timeout=60)
+            try:
+                self.conn.request('GET', self.prefix + path)
+                resp = self.conn.getresponse()
+                body = resp.read()
+                headers = dict((k.lower(), v) for k, v in resp.getheaders())
+                if (resp.will_close):
+                    self.conn.close()
+                    self.conn = None
+                return resp.status, headers, body
+            except (http.client.HTTPException, OSError):
+                # Server closed an idle connection: reconnect once.
+                self.conn.close()
+                self.conn = None
+                if (attempt == 1):
+                    raise
+
+#------------------------------------------------------------------------
+# Simulated browsers
+
+class Recorder(object):
+    '''
+    Latencies and errors per route, shared by all the browsers.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.errors = {}
+        self.nbytes = 0
+
+    def timed(self, client, route, path):
+        start = time.perf_counter()
+        try:
+            status, headers, body = client.get(path)
+        except Exception:
+            status, headers, body = 599, {}, b''
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.times.setdefault(route, []).append(elapsed)
+            self.nbytes += len(body)
+            if (status >= 400):
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return status, headers, body
+
+def quote(path):
+    return urllib.parse.quote(path)
+
+def redirect_path(client, location):
+    '''
+    Path to request for a redirect Location (absolute URL or path),
+    without the prefix the HTTP client adds itself.
+    '''
+    url = urllib.parse.urlsplit(location)
+    path = url.path
+    prefix = getattr(client, 'prefix', '')
+    if (prefix and path.startswith(prefix + '/')):
+        path = path[len(prefix):]
+    return path + ('?' + url.query if url.query else '')
+
+def browse(client, rec, stop, think, rng):
+    '''
+    One simulated observer: open a night, look at some thumbnails and
+    previews, page the frame list, now and then run a cone search.
+    '''
+    status, headers, body = rec.timed(client, '/api/nights',
+                                      '/api/nights?limit=1000')
+    if (status != 200):
+        return
+    nights = [row[0] for row in json.loads(body)['rows']]
+    if (len(nights) == 0):
+        return
+
+    while (not stop.is_set()):
+        night = rng.choice(nights)
+        rec.timed(client, '/astrobrowse/<date>', '/astrobrowse/' + night)
+        status, headers, body = rec.timed(client, '/api/frames',
+                                          '/api/frames?limit=50&night=' +
+                                          night)
+        rows = []
+        if (status == 200):
+            doc = json.loads(body)
+            icol = doc['columns'].index('path')
+            tcol = doc['columns'].index('thumbpath')
+            rows = [(r[icol], r[tcol]) for r in doc['rows']]
+            if (doc['next'] and (rng.random() < 0.3)):
+                rec.timed(client, '/api/frames',
+                          '/api/frames?limit=50&night={}&after={}'.format(
+                              night, doc['next']))
+        for path, thumb in rng.sample(rows, min(6, len(rows))):
+            rec.timed(client, '/data/<thumb>', '/data/' + quote(thumb))
+        if (rows and (rng.random() < 0.25)):
+            path = rng.choice(rows)[0]
+            status, headers, body = rec.timed(client, '/preview/<frame>',
+                '/preview/{}?size={}'.format(quote(path),
+                                             rng.choice([128, 256])))
+            # The preview is rendered (or found) here, then fetched from
+            # its cached /previews/ file like a browser would.
+            if ((status in (301, 302, 303, 307)) and
+                headers.get('location')):
+                rec.timed(client, '/previews/<name>',
+                          redirect_path(client, headers['location']))
+        if (rng.random() < 0.1):
+            name, ra, dec = rng.choice(OBJECTS)
+            rec.timed(client, '/astrobrowse/search',
+                      '/astrobrowse/search?' + urllib.parse.urlencode(
+                          {'ra': ra, 'dec': dec, 'radius': 0.5}))
+        if (think > 0):
+            stop.wait(rng.expovariate(1.0 / think))
+
+def percentile(sorted_times, q):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    '''
+    k = max(0, int(np.ceil(q / 100.0 * len(sorted_times))) - 1)
+    return sorted_times[k]
+
+def report(rec, seconds, out=sys.stdout):
+    total = sum(len(t) for t in rec.times.values())
+    out.write('{:22s} {:>7s} {:>6s} {:>8s} {:>8s} {:>8s} {:>8s}\n'.format(
+        'route', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for route in sorted(rec.times):
+        times = sorted(rec.times[route])
+        out.write('{:22s} {:7d} {:6d} {:8.1f} {:8.2f} {:8.2f} {:8.2f}\n'.format(
+            route, len(times), rec.errors.get(route, 0),
+            len(times) / seconds, percentile(times, 50) * 1000.0,
+            percentile(times, 95) * 1000.0, percentile(times, 99) * 1000.0))
+    out.write('{} requests in {:.1f} s: {:.1f} req/s, {:.1f} MB/s\n'.format(
+        total, seconds, total / seconds, rec.nbytes / seconds / 1e6))
+
+def run(make_client, clients, duration, think, seed=1):
+    rec = Recorder()
+    stop = threading.Event()
+    threads = []
+    start = time.perf_counter()
+    for c in range(clients):
+        t = threading.Thread(target=browse, args=(make_client(), rec, stop,
+                                                  think, random.Random(seed + c)),
+                             daemon=True)
+        t.start()
+        threads.append(t)
+    stop.wait(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return rec, time.perf_counter() - start
+
+def load_app(archive):
+    '''
+    Import astrobrowse to serve archive (its data/ and PW17QSI.db).
+    '''
+    os.chdir(archive)
+    sys.path.insert(0, WEB_DIR)
+    import bottle
+    import astrobrowse
+    # Templates are looked up from the web directory, not the archive.
+    bottle.TEMPLATE_PATH.insert(0, WEB_DIR + '/')
+    # The deployed stack (wsgi.py), metrics middleware included.
+    return astrobrowse.application
+
+if (__name__ == "__main__"):
+
+    parser = argparse.ArgumentParser(description='''
+    Build a synthetic archive and/or load test astrobrowse with
+    concurrent simulated browsers.
+    ''', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('archive', nargs='?', default=None,
+        help='synthetic archive directory (data/ and PW17QSI.db)')
+    parser.add_argument('-build', default=False, action='store_true',
+        help='(re)build the synthetic archive first')
+    parser.add_argument('-nights', default=10, type=int,
+        help='nights in the synthetic archive')
+    parser.add_argument('-frames', default=100, type=int,
+        help='frames per night in the synthetic archive')
+    parser.add_argument('-size', default=64, type=int,
+        help='frame width and height in pixels')
+    parser.add_argument('-clients', default=4, type=int,
+        help='concurrent simulated browsers')
+    parser.add_argument('-duration', default=10.0, type=float,
+        help='seconds to run for; 0 builds only')
+    parser.add_argument('-think', default=0.0, type=float,
+        help='mean think time between page views (seconds)')
+    parser.add_argument('-mode', default='wsgi', choices=['wsgi', 'http'],
+        help='call the app in-process, or over HTTP on localhost')
+    parser.add_argument('-port', default=6001, type=int,
+        help='localhost port for -mode http')
+    parser.add_argument('-url', default=None,
+        help='load test a running server instead of an archive')
+
+    args = parser.parse_args()
+
+    if (args.url == None):
+        if (args.archive == None):
+            parser.error('give an archive directory or -url')
+        args.archive = abspath(args.archive)
+        if (args.build):
+            if (os.path.exists(join(args.archive, 'PW17QSI.db'))):
+                os.remove(join(args.archive, 'PW17QSI.db'))
+            build_archive(args.archive, args.nights, args.frames, args.size)
+        if (args.duration <= 0):
+            sys.exit(0)
+
+    if (args.url != None):
+        make_client = lambda: HTTPClient(args.url)
+    elif (args.mode == 'wsgi'):
+        app = load_app(args.archive)
+        make_client = lambda: WSGIClient(app)
+    else:
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *a):
+                pass
+
+        app = load_app(args.archive)
+        import astrobrowse
+        server = make_server('127.0.0.1', args.port, app,
+                             server_class=astrobrowse.ThreadingWSGIServer,
+                             handler_class=QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}'.format(args.port)
+        make_client = lambda: HTTPClient(url)
+
+    rec, seconds = run(make_client, args.clients, args.duration, args.think)
+    report(rec, seconds)
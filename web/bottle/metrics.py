@@ -0,0 +1,235 @@
+'''
+Request metrics for astrobrowse, in Prometheus text format.
+
+MetricsMiddleware wraps the WSGI app (outside StripPathMiddleware)
+and records, per route and method:
+- request latency (until the last byte of the body is handed to the
+  server, so streamed downloads count in full) as a histogram;
+  server-sent event streams are timed to their first byte instead,
+  and file bodies the server sends itself (wsgi.file_wrapper) to the
+  hand-off, so they keep their sendfile path
+- SQLite time spent in the request as a histogram, from sql_timer()
+  blocks around the database calls
+- response bytes and requests by status code
+
+render() produces the /metrics page.  Requests slower than the
+threshold are written to the slow-request log; both are configurable
+with ASTROBROWSE_SLOW_MS and ASTROBROWSE_SLOW_LOG.  The /metrics page
+is only served to scrapers that send ASTROBROWSE_METRICS_TOKEN as a
+bearer token (see authorized()).
+'''
+import hmac
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency histogram bucket bounds (seconds).
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Requests taking longer than this are logged.
+SLOW_SECONDS = float(os.environ.get('ASTROBROWSE_SLOW_MS', '1000')) / 1000.0
+# Slow-request log file (default: stderr).
+SLOW_LOG = os.environ.get('ASTROBROWSE_SLOW_LOG')
+# Bearer token required to read /metrics (unset: /metrics is disabled).
+METRICS_TOKEN = os.environ.get('ASTROBROWSE_METRICS_TOKEN')
+# Responses of these types are open-ended streams.
+STREAM_TYPES = ('text/event-stream',)
+
+_lock = threading.Lock()
+_local = threading.local()
+_requests = {}
+_bytes = {}
+_latency = {}
+_sql = {}
+
+slow_log = logging.getLogger('astrobrowse.slow')
+
+class Histogram(object):
+    '''
+    Cumulative-bucket histogram, as Prometheus expects it.
+    '''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        i = 0
+        while ((i < len(BUCKETS)) and (value > BUCKETS[i])):
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.n += 1
+
+@contextmanager
+def sql_timer():
+    '''
+    Charge the time spent in the block to the current request's SQL time.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.sql = getattr(_local, 'sql', 0.0) + \
+            (time.perf_counter() - start)
+
+def authorized(environ):
+    '''
+    True if the request carries the metrics bearer token.
+    Behind a reverse proxy every request comes from the loopback
+    address, so the client address can't be used for this.
+    '''
+    if (not METRICS_TOKEN):
+        return False
+    auth = environ.get('HTTP_AUTHORIZATION', '')
+    if (not auth.startswith('Bearer ')):
+        return False
+    return hmac.compare_digest(auth[7:].strip().encode(),
+                               METRICS_TOKEN.encode())
+
+def _record(route, method, status, seconds, sql, nbytes):
+    with _lock:
+        key = (route, method, status)
+        _requests[key] = _requests.get(key, 0) + 1
+        _bytes[(route, method)] = _bytes.get((route, method), 0) + nbytes
+        for table, value in ((_latency, seconds), (_sql, sql)):
+            hist = table.get((route, method))
+            if (hist == None):
+                hist = table[(route, method)] = Histogram()
+            hist.observe(value)
+
+class _Body(object):
+    '''
+    Wraps the response iterable to count bytes and finish the
+    measurement when the server closes it.
+    '''
+    def __init__(self, result, done):
+        self.result = result
+        self.done = done
+        self.nbytes = 0
+
+    def __iter__(self):
+        for chunk in self.result:
+            self.nbytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if (hasattr(self.result, 'close')):
+                self.result.close()
+        finally:
+            self.done(self.nbytes)
+
+class MetricsMiddleware(object):
+    '''
+    Time every request and record it under its bottle route rule.
+    '''
+    def __init__(self, app, slow_seconds=None, slow_logfile=None):
+        self.app = app
+        self.slow = SLOW_SECONDS if (slow_seconds == None) else slow_seconds
+        logfile = SLOW_LOG if (slow_logfile == None) else slow_logfile
+        if (not slow_log.handlers):
+            if (logfile):
+                handler = logging.FileHandler(logfile)
+            else:
+                handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            slow_log.addHandler(handler)
+            slow_log.setLevel(logging.INFO)
+            slow_log.propagate = False
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        _local.sql = 0.0
+        status = ['000']
+        rheaders = {}
+
+        def _start_response(stat, headers, exc_info=None):
+            status[0] = stat.split(' ', 1)[0]
+            rheaders.clear()
+            rheaders.update((k.lower(), v) for k, v in headers)
+            return start_response(stat, headers, exc_info)
+
+        def done(nbytes):
+            seconds = time.perf_counter() - start
+            sql = getattr(_local, 'sql', 0.0)
+            route = environ.get('bottle.route')
+            rule = route.rule if (route != None) else 'unmatched'
+            method = environ.get('REQUEST_METHOD', 'GET')
+            _record(rule, method, status[0], seconds, sql, nbytes)
+            if (seconds >= self.slow):
+                query = environ.get('QUERY_STRING')
+                slow_log.info('%s %s%s %s %.1f ms (sql %.1f ms) %d bytes',
+                              method, environ.get('PATH_INFO', ''),
+                              ('?' + query) if query else '', status[0],
+                              seconds * 1000.0, sql * 1000.0, nbytes)
+
+        try:
+            result = self.app(environ, _start_response)
+        except Exception:
+            status[0] = '500'
+            done(0)
+            raise
+
+        # Event streams stay open as long as the client does: record
+        # the time to the first event (bottle has already produced it)
+        # rather than the connection length.
+        ctype = rheaders.get('content-type', '').split(';')[0].strip()
+        if (ctype in STREAM_TYPES):
+            done(0)
+            return result
+        # Files the server sends itself: don't hide them behind a
+        # generator, which would lose the sendfile path.
+        wrapper = environ.get('wsgi.file_wrapper')
+        if ((type(wrapper) is type) and isinstance(result, wrapper)):
+            done(int(rheaders.get('content-length', 0) or 0))
+            return result
+        return _Body(result, done)
+
+def _labels(route, method, **more):
+    text = 'route="{}",method="{}"'.format(route.replace('"', '\\"'), method)
+    for key, value in more.items():
+        text += ',{}="{}"'.format(key, value)
+    return text
+
+def render():
+    '''
+    All metrics in the Prometheus text exposition format.
+    '''
+    out = []
+    with _lock:
+        out.append('# HELP astrobrowse_requests_total Requests by route and '
+                   'status.')
+        out.append('# TYPE astrobrowse_requests_total counter')
+        for (route, method, status), n in sorted(_requests.items()):
+            out.append('astrobrowse_requests_total{{{}}} {}'.format(
+                _labels(route, method, status=status), n))
+
+        out.append('# HELP astrobrowse_response_bytes_total Response body '
+                   'bytes sent.')
+        out.append('# TYPE astrobrowse_response_bytes_total counter')
+        for (route, method), n in sorted(_bytes.items()):
+            out.append('astrobrowse_response_bytes_total{{{}}} {}'.format(
+                _labels(route, method), n))
+
+        for name, table, text in (
+                ('astrobrowse_request_duration_seconds', _latency,
+                 'Request latency, including streaming the body '
+                 '(event streams: to the first event).'),
+                ('astrobrowse_request_sql_seconds', _sql,
+                 'SQLite time per request.')):
+            out.append('# HELP {} {}'.format(name, text))
+            out.append('# TYPE {} histogram'.format(name))
+            for (route, method), hist in sorted(table.items()):
+                labels = _labels(route, method)
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ['+Inf'], hist.counts):
+                    cumulative += count
+                    out.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bound, cumulative))
+                out.append('{}_sum{{{}}} {:.6f}'.format(name, labels,
+                                                         hist.total))
+                out.append('{}_count{{{}}} {}'.format(name, labels, hist.n))
+    return '\n'.join(out) + '\n'
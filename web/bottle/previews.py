@@ -0,0 +1,175 @@
+'''
+On-demand PNG previews of FITS frames with a size-bounded LRU disk cache.
+
+A preview is rendered from a strided read of the data unit (only every
+n-th row/column is read, through the astropy section interface) and
+stretched to 8 bits.  The cache file name is a hash of the frame's path,
+size, mtime and the render options, so a changed frame never hits a
+stale preview and the files can be served with a long max-age.
+
+Concurrent requests for the same preview are single-flighted: the first
+one renders, the others wait on its lock and then read the cached file.
+A preview handed out by preview_file() is kept out of eviction for
+PIN_SECONDS, so the client can still fetch it at the URL it was
+redirected to.
+'''
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+from PIL import Image
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'cache', 'previews')
+# Upper bound on the disk used by the preview cache.
+CACHE_BYTES = 512 * 1024 * 1024
+# Previews just handed out are not evicted for this long (seconds).
+PIN_SECONDS = 60.0
+
+DEFAULT_SIZE = 300
+MIN_SIZE = 16
+MAX_SIZE = 2048
+
+STRETCHES = ['linear', 'log', 'asinh']
+
+_lock = threading.Lock()
+_inflight = {}
+_index = None
+# name -> time.monotonic() it was last handed out
+_pinned = {}
+
+def _load_index():
+    '''
+    In-memory LRU index of the cache directory (name -> bytes),
+    oldest access first.  Built from the files' atimes on first use.
+    '''
+    global _index
+    if (_index == None):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        entries = []
+        for f in os.listdir(CACHE_DIR):
+            if (f.endswith('.png')):
+                st = os.stat(os.path.join(CACHE_DIR, f))
+                entries.append((st.st_atime, f, st.st_size))
+        entries.sort()
+        _index = OrderedDict((f, size) for atime, f, size in entries)
+    return _index
+
+def _evict():
+    '''
+    Drop least recently used previews until the cache fits, skipping
+    the ones still pinned.  Called with _lock held.
+    '''
+    index = _load_index()
+    total = sum(index.values())
+    if (total <= CACHE_BYTES):
+        return
+    now = time.monotonic()
+    for name in [n for n, t in _pinned.items() if (now - t > PIN_SECONDS)]:
+        del _pinned[name]
+    for name in list(index):
+        if (total <= CACHE_BYTES):
+            break
+        if (name in _pinned):
+            continue
+        size = index.pop(name)
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cache_name(fitsfile, size, stretch):
+    '''
+    Content-addressed cache file name for a preview.
+    '''
+    st = os.stat(fitsfile)
+    key = '{}|{}|{}|{}|{}'.format(os.path.abspath(fitsfile), st.st_size,
+                                  st.st_mtime_ns, size, stretch)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + '.png'
+
+def render(fitsfile, size=DEFAULT_SIZE, stretch='linear'):
+    '''
+    Render a preview of the first image plane, size pixels wide.
+    Returns PNG bytes.
+    '''
+    # Read the raw values through the section and scale them here;
+    # astropy won't memory-map BZERO/BSCALE data itself.
+    with fits.open(fitsfile, memmap=True,
+                   do_not_scale_image_data=True) as hdul:
+        hdr = hdul[0].header
+        naxis1 = hdr.get('NAXIS1', 0)
+        step = max(1, naxis1 // size)
+        if (hdr.get('NAXIS', 0) == 3):
+            dat = hdul[0].section[0, ::step, ::step]
+        else:
+            dat = hdul[0].section[::step, ::step]
+        dat = np.asarray(dat, dtype=np.float32) * hdr.get('BSCALE', 1.0) + \
+            hdr.get('BZERO', 0.0)
+
+    # Same default cut as fitsToThumb.py
+    v_min, v_max = np.percentile(dat, (0.2, 99.5))
+    if (v_max <= v_min):
+        v_max = v_min + 1.0
+    dat = np.clip((dat - v_min) / (v_max - v_min), 0.0, 1.0)
+    if (stretch == 'log'):
+        dat = np.log1p(1000.0 * dat) / np.log1p(1000.0)
+    elif (stretch == 'asinh'):
+        dat = np.arcsinh(10.0 * dat) / np.arcsinh(10.0)
+
+    # FITS row 0 is the bottom of the image.
+    img = Image.fromarray((dat[::-1] * 255.0 + 0.5).astype(np.uint8))
+    height = max(1, int(round(img.height * size / float(img.width))))
+    img = img.resize((size, height), Image.BILINEAR)
+
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+def preview_file(fitsfile, size=DEFAULT_SIZE, stretch='linear'):
+    '''
+    Path of the cached preview for fitsfile, rendering it on a miss.
+    Returns (cache directory, file name within it).
+    '''
+    name = cache_name(fitsfile, size, stretch)
+    cached = os.path.join(CACHE_DIR, name)
+
+    with _lock:
+        index = _load_index()
+        if ((name in index) and os.path.exists(cached)):
+            index.move_to_end(name)
+            _pinned[name] = time.monotonic()
+            return CACHE_DIR, name
+        flight = _inflight.get(name)
+        if (flight == None):
+            flight = _inflight[name] = threading.Lock()
+
+    tmp = cached + '.{}.tmp'.format(threading.get_ident())
+    try:
+        with flight:
+            # Someone else may have finished it while we waited.
+            if (not os.path.exists(cached)):
+                png = render(fitsfile, size, stretch)
+                with open(tmp, 'wb') as fp:
+                    fp.write(png)
+                os.replace(tmp, cached)
+    finally:
+        with _lock:
+            _inflight.pop(name, None)
+        # Left behind only if the render or the write failed.
+        if (os.path.exists(tmp)):
+            os.remove(tmp)
+
+    with _lock:
+        index = _load_index()
+        index[name] = os.path.getsize(cached)
+        index.move_to_end(name)
+        _pinned[name] = time.monotonic()
+        _evict()
+
+    return CACHE_DIR, name
@@ -14,8 +14,18 @@ def server_static(filepath):
 
 @route('/astrobrowse/color')
 def show_color():
-    # Get a list of the color images.
-    colorlist = [f for f in listdir("data/color")]
+    # Get the color composites recorded by makeColor.py (none until it
+    # or color_products.py --rebuild has made the table).
+    conn = sqlite3.connect('PW17QSI.db')
+    c = conn.cursor()
+    try:
+        c.execute("select path, previewpath, previewwidth, \
+                     previewheight, width, height, red, green, blue, created \
+                     from color_products order by created desc, path")
+        colorlist = c.fetchall()
+    except sqlite3.OperationalError:
+        colorlist = []
+    c.close()
     # Pass list to html template and return result.
     output = template('templates/color', url=url, colorlist=colorlist)
     return output
@@ -10,11 +10,19 @@
     </div>
   </div>
   <div class="main-content">
-    % for image in colorlist:
-      <h2>{{image}}</h2>
-      <img src="{{url('data', filepath='color/' + image)}}" width=1200>
+    % for path, preview, pwidth, pheight, width, height, red, green, blue, created in colorlist:
+      <h2>{{path.split('/')[-1]}}</h2>
+      <!-- Small preview; the full image loads only when followed. -->
+      <a href="{{url('data', filepath=path)}}">
+        <img src="{{url('data', filepath=preview)}}" loading="lazy"
+             width="{{pwidth}}" height="{{pheight}}"
+             alt="{{path}}"></a>
+      <p>{{width}} x {{height}}
+      % if red:
+        from {{red}}, {{green}}, {{blue}}
+      % end
+      </p>
     % end
   <div>
 </body>
 </html>
-
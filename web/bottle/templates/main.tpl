@@ -58,6 +58,31 @@
       }
       window.location.assign(new_url);
     };
+
+    % if get('feed'):
+    // Append frames of the night shown as they are ingested.
+    if (window.EventSource) {
+      var night = document.getElementById("date-select").value;
+      var source = new EventSource("{{feed}}");
+      source.addEventListener("frame", function(e) {
+        var f = JSON.parse(e.data);
+        if (f.path.indexOf(night + "/") != 0) {
+          return;
+        }
+        var row = document.getElementById("images").insertRow(-1);
+        var cols = [f.name, f.dateobs, f.naxis1, f.exptime, f.filter,
+                    f.imagetyp];
+        for (var i = 0; i < cols.length; i++) {
+          row.insertCell(-1).textContent = cols[i];
+        }
+        var link = document.createElement("a");
+        link.href = f.preview;
+        link.target = "popup";
+        link.textContent = "thumb";
+        row.insertCell(-1).appendChild(link);
+      });
+    }
+    % end
   </script>
 </body>
 </html>
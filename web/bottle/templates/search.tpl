@@ -0,0 +1,53 @@
+<!DOCTYPE html>
+<html>
+<head>
+  <link rel="stylesheet" href="{{url('assets', filepath='css/styles.css')}}">
+</head>
+<body style="background-color:lightblue;">
+  <div class="banner">
+    <div class="banner-content">
+      Lowell Astrophotography Project Database
+    </div>
+  </div>
+  <div class="main-content">
+    <div class="select-date">
+      <form action="{{url('search')}}" method="get">
+        <label for="ra">RA:</label>
+        <input type="text" name="ra" id="ra" value="{{ra}}" size="12">
+        <label for="dec">Dec:</label>
+        <input type="text" name="dec" id="dec" value="{{dec}}" size="12">
+        <label for="radius">Radius (deg):</label>
+        <input type="text" name="radius" id="radius" value="{{radius}}" size="6">
+        <input type="submit" value="Search">
+      </form>
+    </div>
+    <table id="images" border="1">
+      <tr>
+        <th>Name</th>
+        <th>Date</th>
+        <th>Width</th>
+        <th>Exptime</th>
+        <th>Filter</th>
+        <th>Frame Type</th>
+        <th>Thumb</th>
+        <th>Sep (deg)</th>
+      </tr>
+      %for row in imlist:
+        <tr>
+        %for col in row:
+          %if ('UT' in str(col)):
+            <td><a href='{{url('data', filepath=col)}}'
+                  target='popup'
+                  onclick="window.open('{{url('data', filepath=col)}}',
+                    'popup','width=300,height=300'); return false;"
+                    >thumb</a></td>
+          %else:
+            <td>{{col}}</td>
+          %end
+        %end
+        </tr>
+      %end
+      </table>
+  <div>
+</body>
+</html>
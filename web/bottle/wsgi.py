@@ -1,4 +1,5 @@
-from astrobrowse import app
+import bottle
+from astrobrowse import app, application
 
 if __name__ == "__main__":
-  app.run()
+  bottle.run(app=application)
@@ -5,6 +5,45 @@ from skimage.exposure import (rescale_intensity, adjust_log, equalize_hist,
 import numpy as np
 from astropy.io import fits
 import glob, os, sys
+import sqlite3
+
+this_path, this_file = os.path.split(os.path.abspath(__file__))
+sys.path.append(this_path + "/../stephen")
+import reduc_stat_utils
+
+def duplicate_paths(this_dir):
+  """ images.path of the frames in this night directory that the
+      ingest linked to an earlier copy; they share its thumbnail.
+      Empty if there is no database (or it predates the column)."""
+
+  db_path = this_path + "/../../db/PW17QSI.db"
+  if (not os.path.exists(db_path)):
+    return set()
+
+  night = os.path.basename(os.path.normpath(this_dir))
+  conn = sqlite3.connect("file:{}?mode=ro".format(db_path), uri=True)
+  try:
+    rows = conn.execute("select path from images \
+      where path like ? and duplicate_of is not null", (night + "/%",))
+    dups = set(row[0] for row in rows)
+  except sqlite3.OperationalError:
+    dups = set()
+  conn.close()
+  return dups
+
+def make_thumb(image_data, width, outfile):
+  """ Write a 300 pixel wide PNG thumbnail of an image array
+      (percentile stretch 0.2 - 99.5)."""
+
+  # One histogram pass for integer (camera) data
+  pct = reduc_stat_utils.array_stats(image_data, ["p0.2", "p99.5"])
+  v_min, v_max = pct["p0.2"], pct["p99.5"]
+  image_data = rescale_intensity(image_data, in_range=(v_min, v_max),
+      out_range=(0, 256))
+  fraction = 300./width
+  image_data = rescale(image_data, fraction)
+  image_data = image_data.astype(np.uint8)
+  imsave(outfile, image_data)
 
 if __name__ == "__main__":
 
@@ -15,24 +54,23 @@ if __name__ == "__main__":
 
   this_dir = sys.argv[1]
 
+  dups = duplicate_paths(this_dir)
+  night = os.path.basename(os.path.normpath(this_dir))
+
   # For each FITS file (extension = .fit) in the specified directory.
   count = 0
   for infile in glob.glob(this_dir + "/*.fit"):
     print(infile)
+    if ((night + "/" + os.path.basename(infile)) in dups):
+      print("  copy of an ingested frame, skipping")
+      continue
     file, ext = os.path.splitext(infile)
     hdul = fits.open(infile)
     width = hdul[0].header["NAXIS1"]
     image_data = hdul[0].data
     hdul.close()
 
-    base = os.path.splitext(file)[0]
-    v_min, v_max = np.percentile(image_data, (0.2, 99.5))
-    image_data = rescale_intensity(image_data, in_range=(v_min, v_max),
-        out_range=(0, 256))
-    fraction = 300./width
-    image_data = rescale(image_data, fraction)
-    image_data = image_data.astype(np.uint8)
-    imsave(file + ".png", image_data)
+    make_thumb(image_data, width, file + ".png")
     count = count + 1
   #  if (count > 10): break
 
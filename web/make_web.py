@@ -1,59 +1,300 @@
-import numpy as np
-from astropy.io import fits
-import glob, os, sys
+import argparse
+import hashlib
+import html
+import json
+import os, sys
+import shutil
+import sqlite3
 
-n = len(sys.argv)
-if (n != 2):
-  print("usage: make_web directory")
-  sys.exit(2)
+# has_column() is with the ingest code in ../db
+this_path, this_file = os.path.split(os.path.abspath(__file__))
+sys.path.append(this_path + "/../db")
+import query_frames
 
-this_dir = sys.argv[1]
+# Static gallery pages built from the images table, ordered by DATE-OBS.
+#
+# Writes <out>/<night>/index.html (plus index-2.html, ... when a night has
+# more than -pagesize frames) and a season index at <out>/index.html.
+# A manifest in <out> records a signature of each night's rows, so only
+# nights whose rows changed since the last build are rewritten.  The
+# rows are only hashed for nights whose frame count or highest rowid
+# moved; a night whose rows were rewritten in place needs -force.
 
+# Bump when the page layout changes, to force a full rebuild.
+PAGE_VERSION = 1
 
-# Copy the styles.css file to this directory.
-os.popen("cp ../../data/styles.css " + this_dir)
-# open output file.
-with open(this_dir + '/index.html', 'w') as fp:
-  fp.write('''<!doctype html>\n
+MANIFEST = ".make_web_manifest.json"
+
+HEAD = '''<!doctype html>
 <html lang="en">
 <head>
-  <meta charset="utf-8">\n
-  <title>index of images</title>\n
-  <link rel="stylesheet" href="styles.css">\n
-</head>\n
-<body>\n''' )
-  fp.write('<div class="grid-container">\n')
+  <meta charset="utf-8">
+  <title>{title}</title>
+  <link rel="stylesheet" href="{css}">
+</head>
+<body>
+'''
+
+TAIL = '''</body>
+</html>
+'''
+
+def night_rows(conn, nights=None):
+  """ Stream the gallery rows, grouped by night directory and ordered
+      by observation time within a night.  Copies linked to an
+      earlier frame (duplicate_of) are left out, once the ingest has
+      added that column.
+
+      Return: generator of (night, name, thumbpath, naxis1, dateobs,
+              exptime, filter, imagetyp)"""
+
+  where = []
+  params = []
+  if (query_frames.has_column(conn, "duplicate_of")):
+    where.append("duplicate_of is null")
+  if (nights != None):
+    # path ranges NIGHT/..., from the path index
+    where.append("(" + " or ".join(["(path >= ? and path < ?)"] *
+                                   len(nights)) + ")")
+    for night in nights:
+      params.extend([night + "/", night + "0"])
+  sql = "select substr(path, 1, instr(path, '/') - 1) as night, \
+    name, thumbpath, naxis1, dateobs, exptime, filter, imagetyp \
+    from images"
+  if (len(where) > 0):
+    sql = sql + " where " + " and ".join(where)
+  sql = sql + " order by night, dateobs, name"
+
+  cur = conn.cursor()
+  cur.arraysize = 1000
+  cur.execute(sql, params)
+  while True:
+    rows = cur.fetchmany()
+    if (len(rows) == 0):
+      break
+    for row in rows:
+      yield row
+
+
+def quick_signatures(conn):
+  """ Cheap per-night signature, frame count and highest rowid (copies
+      included), read from the path index without touching the rows.
+
+      Return: {night: [count, max rowid]}"""
+
+  rows = conn.execute("select substr(path, 1, instr(path, '/') - 1) \
+    as night, count(*), max(rowid) from images group by night")
+  return dict((row[0], [row[1], row[2]]) for row in rows)
+
+
+def scan_nights(conn, nights=None):
+  """ One pass over the rows: a signature and frame count per night.
+
+      Return: {night: (signature, count)}"""
+
+  sigs = {}
+  current = None
+  h = None
   count = 0
-  for infile in glob.glob(this_dir + "/*.fit"):
-      file, ext = os.path.splitext(infile)
-      base = os.path.basename(file)
-      thumb_image = base + ".png"
-      hdul = fits.open(infile)
-      exptime = hdul[0].header["EXPTIME"]
-      try:
-        filt = hdul[0].header["FILTER"]
-      except KeyError:
-        filt = "NONE"
-      imtype = hdul[0].header["IMAGETYP"]
-      datetime = hdul[0].header["DATE-OBS"]
-      width = hdul[0].header["NAXIS1"]
-      hdul.close()
-
-      fp.write('<div class="grid-item">\n')
-      fp.write('<figure>\n')
-      fp.write("  <img src=\"{}\"/>\n".format(thumb_image))
-      fp.write("  <figcaption>file: {}</figcaption>\n".format(file))
-      fp.write("  <figcaption>width: {}</figcaption>\n".format(width))
-      fp.write("  <figcaption>datetime: {}</figcaption>\n".format(datetime))
-      fp.write("  <figcaption>exptime: {}</figcaption>\n".format(exptime))
-      fp.write("  <figcaption>filter: {}</figcaption>\n".format(filt))
-      fp.write("  <figcaption>image type: {}</figcaption>\n".format(imtype))
-      fp.write('</figure>\n')
-      fp.write('''</div>''')
-
-      count = count + 1
-      #if (count > 10): break
-
-  fp.write('''</div>''')
-  fp.write('''</body>\n
-</html>\n''')
+  for row in night_rows(conn, nights):
+    if (row[0] != current):
+      if (current != None):
+        sigs[current] = (h.hexdigest(), count)
+      current = row[0]
+      h = hashlib.blake2b(digest_size=16)
+      h.update(str(PAGE_VERSION).encode())
+      count = 0
+    h.update(repr(row[1:]).encode())
+    count = count + 1
+  if (current != None):
+    sigs[current] = (h.hexdigest(), count)
+
+  return sigs
+
+
+def write_atomic(filename, text):
+  """ Write via a temporary file and rename, so a browser never sees
+      a half written page."""
+
+  tmp = filename + ".tmp"
+  with open(tmp, "w") as fp:
+    fp.write(text)
+  os.replace(tmp, filename)
+
+
+def page_name(page):
+  if (page == 1):
+    return "index.html"
+  return "index-{}.html".format(page)
+
+
+def page_links(page, npages):
+  """ Previous / page number / next links for a paginated night."""
+
+  if (npages <= 1):
+    return ""
+  links = ['<div class="pages">']
+  if (page > 1):
+    links.append('<a href="{}">&laquo; prev</a>'.format(page_name(page - 1)))
+  for p in range(1, npages + 1):
+    if (p == page):
+      links.append("<b>{}</b>".format(p))
+    else:
+      links.append('<a href="{}">{}</a>'.format(page_name(p), p))
+  if (page < npages):
+    links.append('<a href="{}">next &raquo;</a>'.format(page_name(page + 1)))
+  links.append("</div>\n")
+  return " ".join(links)
+
+
+def write_night(out_dir, night, rows, pagesize):
+  """ Write the paginated gallery pages for one night and remove
+      pages left over from a longer earlier build.
+
+      Return: number of pages written"""
+
+  night_dir = os.path.join(out_dir, night)
+  os.makedirs(night_dir, exist_ok=True)
+
+  npages = max(1, (len(rows) + pagesize - 1) // pagesize)
+  for page in range(1, npages + 1):
+    parts = [HEAD.format(title=html.escape(night) + " images",
+                         css="../styles.css")]
+    parts.append('<p><a href="../index.html">season index</a></p>\n')
+    parts.append(page_links(page, npages))
+    parts.append('<div class="grid-container">\n')
+    for name, thumbpath, width, dateobs, exptime, filt, imtype in \
+        rows[(page - 1) * pagesize:page * pagesize]:
+      parts.append('<div class="grid-item">\n<figure>\n')
+      # thumbpath is relative to the data root, and may point at the
+      # original of a copied frame in another night.
+      parts.append('  <img src="../{}" loading="lazy"/>\n'.format(
+        html.escape(str(thumbpath))))
+      for label, value in (("file", name), ("width", width),
+                           ("datetime", dateobs), ("exptime", exptime),
+                           ("filter", filt), ("image type", imtype)):
+        parts.append("  <figcaption>{}: {}</figcaption>\n".format(
+          label, html.escape(str(value))))
+      parts.append("</figure>\n</div>\n")
+    parts.append("</div>\n")
+    parts.append(page_links(page, npages))
+    parts.append(TAIL)
+    write_atomic(os.path.join(night_dir, page_name(page)), "".join(parts))
+
+  # Drop stale extra pages.
+  page = npages + 1
+  while os.path.exists(os.path.join(night_dir, page_name(page))):
+    os.remove(os.path.join(night_dir, page_name(page)))
+    page = page + 1
+
+  return npages
+
+
+def write_season(out_dir, sigs):
+  """ Season index: one line per night, newest first."""
+
+  parts = [HEAD.format(title="index of nights", css="styles.css")]
+  parts.append("<ul>\n")
+  for night in sorted(sigs, reverse=True):
+    parts.append('  <li><a href="{0}/index.html">{0}</a> ({1} frames)</li>\n'.
+                 format(html.escape(night), sigs[night][1]))
+  parts.append("</ul>\n")
+  parts.append(TAIL)
+  write_atomic(os.path.join(out_dir, "index.html"), "".join(parts))
+
+
+def build(conn, out_dir, pagesize=100, force=False, echo=True):
+  """ Rebuild the pages of the nights whose rows changed.
+
+      Return: list of nights rewritten"""
+
+  manifest_file = os.path.join(out_dir, MANIFEST)
+  manifest = {}
+  if ((not force) and os.path.exists(manifest_file)):
+    with open(manifest_file) as fp:
+      manifest = json.load(fp)
+  if ((manifest.get("pagesize") != pagesize) or ("quick" not in manifest)):
+    manifest = {}
+  old = manifest.get("nights", {})
+  old_counts = manifest.get("counts", {})
+  old_quick = manifest.get("quick", {})
+
+  # Hash the rows only of nights whose quick signature moved.
+  quick = quick_signatures(conn)
+  stale = [n for n in sorted(quick) if (old_quick.get(n) != quick[n])]
+  sigs = {}
+  for n in quick:
+    if ((n not in stale) and (n in old)):
+      sigs[n] = (old[n], old_counts.get(n, 0))
+  if (len(stale) > 0):
+    sigs.update(scan_nights(conn, stale))
+  changed = [n for n in sorted(sigs)
+             if ((old.get(n) != sigs[n][0]) or
+                 (not os.path.exists(os.path.join(out_dir, n, "index.html"))))]
+
+  if (len(changed) > 0):
+    current = None
+    rows = []
+    for row in night_rows(conn, changed):
+      if (row[0] != current):
+        if (current != None):
+          write_night(out_dir, current, rows, pagesize)
+        current = row[0]
+        rows = []
+      rows.append(row[1:])
+    if (current != None):
+      write_night(out_dir, current, rows, pagesize)
+    if (echo):
+      print("rebuilt " + " ".join(changed))
+
+  season_changed = ((len(changed) > 0) or (set(old) != set(sigs)) or
+    (not os.path.exists(os.path.join(out_dir, "index.html"))))
+  if (season_changed):
+    write_season(out_dir, sigs)
+
+    # Style sheet shared by all the pages.
+    css = os.path.join(out_dir, "styles.css")
+    this_path, this_file = os.path.split(os.path.abspath(__file__))
+    src = this_path + "/../../data/styles.css"
+    if ((not os.path.exists(css)) and os.path.exists(src)):
+      shutil.copy(src, css)
+  elif (echo):
+    print("nothing changed")
+
+  # (also when only copies were added: their nights needn't be hashed
+  # again next time)
+  if (season_changed or (old_quick != quick)):
+    write_atomic(manifest_file, json.dumps(
+      {"pagesize": pagesize,
+       "nights": dict((n, sigs[n][0]) for n in sigs),
+       "counts": dict((n, sigs[n][1]) for n in sigs),
+       "quick": quick}, indent=1))
+
+  return changed
+
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="""
+  Build static gallery pages (one set per night plus a season index)
+  from the images table, rewriting only the nights that changed.
+  """, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("-out", default="../../data",
+    help="site root; night pages go in <out>/<night>/")
+  parser.add_argument("-pagesize", default=100, type=int,
+    help="frames per page")
+  parser.add_argument("-force", default=False, action="store_true",
+    help="ignore the manifest and rebuild every night")
+  parser.add_argument("-db", default=None,
+    help="database file (default ../../db/PW17QSI.db from this script)")
+
+  args = parser.parse_args()
+
+  # Get the path to the database.
+  db_path = args.db
+  if (db_path == None):
+    db_path = this_path + "/../../db/PW17QSI.db"
+
+  conn = sqlite3.connect("file:{}?mode=ro".format(db_path), uri=True)
+  build(conn, args.out, pagesize=max(1, args.pagesize), force=args.force)
+  conn.close()